@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the PDF Extractor
+Generates synthetic documents and measures extraction performance.
+
+    python benchmark.py ocr --pages 10          # pages/s and character accuracy per OCR profile
+    python benchmark.py memory                  # peak memory per processing stage
+    python benchmark.py memory --update-baseline
+    python benchmark.py calibrate               # per-stage rates used by pdf_extractor.py --estimate
+"""
+
+import argparse
+import contextlib
+import difflib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from pdf_extractor import PDFExtractor, OCR_PROFILES, STAGE_RATES_PATH, load_stage_rates
+
+BASELINE_PATH = Path(__file__).parent / "memory_baseline.json"
+
+# Extractor methods profiled as stages; inner stages also count towards enclosing ones
+MEMORY_STAGES = {
+    "page_extraction": "extract_page",
+    "image_conversion": "save_image_pixmap",
+    "page_render": "render_page_for_ocr",
+    "full_text": "build_full_text",
+    "chunking": "split_text_by_tokens",
+}
+
+WORDS = (
+    "invoice contract payment delivery schedule warranty customer supplier quantity "
+    "amount total balance signature approved shipment order reference account terms "
+    "agreement report quarter revenue margin forecast budget inventory section clause"
+).split()
+
+
+def make_scanned_corpus(path: str, pages: int = 10, dpi: int = 150, seed: int = 7) -> list:
+    """Write an image-only PDF that looks like a scan and return the ground-truth text per page"""
+    rng = random.Random(seed)
+    noise = np.random.default_rng(seed)
+    truth = []
+    scanned = fitz.open()
+
+    for _ in range(pages):
+        lines = [" ".join(rng.choice(WORDS) for _ in range(8)) for _ in range(30)]
+        truth.append("\n".join(lines))
+
+        # Typeset the text, then rasterise it like a scanner would
+        source = fitz.open()
+        page = source.new_page()
+        for i, line in enumerate(lines):
+            page.insert_text((50, 60 + i * 24), line, fontsize=12)
+        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+        source.close()
+
+        # Paper grain and faint speckle
+        pixels = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width).astype(np.int16)
+        pixels = pixels - 20 + noise.normal(0, 12, pixels.shape).astype(np.int16)
+        pixels = np.clip(pixels, 0, 255).astype(np.uint8)
+        scan = fitz.Pixmap(fitz.csGRAY, pix.width, pix.height, pixels.tobytes(), False)
+
+        out_page = scanned.new_page()
+        out_page.insert_image(out_page.rect, pixmap=scan)
+
+    scanned.save(path, deflate=True)
+    scanned.close()
+    return truth
+
+
+def make_large_document(path: str, pages: int = 12, image_every: int = 3, image_size: int = 800,
+                        text_lines: int = 60, seed: int = 11) -> str:
+    """Write a document with long text on every page and a large CMYK image every few pages"""
+    rng = random.Random(seed)
+    noise = np.random.default_rng(seed)
+    doc = fitz.open()
+    for page_index in range(pages):
+        page = doc.new_page()
+        for i in range(text_lines):
+            line = " ".join(rng.choice(WORDS) for _ in range(10))
+            page.insert_text((36, 30 + i * 12), line, fontsize=8)
+        if image_every and page_index % image_every == 0:
+            # CMYK forces the colorspace conversion path
+            samples = noise.integers(0, 256, (image_size, image_size, 4), dtype=np.uint8)
+            pix = fitz.Pixmap(fitz.csCMYK, image_size, image_size, samples.tobytes(), False)
+            page.insert_image(fitz.Rect(36, 500, 336, 800), pixmap=pix)
+    doc.save(path, deflate=True)
+    doc.close()
+    return path
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or None where it cannot be read cheaply"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class StageMemoryProfiler:
+    """Measures peak memory per stage: Python allocations via tracemalloc and, where
+    available, process RSS sampled by a background thread (covers MuPDF's C allocations).
+    Peaks are reported relative to the memory in use when the stage (or profile) started."""
+
+    def __init__(self, sample_interval: float = 0.002):
+        self.sample_interval = sample_interval
+        self.stack = []
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.rss_start = None
+        self.sampling = False
+
+    def _stage(self, name):
+        return self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "python_peak": 0, "rss_peak": 0})
+
+    def _sample_rss(self):
+        rss = current_rss()
+        if rss is None:
+            return
+        with self.lock:
+            for frame in self.stack:
+                frame["rss_peak"] = max(frame["rss_peak"], rss)
+
+    def _sampler(self):
+        while self.sampling:
+            self._sample_rss()
+            time.sleep(self.sample_interval)
+
+    def enter(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            if self.stack:
+                # Keep the enclosing stage's peak before resetting for this one
+                self.stack[-1]["python_peak"] = max(self.stack[-1]["python_peak"], peak)
+            tracemalloc.reset_peak()
+            self.stack.append({"name": name, "start": current, "python_peak": current,
+                               "rss_peak": current_rss() or 0, "started_at": time.perf_counter()})
+
+    def exit(self):
+        self._sample_rss()
+        _, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            frame = self.stack.pop()
+            frame_peak = max(frame["python_peak"], peak)
+            if self.stack:
+                self.stack[-1]["python_peak"] = max(self.stack[-1]["python_peak"], frame_peak)
+        stage = self._stage(frame["name"])
+        stage["calls"] += 1
+        stage["seconds"] += time.perf_counter() - frame["started_at"]
+        stage["python_peak"] = max(stage["python_peak"], frame_peak - frame["start"])
+        if self.rss_start is not None:
+            stage["rss_peak"] = max(stage["rss_peak"], frame["rss_peak"] - self.rss_start)
+
+    def wrap(self, obj, method_name: str, stage: str):
+        """Replace obj.method_name with a version that is measured as the given stage"""
+        method = getattr(obj, method_name)
+
+        def measured(*args, **kwargs):
+            self.enter(stage)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.exit()
+
+        setattr(obj, method_name, measured)
+
+    def __enter__(self):
+        tracemalloc.start()
+        self.rss_start = current_rss()
+        if self.rss_start is not None:
+            self.sampling = True
+            self.thread = threading.Thread(target=self._sampler, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.sampling:
+            self.sampling = False
+            self.thread.join()
+        tracemalloc.stop()
+        return False
+
+
+def profile_memory(document: dict, use_ocr: bool = False) -> dict:
+    """Run process_pdf on a generated document and return peak memory per stage"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pdf_path = make_large_document(str(Path(temp_dir) / "large.pdf"), **document)
+        with contextlib.redirect_stdout(io.StringIO()):
+            extractor = PDFExtractor(use_ocr=use_ocr)
+        profiler = StageMemoryProfiler()
+        for stage, method_name in MEMORY_STAGES.items():
+            profiler.wrap(extractor, method_name, stage)
+
+        with profiler, contextlib.redirect_stdout(io.StringIO()):
+            extractor.process_pdf(pdf_path, str(Path(temp_dir) / "out"))
+            if not extractor.use_ocr:
+                # Without OCR process_pdf never renders pages; render them once so the
+                # stage is still covered
+                doc = fitz.open(pdf_path)
+                for page in doc:
+                    extractor.render_page_for_ocr(page)
+                doc.close()
+        return profiler.stages
+
+
+def check_memory_baseline(stages: dict, baseline: dict) -> list:
+    """Compare measured stage peaks with a stored baseline; returns the regressions found"""
+    failures = []
+    for stage, expected in baseline["stages"].items():
+        measured = stages.get(stage)
+        if measured is None:
+            failures.append(f"{stage}: stage did not run")
+            continue
+        for metric, tolerance in (("python_peak", baseline["tolerance"]),
+                                  ("rss_peak", baseline["rss_tolerance"])):
+            if metric == "rss_peak" and current_rss() is None:
+                continue
+            limit = expected[metric] * (1 + tolerance) + baseline["slack_bytes"]
+            if measured[metric] > limit:
+                failures.append(f"{stage}: {metric} {measured[metric] / 1e6:.1f} MB exceeds "
+                                f"baseline {expected[metric] / 1e6:.1f} MB by more than {tolerance:.0%}")
+    return failures
+
+
+def character_accuracy(expected: str, actual: str) -> float:
+    """Similarity of whitespace-normalised texts (difflib ratio, 1.0 = identical)"""
+    expected = " ".join(expected.split())
+    actual = " ".join(actual.split())
+    return difflib.SequenceMatcher(None, expected, actual, autojunk=False).ratio()
+
+
+def benchmark_ocr(pages: int, profiles: list, language: str) -> list:
+    """OCR a synthetic scanned corpus with each profile and measure pages/s and accuracy"""
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        corpus = str(Path(temp_dir) / "scanned.pdf")
+        truth = make_scanned_corpus(corpus, pages)
+
+        for profile in profiles:
+            extractor = PDFExtractor(use_ocr=True, ocr_language=language, ocr_profile=profile)
+            if not extractor.use_ocr:
+                raise RuntimeError("Tesseract is not available; see TESSERACT_SETUP.md")
+
+            doc = fitz.open(corpus)
+            accuracies = []
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for page_index in range(len(doc)):
+                    text = extractor.extract_text_from_page_ocr(doc[page_index])
+                    accuracies.append(character_accuracy(truth[page_index], text))
+            elapsed = time.perf_counter() - start
+            doc.close()
+
+            results.append({
+                "profile": profile,
+                "pages": pages,
+                "seconds": round(elapsed, 2),
+                "pages_per_second": round(pages / elapsed, 3),
+                "char_accuracy": round(sum(accuracies) / len(accuracies), 4)
+            })
+    return results
+
+
+def calibrate_stage_rates(pages: int, profiles: list, language: str) -> dict:
+    """Time each extraction stage on generated documents and return the rates used by
+    PDFExtractor.estimate_pdf. OCR rates are kept at their defaults without Tesseract."""
+    rates = load_stage_rates()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pdf_path = make_large_document(str(Path(temp_dir) / "large.pdf"), pages=pages, image_every=2)
+        with contextlib.redirect_stdout(io.StringIO()):
+            extractor = PDFExtractor()
+        image_time = [0.0]
+        save_image_pixmap = extractor.save_image_pixmap
+
+        def timed_save(pix, *args):
+            start = time.perf_counter()
+            try:
+                return save_image_pixmap(pix, *args)
+            finally:
+                image_time[0] += time.perf_counter() - start
+        extractor.save_image_pixmap = timed_save
+
+        images_dir = Path(temp_dir) / "images"
+        images_dir.mkdir()
+        doc = fitz.open(pdf_path)
+        image_megapixels = sum(img[2] * img[3] for page in doc for img in page.get_images(full=True)) / 1e6
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for page_index in range(len(doc)):
+                extractor.extract_page(doc[page_index], page_index + 1, str(images_dir))
+        elapsed = time.perf_counter() - start
+        doc.close()
+        rates["page_seconds"] = round((elapsed - image_time[0]) / pages, 5)
+        rates["image_megapixel_seconds"] = round(image_time[0] / image_megapixels, 5)
+
+        corpus = str(Path(temp_dir) / "scanned.pdf")
+        make_scanned_corpus(corpus, max(2, pages // 10))
+        for profile in profiles:
+            extractor = PDFExtractor(use_ocr=True, ocr_language=language, ocr_profile=profile)
+            if not extractor.use_ocr:
+                print("Tesseract is not available; OCR rates keep their defaults", file=sys.stderr)
+                break
+            doc = fitz.open(corpus)
+            # Pages are rendered at 2x zoom for full-page OCR
+            megapixels = sum(page.rect.width * page.rect.height * 4 for page in doc) / 1e6
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for page in doc:
+                    extractor.extract_text_from_page_ocr(page)
+            rates["ocr_megapixel_seconds"][profile] = round((time.perf_counter() - start) / megapixels, 5)
+            doc.close()
+    return rates
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the PDF Extractor")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ocr_parser = subparsers.add_parser("ocr", help="Compare OCR profiles on a synthetic scanned corpus")
+    ocr_parser.add_argument("--pages", type=int, default=10, help="Pages in the synthetic corpus (default: 10)")
+    ocr_parser.add_argument("--profiles", nargs='+', choices=list(OCR_PROFILES), default=list(OCR_PROFILES))
+    ocr_parser.add_argument("--ocr-lang", default="eng", help="OCR language code (default: eng)")
+    ocr_parser.add_argument("--json", help="Also write the results to this JSON file")
+
+    memory_parser = subparsers.add_parser("memory", help="Peak memory per stage on a generated large document")
+    memory_parser.add_argument("--pages", type=int, help="Pages in the generated document (default: baseline's)")
+    memory_parser.add_argument("--image-size", type=int, help="Side of the CMYK images in pixels (default: baseline's)")
+    memory_parser.add_argument("--ocr", action="store_true", help="Enable OCR while profiling")
+    memory_parser.add_argument("--update-baseline", action="store_true",
+                               help=f"Store the measurements as the new baseline ({BASELINE_PATH.name})")
+    memory_parser.add_argument("--json", help="Also write the results to this JSON file")
+
+    calibrate_parser = subparsers.add_parser("calibrate", help="Measure the stage rates used by --estimate")
+    calibrate_parser.add_argument("--pages", type=int, default=40, help="Pages in the generated document (default: 40)")
+    calibrate_parser.add_argument("--profiles", nargs='+', choices=list(OCR_PROFILES), default=list(OCR_PROFILES))
+    calibrate_parser.add_argument("--ocr-lang", default="eng", help="OCR language code (default: eng)")
+    calibrate_parser.add_argument("--json", help=f"Write the rates here instead of {STAGE_RATES_PATH.name}")
+
+    args = parser.parse_args()
+
+    if args.command == "ocr":
+        results = benchmark_ocr(args.pages, args.profiles, args.ocr_lang)
+        # Speed and accuracy relative to the default profile, when it was benchmarked
+        default = next((row for row in results if row["profile"] == "accurate"), None)
+        print(f"{'Profile':<10} {'Pages/s':>8} {'Accuracy':>9} {'Seconds':>8} {'Speedup':>8} {'Acc. diff':>10}")
+        for row in results:
+            speedup = accuracy_diff = ""
+            if default:
+                speedup = f"{row['pages_per_second'] / default['pages_per_second']:.2f}x"
+                accuracy_diff = f"{(row['char_accuracy'] - default['char_accuracy']) * 100:+.2f} pt"
+            print(f"{row['profile']:<10} {row['pages_per_second']:>8.2f} "
+                  f"{row['char_accuracy']:>9.2%} {row['seconds']:>8.1f} {speedup:>8} {accuracy_diff:>10}")
+
+    elif args.command == "memory":
+        with open(BASELINE_PATH, encoding='utf-8') as f:
+            baseline = json.load(f)
+        document = dict(baseline["document"])
+        if args.pages:
+            document["pages"] = args.pages
+        if args.image_size:
+            document["image_size"] = args.image_size
+
+        results = profile_memory(document, use_ocr=args.ocr)
+        print(f"{'Stage':<18} {'Calls':>6} {'Seconds':>8} {'Python peak':>12} {'RSS peak':>10}")
+        for stage, row in results.items():
+            print(f"{stage:<18} {row['calls']:>6} {row['seconds']:>8.2f} "
+                  f"{row['python_peak'] / 1e6:>9.1f} MB {row['rss_peak'] / 1e6:>7.1f} MB")
+
+        if args.update_baseline:
+            if document != baseline["document"]:
+                raise ValueError("Baselines must use the stored document settings (drop --pages/--image-size)")
+            baseline["stages"] = {stage: {"python_peak": row["python_peak"], "rss_peak": row["rss_peak"]}
+                                  for stage, row in results.items()}
+            with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+                json.dump(baseline, f, indent=2)
+                f.write("\n")
+            print(f"Baseline updated: {BASELINE_PATH}")
+        elif document == baseline["document"]:
+            failures = check_memory_baseline(results, baseline)
+            for failure in failures:
+                print(f"✗ {failure}")
+            if failures:
+                sys.exit(1)
+            print("✓ Within memory baseline")
+
+    elif args.command == "calibrate":
+        results = calibrate_stage_rates(args.pages, args.profiles, args.ocr_lang)
+        print(f"Text extraction: {results['page_seconds'] * 1000:.2f} ms/page")
+        print(f"Image conversion: {results['image_megapixel_seconds'] * 1000:.1f} ms/megapixel")
+        for profile, rate in results["ocr_megapixel_seconds"].items():
+            print(f"OCR ({profile}): {rate * 1000:.0f} ms/megapixel")
+        if not args.json:
+            with open(STAGE_RATES_PATH, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+                f.write("\n")
+            print(f"Rates written: {STAGE_RATES_PATH}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
@@ -7,8 +7,29 @@ inserting image filenames at correct positions in text, and splits output into ~
 
 import os
 import sys
-import fitz  # PyMuPDF
+import asyncio
+import codecs
+import contextlib
+import copy
+try:
+    import pymupdf as fitz  # PyMuPDF; the legacy "fitz" alias prints a warning to stdout
+except ImportError:
+    import fitz  # PyMuPDF < 1.24.3
 import argparse
+import gzip
+import hashlib
+import json
+import math
+import mmap
+import multiprocessing
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import List, Tuple, Dict
 import re
@@ -17,23 +38,585 @@ import pytesseract
 from PIL import Image
 import io
 
+try:
+    import numpy as np
+except ImportError:  # Optional: blank-image detection and OCR preprocessing are skipped without it
+    np = None
+
+
+def write_page_records(path: str, records) -> int:
+    """Write page records as gzip-compressed JSON lines, returning the number written"""
+    return sum(1 for _ in tee_page_records(path, records))
+
+
+def tee_page_records(path: str, records):
+    """Yield page records unchanged while writing them to path in write_page_records' format"""
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            yield record
+
+
+def read_page_records(path: str) -> List[Dict[str, any]]:
+    """Read page records written by write_page_records"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# Components per pixel of the colorspaces named in image metadata (others count as RGB)
+COLORSPACE_COMPONENTS = {"DeviceGray": 1, "CalGray": 1, "Indexed": 1, "Separation": 1,
+                         "DeviceRGB": 3, "CalRGB": 3, "Lab": 3, "DeviceCMYK": 4}
+
+# Per-document page records kept next to the text files so they can be re-chunked
+PAGES_SUFFIX = "_pages.jsonl.gz"
+
+# Lists the text files written to an output directory, per base filename, so a later run
+# removes exactly those and never a same-named file it did not write
+TEXT_FILES_MANIFEST = ".pdf_extractor_files.json"
+
+
+def image_blank_stats(pix, max_samples: int = 1 << 20) -> Dict[str, float]:
+    """Cheap blankness statistics for a grayscale or RGB pixmap, computed on a NumPy view of its samples.
+    
+    Returns the luminance variance, the share and (estimated full-size) number of "ink"
+    pixels (far from the dominant background level) and the share of the most common
+    16-level histogram bin. Large images are subsampled on a regular grid to at most
+    ~max_samples pixels."""
+    channels = pix.n - pix.alpha
+    samples = np.frombuffer(pix.samples_mv, dtype=np.uint8)
+    pixels = samples.reshape(pix.height, pix.stride)[:, :pix.width * pix.n].reshape(pix.height, pix.width, pix.n)
+    
+    step = max(1, int((pix.width * pix.height / max_samples) ** 0.5))
+    pixels = pixels[::step, ::step, :channels]
+    if channels == 1:
+        luminance = pixels[:, :, 0]
+    else:
+        # Integer approximation of 0.299 R + 0.587 G + 0.114 B
+        weighted = pixels[:, :, :3].astype(np.uint32) * np.array([77, 150, 29], dtype=np.uint32)
+        luminance = (weighted.sum(axis=2) >> 8).astype(np.uint8)
+    
+    histogram = np.bincount((luminance >> 4).ravel(), minlength=16)
+    total = max(luminance.size, 1)
+    background_bin = int(histogram.argmax())
+    background = background_bin * 16 + 8
+    ink = np.abs(luminance.astype(np.int16) - background) > 48
+    
+    return {
+        "variance": float(luminance.var()) if luminance.size else 0.0,
+        "ink_ratio": float(ink.sum()) / total,
+        "ink_pixels": int(ink.sum()) * step * step,
+        "dominant_share": float(histogram[background_bin]) / total
+    }
+
+
+# Below this many non-space characters a text layer is judged by image coverage, not quality
+MIN_TEXT_LAYER_CHARS = 20
+
+# Scripts written without spaces between words (CJK ideographs, kana, hangul)
+SPACELESS_SCRIPT_RANGES = ((0x2E80, 0x9FFF), (0xAC00, 0xD7AF), (0xF900, 0xFAFF))
+
+# UTF-8 decoded as Latin-1/cp1252: a lead byte shown as Ã or Â followed by a continuation byte
+MOJIBAKE_PATTERN = re.compile('[\u00c2\u00c3][\u0080-\u00bf]')
+
+
+def text_layer_stats(text: str) -> Dict[str, float]:
+    """Dictionary-free quality statistics of a page's extracted text.
+    
+    Broken font CMaps and wrong encodings show up as replacement, private-use or
+    mojibake characters, as runs of symbols and punctuation, or as text without spaces
+    (very long "words"); letter-spaced extraction gives one-character words. Each signal
+    becomes a 0..1 factor and "score" is their product: 1 for clean prose, 0 for an empty
+    or unusable text layer."""
+    chars = [c for c in text if not c.isspace()]
+    total = len(chars)
+    if not total:
+        return {"chars": 0, "alnum_ratio": 0.0, "junk_ratio": 0.0, "mean_word_length": 0.0,
+                "long_word_ratio": 0.0, "score": 0.0}
+    
+    alnum = sum(c.isalnum() for c in chars)
+    junk = sum(c == '\ufffd' or unicodedata.category(c) in ("Co", "Cn", "Cc", "Cs") for c in chars)
+    junk += 2 * len(MOJIBAKE_PATTERN.findall(text))
+    spaceless = sum(any(low <= ord(c) <= high for low, high in SPACELESS_SCRIPT_RANGES) for c in chars)
+    words = [w for w in text.split() if any(c.isalnum() for c in w)]
+    mean_length = sum(len(w) for w in words) / len(words) if words else 0.0
+    long_ratio = sum(len(w) > 25 for w in words) / len(words) if words else 0.0
+    
+    junk_factor = max(0.0, 1 - 10 * junk / total)
+    class_factor = min(1.0, max(0.0, (alnum / total - 0.4) / 0.3))
+    word_factor = 1.0
+    # Word lengths say little about a handful of words or about spaceless scripts
+    if len(words) >= 8 and spaceless < 0.3 * total:
+        if mean_length > 10:
+            word_factor = max(0.0, 1 - (mean_length - 10) / 6)
+        elif mean_length < 2.5:
+            word_factor = max(0.0, (mean_length - 1) / 1.5)
+        word_factor *= max(0.0, 1 - 4 * long_ratio)
+    
+    return {
+        "chars": total,
+        "alnum_ratio": alnum / total,
+        "junk_ratio": junk / total,
+        "mean_word_length": mean_length,
+        "long_word_ratio": long_ratio,
+        "score": junk_factor * class_factor * word_factor
+    }
+
+
+# Named OCR speed/accuracy trade-offs. psm/oem are Tesseract's page segmentation and
+# engine modes; osd_once detects orientation once per document instead of per image
+# (psm 1 does it on every call); the rest is the NumPy preprocessing chain, which only
+# runs on images converted to grayscale. "accurate" hands Tesseract the original image,
+# exactly as before profiles existed.
+OCR_PROFILES = {
+    "fast": {"psm": 6, "oem": 1, "osd_once": True, "grayscale": True, "binarize": True, "max_side": 2000},
+    "balanced": {"psm": 3, "oem": 1, "osd_once": True, "grayscale": True, "binarize": True, "max_side": None},
+    "accurate": {"psm": 1, "oem": 3, "osd_once": False, "grayscale": False, "binarize": False, "max_side": None},
+}
+
+# Seconds per unit of work for each extraction stage, used by estimate_pdf. Rendered
+# pages and images are costed per megapixel. `benchmark.py calibrate` measures them on
+# this machine and writes STAGE_RATES_PATH, which then overrides these defaults.
+DEFAULT_STAGE_RATES = {
+    "page_seconds": 0.01,
+    "image_megapixel_seconds": 0.15,
+    "ocr_megapixel_seconds": {"fast": 0.25, "balanced": 0.5, "accurate": 1.0},
+}
+STAGE_RATES_PATH = Path(__file__).parent / "stage_rates.json"
+
+# Tokens assumed for a page whose text will come from full-page OCR
+OCR_PAGE_TOKENS = 450
+
+
+def load_stage_rates(path: str = None) -> dict:
+    """Stage rates from a calibration file (default STAGE_RATES_PATH if it exists),
+    falling back to DEFAULT_STAGE_RATES for anything it does not cover"""
+    rates = json.loads(json.dumps(DEFAULT_STAGE_RATES))
+    path = Path(path) if path else STAGE_RATES_PATH
+    if path.exists():
+        with open(path, encoding='utf-8') as f:
+            calibrated = json.load(f)
+        for key, value in calibrated.items():
+            if isinstance(value, dict):
+                rates.setdefault(key, {}).update(value)
+            else:
+                rates[key] = value
+    return rates
+
+
+def otsu_threshold(gray) -> int:
+    """Otsu's threshold for a uint8 grayscale array (maximises between-class variance)"""
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256, dtype=np.float64)
+    weight_bg = np.cumsum(histogram)
+    weight_fg = weight_bg[-1] - weight_bg
+    cumulative_mean = np.cumsum(histogram * levels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_bg = cumulative_mean / weight_bg
+        mean_fg = (cumulative_mean[-1] - cumulative_mean) / weight_fg
+        between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.argmax(np.nan_to_num(between, nan=-1.0)))
+
+
+def preprocess_for_ocr(rgb, max_side: int = None):
+    """Convert an (h, w, 3) uint8 array to grayscale, block-averaging it down so the
+    longest side is at most max_side"""
+    weighted = rgb[:, :, :3].astype(np.uint32) * np.array([77, 150, 29], dtype=np.uint32)
+    gray = (weighted.sum(axis=2) >> 8).astype(np.uint8)
+    
+    if max_side and max(gray.shape) > max_side:
+        factor = -(-max(gray.shape) // max_side)  # ceiling division
+        height = gray.shape[0] // factor * factor
+        width = gray.shape[1] // factor * factor
+        blocks = gray[:height, :width].reshape(height // factor, factor, width // factor, factor)
+        gray = blocks.mean(axis=(1, 3)).astype(np.uint8)
+    return gray
+
+
+def open_pdf(pdf_path: str, source=None, prefetcher=None):
+    """Open pdf_path, or source instead when given: bytes or a local copy of the file
+    (e.g. from PDFPrefetcher). When a prefetcher is given and pdf_path is read directly
+    because it was not prefetched, the time spent opening it counts as I/O stall."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=source, filetype="pdf")
+    if source or prefetcher is None:
+        return fitz.open(str(source or pdf_path))
+    started = time.perf_counter()
+    try:
+        return fitz.open(str(pdf_path))
+    finally:
+        prefetcher.stall_seconds += time.perf_counter() - started
+
+
+def iter_pdf_files(root: str):
+    """Walk a directory tree with os.scandir and yield the paths of PDF files, in sorted order.
+    Output directories (*_extracted, *_shards) and hidden entries are skipped."""
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            print(f"Warning: Could not read directory {current}: {e}")
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.endswith(("_extracted", "_shards")):
+                    subdirs.append(entry.path)
+            elif entry.name.lower().endswith('.pdf') and entry.is_file():
+                yield entry.path
+        # Reversed so directories are visited in name order
+        stack.extend(reversed(subdirs))
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """Hash a file in blocks without loading it into memory"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class OCRCache:
+    """OCR results stored in an SQLite file that any number of processes and runs can
+    share. Once the stored texts exceed max_bytes, the least recently used entries are
+    evicted. Database errors are reported and treated as misses, never as OCR failures."""
+    
+    def __init__(self, path: str, max_bytes: int = 512 * 2**20):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._lock = threading.Lock()
+        # Running estimate of the stored size: this process's inserts on top of the total
+        # read at connect time. Only when it crosses max_bytes is the real total (including
+        # other processes' inserts) summed and the table evicted.
+        self._total = 0
+    
+    def _connect(self):
+        if self._conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            # Autocommit plus WAL lets concurrent processes read while one writes
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS ocr (key TEXT PRIMARY KEY, text TEXT NOT NULL, "
+                         "size INTEGER NOT NULL, last_used REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ocr_last_used ON ocr (last_used)")
+            self._total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr").fetchone()[0]
+            self._conn = conn
+        return self._conn
+    
+    def get(self, key: str):
+        """Cached text for key (refreshing its LRU position), or None"""
+        with self._lock:
+            try:
+                conn = self._connect()
+                row = conn.execute("SELECT text FROM ocr WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE ocr SET last_used = ? WHERE key = ?", (time.time(), key))
+                    return row[0]
+            except sqlite3.Error as e:
+                print(f"Warning: OCR cache read failed: {e}")
+        return None
+    
+    def put(self, key: str, text: str):
+        """Store text for key, then evict least recently used entries over max_bytes"""
+        size = len(text.encode('utf-8'))
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute("INSERT OR REPLACE INTO ocr (key, text, size, last_used) VALUES (?, ?, ?, ?)",
+                             (key, text, size, time.time()))
+                self._total += size
+                if self._total > self.max_bytes:
+                    self._total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr").fetchone()[0]
+                if self._total > self.max_bytes:
+                    # Evict down to 90% so the next few inserts do not each trigger a pass
+                    excess = self._total - int(self.max_bytes * 0.9)
+                    evict = []
+                    for old_key, old_size in conn.execute("SELECT key, size FROM ocr ORDER BY last_used"):
+                        if excess <= 0:
+                            break
+                        evict.append((old_key,))
+                        excess -= old_size
+                        self._total -= old_size
+                    conn.executemany("DELETE FROM ocr WHERE key = ?", evict)
+            except sqlite3.Error as e:
+                print(f"Warning: OCR cache write failed: {e}")
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM ocr").fetchone()[0]
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class PDFPrefetcher:
+    """Read the next PDFs of a batch in background threads while the current one is
+    processed, into memory or into copies under scratch_dir.
+    
+    At most depth files are read ahead, and the files held at any time total at most
+    max_bytes; a file larger than the budget is never prefetched. Iterating yields
+    (path, source) where source is the prefetched bytes or local copy, or None to read
+    path directly. stall_seconds is the time spent waiting for reads that had not finished,
+    plus the time open_pdf spends opening files that were read directly."""
+    
+    def __init__(self, paths, depth: int = 2, max_bytes: int = 512 * 2**20, scratch_dir: str = None):
+        self.paths = [Path(p) for p in paths]
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.scratch_dir = Path(scratch_dir) if scratch_dir else None
+        self.stall_seconds = 0.0
+        self.prefetched = 0
+        self.reserved_bytes = 0
+        self._futures = {}  # index -> (future, size)
+        self._next = 0
+        self._executor = None
+    
+    def _read(self, index: int):
+        path = self.paths[index]
+        if self.scratch_dir is None:
+            return path.read_bytes()
+        # A directory per index keeps the file name (and so the output names) unchanged
+        target = self.scratch_dir / str(index) / path.name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(path, target)
+        return target
+    
+    def _discard(self, source):
+        if isinstance(source, Path):
+            source.unlink(missing_ok=True)
+            try:
+                source.parent.rmdir()
+            except OSError:
+                pass
+    
+    def _top_up(self, current: int):
+        """Start reads for the files after current, within the depth and byte budget"""
+        while self._next < len(self.paths) and self._next <= current + self.depth:
+            index = self._next
+            try:
+                size = self.paths[index].stat().st_size
+            except OSError:
+                size = None
+            if size is not None and size <= self.max_bytes:
+                if self.reserved_bytes + size > self.max_bytes:
+                    break  # resume once the current file has been released
+                self._futures[index] = (self._executor.submit(self._read, index), size)
+                self.reserved_bytes += size
+            self._next += 1
+    
+    def __iter__(self):
+        if self.depth < 1:
+            yield from ((path, None) for path in self.paths)
+            return
+        
+        self._executor = ThreadPoolExecutor(max_workers=self.depth, thread_name_prefix="pdf-prefetch")
+        try:
+            for index, path in enumerate(self.paths):
+                self._top_up(index)
+                source = None
+                entry = self._futures.pop(index, None)
+                if entry:
+                    started = time.perf_counter()
+                    try:
+                        source = entry[0].result()
+                        self.prefetched += 1
+                    except OSError as e:
+                        print(f"Warning: Could not prefetch {path}: {e}")
+                    self.stall_seconds += time.perf_counter() - started
+                try:
+                    yield path, source
+                finally:
+                    if entry:
+                        self.reserved_bytes -= entry[1]
+                    self._discard(source)
+                    source = None
+        finally:
+            for future, _ in self._futures.values():
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            for future, _ in self._futures.values():
+                if not future.cancelled() and future.exception() is None:
+                    self._discard(future.result())
+            self._futures.clear()
+
+
+class ExtractionCancelled(Exception):
+    """Raised between pages when the extractor's cancel token is set"""
+
+
+@dataclass
+class ExtractionResult:
+    """Output of an in-memory extraction (extract_bytes); nothing is written to disk"""
+    chunks: List[str]                   # token-split text, same content as the _part_N.txt files
+    images: Dict[str, bytes]            # filename -> PNG bytes (or _ERROR.txt message bytes)
+    pages: List[Dict[str, any]]         # per-page records
+    total_tokens: int
+    stats: Dict[str, any] = field(default_factory=dict)
+    
+    @property
+    def image_count(self) -> int:
+        return sum(1 for name in self.images if name.endswith(".png"))
+
+
 class PDFExtractor:
-    def __init__(self, max_tokens: int = 45000, use_ocr: bool = False, ocr_language: str = 'eng'):
+    def __init__(self, max_tokens: int = 45000, use_ocr: bool = False, ocr_language: str = 'eng',
+                 progress_callback=None, cancel_event=None, layout: bool = False,
+                 skip_blank_ocr: bool = True, skip_blank_images: bool = False,
+                 blank_variance_threshold: float = 4.0, blank_ink_ratio: float = 0.002,
+                 blank_min_ink_pixels: int = 25, ocr_profile: str = "accurate", page_timeout: float = None,
+                 boilerplate: str = None, ocr_cache: str = None, ocr_cache_size: int = 512 * 2**20,
+                 text_quality_threshold: float = 0.5, max_image_pixels: int = 100_000_000,
+                 max_render_pixels: int = 50_000_000, max_pages: int = None, max_image_bytes: int = None,
+                 async_concurrency: int = None, async_pages_per_task: int = 8):
         self.max_tokens = max_tokens
         self.use_ocr = use_ocr
         self.ocr_language = ocr_language
+        # Layout mode places [IMAGE: ...] markers in reading order instead of at the top of the page
+        self.layout = layout
+        # Blank/near-uniform images (variance below the threshold, or too little ink both as
+        # a share and in pixels, so a small signature on a large page still counts) skip OCR
+        # and, with skip_blank_images, are not saved at all. Requires NumPy.
+        self.skip_blank_ocr = skip_blank_ocr
+        self.skip_blank_images = skip_blank_images
+        self.blank_variance_threshold = blank_variance_threshold
+        self.blank_ink_ratio = blank_ink_ratio
+        self.blank_min_ink_pixels = blank_min_ink_pixels
+        # Full-page OCR runs only when the text layer's quality score (text_layer_stats)
+        # is below this, or when a nearly textless page is mostly covered by images
+        self.text_quality_threshold = text_quality_threshold
+        # Resource guards, checked from image and page metadata before anything is decoded:
+        # images over max_image_pixels, or past max_image_bytes of decoded images in a
+        # document, are skipped; OCR renders over max_render_pixels are downscaled; pages
+        # after max_pages are skipped (whole-document extraction only, not shards).
+        # None disables a limit.
+        self.max_image_pixels = max_image_pixels
+        self.max_render_pixels = max_render_pixels
+        self.max_pages = max_pages
+        self.max_image_bytes = max_image_bytes
+        self._image_bytes = 0
+        self.run_stats = self._new_run_stats()
+        # Images of in-memory extractions (images_dir=None), by filename; None discards them
+        self.memory_images = {}
+        # progress_callback(event: dict) is called from the extracting thread;
+        # cancel_event is any object with is_set() (e.g. threading.Event)
+        self.progress_callback = progress_callback
+        self.cancel_event = cancel_event
+        if ocr_profile not in OCR_PROFILES:
+            raise ValueError(f"Unknown OCR profile '{ocr_profile}' (choose from {', '.join(OCR_PROFILES)})")
+        self.ocr_profile = ocr_profile
+        self._osd_rotation = None
+        self._osd_attempts = 0
+        # With a page timeout, pages are extracted in a supervised worker process so a
+        # hanging or crashing page becomes an error marker instead of stalling the run
+        self.page_timeout = page_timeout
+        # Lines repeated near the top/bottom of most pages (headers, footers, notices):
+        # None keeps them, "remove" drops them, "note" drops them and lists them once
+        if boilerplate not in (None, "remove", "note"):
+            raise ValueError(f"Unknown boilerplate mode '{boilerplate}' (choose from remove, note)")
+        self.boilerplate = boilerplate
+        # The async API (aprocess_pdf, aextract_bytes, ...) extracts pages in a pool of worker
+        # processes, in runs of async_pages_per_task pages; at most async_concurrency runs (of
+        # one or several documents) are in flight unless a semaphore is passed in. Idle
+        # workers are kept for the next run until close_workers().
+        self.async_concurrency = async_concurrency or os.cpu_count() or 1
+        self.async_pages_per_task = async_pages_per_task
+        self._idle_workers = []
+        self._pool_lock = threading.Lock()
+        self._semaphore = None
+        self._semaphore_loop = None
+        # Optional SQLite file of OCR results keyed by image content; see OCRCache
+        self.ocr_cache = OCRCache(ocr_cache, ocr_cache_size) if ocr_cache else None
+        self._tesseract_version = None
         self.encoding = tiktoken.get_encoding("cl100k_base")  # GPT-4 encoding
         
         # Test tesseract availability if OCR is enabled
         if self.use_ocr:
             try:
-                pytesseract.get_tesseract_version()
-                print(f"✓ Tesseract OCR enabled (language: {ocr_language})")
+                self._tesseract_version = str(pytesseract.get_tesseract_version())
+                print(f"✓ Tesseract OCR enabled (language: {ocr_language}, profile: {ocr_profile})")
             except Exception as e:
                 print(f"⚠ Warning: Tesseract OCR not available: {e}")
                 print("  OCR features will be disabled. Install Tesseract to enable OCR.")
                 self.use_ocr = False
         
+    def _new_run_stats(self) -> Dict[str, any]:
+        """Per-document counters that process_pdf adds to its result"""
+        return {"blank_images": [], "page_errors": [],
+                "boilerplate": {"unique_lines": 0, "lines_removed": 0, "tokens_saved": 0},
+                "ocr_cache": {"hits": 0, "misses": 0},
+                "page_ocr": {"runs": 0, "avoided": 0, "added": 0},
+                "resource_limits": []}
+    
+    def merge_run_stats(self, stats: Dict[str, any]):
+        """Add counters collected elsewhere (e.g. in a worker process) to run_stats"""
+        for key, value in stats.items():
+            current = self.run_stats.get(key)
+            if isinstance(value, list):
+                self.run_stats.setdefault(key, []).extend(value)
+            elif isinstance(value, dict):
+                merged = self.run_stats.setdefault(key, {})
+                for name, count in value.items():
+                    merged[name] = merged.get(name, 0) + count
+            elif isinstance(value, (int, float)):
+                self.run_stats[key] = (current or 0) + value
+    
+    def worker_config(self) -> Dict[str, any]:
+        """Constructor arguments that recreate this extractor's settings in a worker process"""
+        return {
+            "max_tokens": self.max_tokens,
+            "use_ocr": self.use_ocr,
+            "ocr_language": self.ocr_language,
+            "layout": self.layout,
+            "skip_blank_ocr": self.skip_blank_ocr,
+            "skip_blank_images": self.skip_blank_images,
+            "blank_variance_threshold": self.blank_variance_threshold,
+            "blank_ink_ratio": self.blank_ink_ratio,
+            "blank_min_ink_pixels": self.blank_min_ink_pixels,
+            "ocr_profile": self.ocr_profile,
+            "boilerplate": self.boilerplate,
+            "ocr_cache": self.ocr_cache.path if self.ocr_cache else None,
+            "ocr_cache_size": self.ocr_cache.max_bytes if self.ocr_cache else 512 * 2**20,
+            "text_quality_threshold": self.text_quality_threshold,
+            "max_image_pixels": self.max_image_pixels,
+            "max_render_pixels": self.max_render_pixels,
+            "max_pages": self.max_pages,
+            "max_image_bytes": self.max_image_bytes
+        }
+    
+    def settings_fingerprint(self) -> str:
+        """Short hash of the settings that shape the extracted output, so outputs made with
+        other settings can be recognised (the OCR cache location does not count)"""
+        config = {key: value for key, value in self.worker_config().items()
+                  if key not in ("ocr_cache", "ocr_cache_size")}
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    
+    def start_document(self):
+        """Reset per-document state before the first page of a document"""
+        # Orientation detected by osd_once profiles applies to one document only
+        self._osd_rotation = None
+        self._osd_attempts = 0
+        self._image_bytes = 0
+    
+    def _emit(self, event: str, **info):
+        """Send a progress event to the callback, if one is registered"""
+        if self.progress_callback:
+            info["event"] = event
+            self.progress_callback(info)
+    
+    def _check_cancelled(self):
+        """Stop work if cancellation was requested"""
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise ExtractionCancelled("Extraction cancelled")
+    
     def count_tokens(self, text: str) -> int:
         """Count tokens in text using tiktoken"""
         return len(self.encoding.encode(text))
@@ -68,6 +651,134 @@ class PDFExtractor:
         
         return text.strip()
     
+    def _write_marker_file(self, output_dir: str, page_num: int, img_index: int, kind: str, message: str) -> str:
+        """Write a page_N_image_K_<kind>.txt placeholder for an image that was not saved"""
+        marker_filename = f"page_{page_num}_image_{img_index + 1}_{kind}.txt"
+        if output_dir is None:
+            if self.memory_images is not None:
+                self.memory_images[marker_filename] = message.encode('utf-8')
+            return marker_filename
+        with open(os.path.join(output_dir, marker_filename), 'w') as f:
+            f.write(message)
+        return marker_filename
+    
+    def _record_limit(self, page_num: int, item: str, action: str, reason: str):
+        print(f"Warning: {action.capitalize()} {item}: {reason}")
+        self.run_stats["resource_limits"].append({"page": page_num, "item": item, "action": action,
+                                                  "reason": reason})
+    
+    def image_limit_marker(self, page_num: int, img_index: int, width: int, height: int,
+                           components: int, output_dir: str) -> str:
+        """Check an image against the resource limits from its metadata, before decoding.
+        Returns the filename of a _SKIPPED marker if it is skipped, otherwise None (and its
+        decoded size is counted against the document's max_image_bytes)."""
+        decoded_bytes = width * height * components
+        if self.max_image_pixels and width * height > self.max_image_pixels:
+            reason = f"{width}x{height} image exceeds {self.max_image_pixels:,} pixels"
+        elif self.max_image_bytes and self._image_bytes + decoded_bytes > self.max_image_bytes:
+            reason = f"decoded images exceed {self.max_image_bytes:,} bytes for this document"
+        else:
+            self._image_bytes += decoded_bytes
+            return None
+        self._record_limit(page_num, f"image {img_index + 1} on page {page_num}", "skipped", reason)
+        return self._write_marker_file(output_dir, page_num, img_index, "SKIPPED", f"SKIPPED: {reason}")
+    
+    def has_oversized_images(self, page) -> bool:
+        """Whether any image on the page is over max_image_pixels (from metadata only)"""
+        return bool(self.max_image_pixels) and any(
+            img[2] * img[3] > self.max_image_pixels for img in page.get_images(full=True))
+    
+    def check_blank_image(self, pix, page_num: int, filename: str) -> bool:
+        """Return True if the image is blank or near-uniform, recording the decision in run_stats"""
+        needed = (self.use_ocr and self.skip_blank_ocr) or self.skip_blank_images
+        if np is None or not needed:
+            return False
+        try:
+            stats = image_blank_stats(pix)
+        except Exception as e:
+            print(f"Warning: Could not analyse image {filename}: {e}")
+            return False
+        
+        enough_ink = stats["ink_ratio"] >= self.blank_ink_ratio or stats["ink_pixels"] >= self.blank_min_ink_pixels
+        if stats["variance"] >= self.blank_variance_threshold and enough_ink:
+            return False
+        
+        self.run_stats["blank_images"].append({
+            "page": page_num,
+            "image": filename,
+            "variance": round(stats["variance"], 3),
+            "ink_ratio": round(stats["ink_ratio"], 5),
+            "ink_pixels": stats["ink_pixels"],
+            "dominant_share": round(stats["dominant_share"], 4),
+            "ocr_skipped": self.use_ocr,
+            "saved": not self.skip_blank_images
+        })
+        return True
+    
+    def save_image_pixmap(self, pix, page_num: int, img_index: int, output_dir: str) -> Tuple[str, str]:
+        """Convert a decoded image to a PNG-compatible colorspace, OCR it and save it.
+        Returns (filename, ocr_text); failures produce an _ERROR.txt file instead.
+        Returns None when the image is blank and skip_blank_images is set."""
+        # Handle different colorspaces
+        filename = f"page_{page_num}_image_{img_index + 1}.png"
+        
+        # Check if we need to convert colorspace
+        final_pix = None
+        
+        # Handle different colorspaces
+        channels = pix.n - pix.alpha
+        
+        # Check if pixmap is compatible with PNG (must be true grayscale or RGB)
+        # We need to check the actual colorspace, not just channel count
+        colorspace_str = str(pix.colorspace) if pix.colorspace else "None"
+        
+        if pix.colorspace and pix.colorspace == fitz.csGRAY and channels == 1:
+            # True grayscale image - save directly
+            final_pix = pix
+        elif pix.colorspace and pix.colorspace == fitz.csRGB and channels == 3:
+            # RGB image - save directly
+            final_pix = pix
+        else:
+            # Any other colorspace (CMYK, DeviceN, etc.) needs conversion
+            try:
+                # Convert to RGB
+                final_pix = fitz.Pixmap(fitz.csRGB, pix)
+                print(f"Converted image to RGB: {filename}")
+            except Exception as conv_error:
+                print(f"Warning: Could not convert image {filename}: {conv_error}")
+                error_filename = self._write_marker_file(
+                    output_dir, page_num, img_index, "ERROR",
+                    f"ERROR: Failed to convert image with colorspace {colorspace_str} - {conv_error}")
+                return (error_filename, "")
+        
+        is_blank = self.check_blank_image(final_pix, page_num, filename)
+        if is_blank and self.skip_blank_images:
+            return None
+        
+        # Extract OCR text from image if enabled
+        ocr_text = ""
+        if self.use_ocr and not is_blank:
+            try:
+                img_data = final_pix.tobytes("png")
+                ocr_text = self.extract_text_from_image_ocr(img_data)
+                if ocr_text.strip():
+                    print(f"✓ OCR extracted {len(ocr_text)} characters from {filename}")
+            except Exception as ocr_error:
+                print(f"Warning: OCR failed for {filename}: {ocr_error}")
+        
+        try:
+            if output_dir is None:
+                if self.memory_images is not None:
+                    self.memory_images[filename] = final_pix.tobytes("png")
+            else:
+                final_pix.save(os.path.join(output_dir, filename))
+            return (filename, ocr_text)
+        except Exception as save_error:
+            print(f"Warning: Could not save image {filename}: {save_error}")
+            error_filename = self._write_marker_file(
+                output_dir, page_num, img_index, "ERROR", f"ERROR: Failed to save image - {save_error}")
+            return (error_filename, "")
+    
     def extract_images_from_page(self, page, page_num: int, output_dir: str) -> List[Tuple[str, str]]:
         """Extract images from a PDF page and return list of (filename, ocr_text) tuples"""
         image_results = []
@@ -75,162 +786,390 @@ class PDFExtractor:
         
         for img_index, img in enumerate(image_list):
             xref = img[0]
-            pix = None
+            marker = self.image_limit_marker(page_num, img_index, img[2], img[3],
+                                             COLORSPACE_COMPONENTS.get(img[5], 3), output_dir)
+            if marker:
+                image_results.append((marker, ""))
+                continue
             try:
                 pix = fitz.Pixmap(page.parent, xref)
-                
-                # Handle different colorspaces
-                filename = f"page_{page_num}_image_{img_index + 1}.png"
-                filepath = os.path.join(output_dir, filename)
-                
-                # Check if we need to convert colorspace
-                final_pix = None
-                conversion_needed = False
-                
-                # Handle different colorspaces
-                channels = pix.n - pix.alpha
-                
-                # Check if pixmap is compatible with PNG (must be true grayscale or RGB)
-                # We need to check the actual colorspace, not just channel count
-                colorspace_str = str(pix.colorspace) if pix.colorspace else "None"
-                
-                if pix.colorspace and pix.colorspace == fitz.csGRAY and channels == 1:
-                    # True grayscale image - save directly
-                    final_pix = pix
-                elif pix.colorspace and pix.colorspace == fitz.csRGB and channels == 3:
-                    # RGB image - save directly
-                    final_pix = pix
-                else:
-                    # Any other colorspace (CMYK, DeviceN, etc.) needs conversion
-                    conversion_needed = True
-                    try:
-                        # Convert to RGB
-                        final_pix = fitz.Pixmap(fitz.csRGB, pix)
-                        print(f"Converted image to RGB: {filename}")
-                    except Exception as conv_error:
-                        print(f"Warning: Could not convert image {filename}: {conv_error}")
-                        error_filename = f"page_{page_num}_image_{img_index + 1}_ERROR.txt"
-                        error_filepath = os.path.join(output_dir, error_filename)
-                        with open(error_filepath, 'w') as f:
-                            f.write(f"ERROR: Failed to convert image with colorspace {colorspace_str} - {conv_error}")
-                        image_results.append((error_filename, ""))
-                        continue
-                
-                # Extract OCR text from image if enabled
-                ocr_text = ""
-                if self.use_ocr and final_pix:
-                    try:
-                        img_data = final_pix.tobytes("png")
-                        ocr_text = self.extract_text_from_image_ocr(img_data)
-                        if ocr_text.strip():
-                            print(f"✓ OCR extracted {len(ocr_text)} characters from {filename}")
-                    except Exception as ocr_error:
-                        print(f"Warning: OCR failed for {filename}: {ocr_error}")
-                
-                # Only save if we have a valid pixmap
-                if final_pix:
-                    try:
-                        final_pix.save(filepath)
-                        image_results.append((filename, ocr_text))
-                    except Exception as save_error:
-                        print(f"Warning: Could not save image {filename}: {save_error}")
-                        error_filename = f"page_{page_num}_image_{img_index + 1}_ERROR.txt"
-                        error_filepath = os.path.join(output_dir, error_filename)
-                        with open(error_filepath, 'w') as f:
-                            f.write(f"ERROR: Failed to save image - {save_error}")
-                        image_results.append((error_filename, ""))
-                    finally:
-                        # Clean up converted pixmap if it was created
-                        if conversion_needed and final_pix != pix:
-                            final_pix = None
-                
+                result = self.save_image_pixmap(pix, page_num, img_index, output_dir)
+                if result:
+                    image_results.append(result)
             except Exception as pix_error:
                 print(f"Warning: Could not process image {img_index + 1} on page {page_num}: {pix_error}")
-                error_filename = f"page_{page_num}_image_{img_index + 1}_ERROR.txt"
-                error_filepath = os.path.join(output_dir, error_filename)
-                with open(error_filepath, 'w') as f:
-                    f.write(f"ERROR: Failed to process image - {pix_error}")
+                error_filename = self._write_marker_file(
+                    output_dir, page_num, img_index, "ERROR", f"ERROR: Failed to process image - {pix_error}")
                 image_results.append((error_filename, ""))
-            finally:
-                if pix:
-                    pix = None
         
         return image_results
     
-    def extract_text_with_image_positions(self, pdf_path: str, output_dir: str) -> str:
-        """Extract text from PDF and insert image filenames at appropriate positions, with OCR support"""
-        doc = fitz.open(pdf_path)
-        full_text = ""
+    def image_coverage(self, page) -> float:
+        """Share of the page area covered by placed images (from image metadata, no decoding)"""
+        area = abs(page.rect)
+        if not area:
+            return 0.0
+        covered = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+        return min(1.0, covered / area)
+    
+    def needs_page_ocr(self, page, stats: Dict[str, float]) -> bool:
+        """Whether the text layer (described by text_layer_stats) is unusable, so that
+        full-page OCR is worth running"""
+        if stats["chars"] >= MIN_TEXT_LAYER_CHARS:
+            return stats["score"] < self.text_quality_threshold
+        # Short text is fine on title and figure pages; OCR only what looks like a scan,
+        # or a textless page with vector content (e.g. text converted to outlines)
+        return self.image_coverage(page) >= 0.5 or (not stats["chars"] and bool(page.get_drawings()))
+    
+    def ocr_page_if_needed(self, page, page_num: int, page_text: str, is_scanned: bool) -> Tuple[str, str]:
+        """Run full-page OCR on pages whose text layer is unusable (see needs_page_ocr).
+        Returns (mode, ocr_text) where mode is "replace", "append" or "" (keep the PDF text).
+        run_stats["page_ocr"] counts the OCR runs, and those avoided or added compared with
+        the previous rule (scanned, or under 100 characters of text)."""
+        if not self.use_ocr:
+            return ("", "")
+        
+        stats = text_layer_stats(page_text)
+        needed = self.needs_page_ocr(page, stats)
+        previous_rule = is_scanned or len(page_text.strip()) < 100
+        counters = self.run_stats["page_ocr"]
+        if needed and not previous_rule:
+            counters["added"] += 1
+        elif previous_rule and not needed:
+            counters["avoided"] += 1
+        if not needed:
+            return ("", "")
+        counters["runs"] += 1
+        
+        if stats["chars"] >= MIN_TEXT_LAYER_CHARS:
+            print(f"Page {page_num} text layer looks broken (quality {stats['score']:.2f}), applying OCR...")
+        else:
+            print(f"Page {page_num} appears to be scanned, applying OCR...")
+        ocr_page_text = self.extract_text_from_page_ocr(page)
+        garbled = stats["chars"] >= MIN_TEXT_LAYER_CHARS
+        if ocr_page_text.strip() and (garbled or len(ocr_page_text.strip()) > len(page_text.strip())):
+            print(f"✓ OCR produced better results for page {page_num}")
+            return ("replace", ocr_page_text)
+        elif ocr_page_text.strip():
+            print(f"✓ Combined PDF text with OCR text for page {page_num}")
+            return ("append", ocr_page_text)
+        return ("", "")
+    
+    def format_image_section(self, image_results: List[Tuple[str, str]]) -> str:
+        """Image references (and their OCR text) as placed at the top of a page"""
+        image_section = ""
+        for filename, ocr_text in image_results:
+            image_section += f"[IMAGE: {filename}]"
+            if ocr_text.strip():
+                image_section += f"\n[OCR from {filename}]:\n{ocr_text}\n"
+            image_section += "\n"
+        return f"{image_section}\n"
+    
+    def extract_page(self, page, page_num: int, images_dir: str) -> Dict[str, any]:
+        """Extract one page and return its record: page number, text body and image filenames"""
+        # The layout pass decodes every image on the page, so pages with an oversized image
+        # use the default path, which checks each image before decoding it
+        if self.layout and not self.has_oversized_images(page):
+            return self.extract_page_layout(page, page_num, images_dir)
+        
+        # Extract images first (now returns tuples with OCR text)
+        image_results = self.extract_images_from_page(page, page_num, images_dir)
+        
+        # Extract text using normal PDF extraction
+        raw_text = page.get_text()
+        page_text = self.clean_extracted_text(raw_text)
+        
+        # Check if this is a scanned page (little extractable text)
+        is_scanned = self.is_page_mostly_images(page, text=raw_text)
+        
+        mode, ocr_page_text = self.ocr_page_if_needed(page, page_num, page_text, is_scanned)
+        if mode == "replace":
+            page_text = ocr_page_text
+        elif mode == "append":
+            page_text = f"{page_text}\n\n[OCR Text]:\n{ocr_page_text}"
+        
+        # Insert image references and OCR text
+        body = ""
+        if image_results:
+            body += self.format_image_section(image_results)
+        
+        body += page_text
+        return {
+            "page": page_num,
+            "text": body,
+            "images": [filename for filename, _ in image_results]
+        }
+    
+    def extract_page_layout(self, page, page_num: int, images_dir: str) -> Dict[str, any]:
+        """Extract one page from a single get_text("dict") pass.
+        
+        Text and image blocks come back with bounding boxes, sorted top-to-bottom and
+        left-to-right, so image markers land where the image sits in the reading order.
+        Images are decoded from the block data of that same pass."""
+        page_dict = page.get_text("dict", sort=True)
+        
+        segments = []  # cleaned text runs and image references, in reading order
+        text_run = []
+        raw_length = 0
+        image_results = []
+        image_blocks = 0
+        
+        def flush_text_run():
+            if text_run:
+                cleaned = self.clean_extracted_text("".join(text_run))
+                if cleaned:
+                    segments.append(cleaned)
+                text_run.clear()
+        
+        for block in page_dict["blocks"]:
+            if block["type"] == 0:
+                block_text = "".join(
+                    "".join(span["text"] for span in line["spans"]) + "\n" for line in block["lines"])
+                text_run.append(block_text)
+                raw_length += len(block_text.strip())
+            elif block["type"] == 1:
+                flush_text_run()
+                img_index = image_blocks
+                image_blocks += 1
+                marker = self.image_limit_marker(page_num, img_index, block["width"], block["height"],
+                                                 block.get("colorspace") or 3, images_dir)
+                if marker:
+                    image_results.append((marker, ""))
+                    segments.append(f"[IMAGE: {marker}]")
+                    continue
+                try:
+                    pix = fitz.Pixmap(block["image"])
+                    result = self.save_image_pixmap(pix, page_num, img_index, images_dir)
+                    if result is None:
+                        continue
+                    filename, ocr_text = result
+                except Exception as pix_error:
+                    print(f"Warning: Could not process image {img_index + 1} on page {page_num}: {pix_error}")
+                    filename = self._write_marker_file(
+                        images_dir, page_num, img_index, "ERROR", f"ERROR: Failed to process image - {pix_error}")
+                    ocr_text = ""
+                image_results.append((filename, ocr_text))
+                reference = f"[IMAGE: {filename}]"
+                if ocr_text.strip():
+                    reference += f"\n[OCR from {filename}]:\n{ocr_text}"
+                segments.append(reference)
+        flush_text_run()
+        
+        body = "\n\n".join(segments)
+        page_text = "\n\n".join(segment for segment in segments if not segment.startswith("[IMAGE: "))
+        
+        # Same threshold as is_page_mostly_images, without a second text pass
+        is_scanned = raw_length < 50
+        mode, ocr_page_text = self.ocr_page_if_needed(page, page_num, page_text, is_scanned)
+        if mode == "replace":
+            # OCR text has no positions; fall back to images-then-text
+            body = (self.format_image_section(image_results) if image_results else "") + ocr_page_text
+        elif mode == "append":
+            body = f"{body}\n\n[OCR Text]:\n{ocr_page_text}"
+        
+        return {
+            "page": page_num,
+            "text": body,
+            "images": [filename for filename, _ in image_results]
+        }
+    
+    def _page_span(self, page_count: int, start: int = 0, end: int = None) -> Tuple[range, Tuple[int, int]]:
+        """The pages to extract and the (first, last) pages skipped by max_pages, or None.
+        The limit applies to whole-document extraction (end=None) only, not to shards."""
+        skipped = None
+        if end is None:
+            end = page_count
+            if self.max_pages and end > self.max_pages:
+                skipped = (self.max_pages + 1, end)
+                end = self.max_pages
+        return range(start, end), skipped
+    
+    def _emit_page(self, pdf_path: str, page_index: int, pages_done: int, total_pages: int):
+        self._emit("page", pdf_path=pdf_path, page=page_index + 1,
+                   pages_done=pages_done, total_pages=total_pages)
+    
+    def _skipped_pages_record(self, skipped: Tuple[int, int]) -> Dict[str, any]:
+        """Record the max_pages skip and return the marker record that stands in for those pages"""
+        reason = f"document has {skipped[1]} pages, limit is {self.max_pages}"
+        self._record_limit(skipped[0], f"pages {skipped[0]}-{skipped[1]}", "skipped", reason)
+        return {"page": skipped[0], "text": f"[PAGES {skipped[0]}-{skipped[1]}: SKIPPED {reason}]",
+                "images": []}
+    
+    def iter_page_records(self, doc, images_dir: str, start: int = 0, end: int = None):
+        """Yield page records for pages [start, end) of an open document.
+        Emits start/page/done progress events and checks for cancellation between pages."""
+        pages, skipped = self._page_span(len(doc), start, end)
+        self.start_document()
+        self._check_cancelled()
+        
+        worker = None
+        if self.page_timeout:
+            worker = SupervisedPageWorker(self, doc.name or doc.stream, self.page_timeout)
+        
+        try:
+            self._emit("start", pdf_path=doc.name, total_pages=len(pages))
+            for pages_done, page_index in enumerate(pages, 1):
+                if worker:
+                    record = worker.extract_page(page_index, images_dir)
+                else:
+                    record = self.extract_page(doc[page_index], page_index + 1, images_dir)
+                self._emit_page(doc.name, page_index, pages_done, len(pages))
+                yield record
+                self._check_cancelled()
+            if skipped:
+                yield self._skipped_pages_record(skipped)
+            self._emit("done", pdf_path=doc.name, total_pages=len(pages))
+        finally:
+            if worker:
+                worker.close()
+    
+    def build_full_text(self, records) -> str:
+        """Join page records into the final text with page separators"""
+        prefix = ""
+        if self.boilerplate:
+            records, repeated = self.remove_boilerplate(list(records))
+            if repeated and self.boilerplate == "note":
+                prefix = self._boilerplate_note(repeated, len(records))
+        return prefix + "".join(f"--- Page {record['page']} ---\n{record['text']}\n\n" for record in records)
+    
+    @staticmethod
+    def _boilerplate_note(repeated: List[Tuple[str, int]], pages: int) -> str:
+        """The note listing removed lines once, with the number of pages each was on"""
+        lines = [f"{line} (repeated on {count}/{pages} pages)" for line, count in repeated]
+        return "[REPEATED LINES, REMOVED]:\n" + "\n".join(lines) + "\n\n"
+    
+    @staticmethod
+    def _boilerplate_key(line: str) -> int:
+        """Hash of a line with case and spacing normalised. In short lines numbers are
+        masked too, so "Page 3 of 9" matches "Page 4 of 9" but body sentences stay distinct."""
+        line = " ".join(line.lower().split())
+        masked = re.sub(r'\d+', '#', line)
+        if len(re.sub(r'[#\W]+', ' ', masked).split()) <= 3:
+            line = masked
+        return hash(line)
+    
+    def remove_boilerplate(self, records: List[Dict[str, any]], zone: int = 3, min_pages: int = 3,
+                           min_ratio: float = 0.5) -> Tuple[List[Dict[str, any]], List[str]]:
+        """Remove lines that repeat across pages near the top or bottom of the page.
+        
+        Only the first/last `zone` text lines of a page are candidates, which gives the
+        position tolerance. A line is boilerplate when its normalised hash occurs in the
+        same region on at least max(min_pages, min_ratio * pages) pages.
+        Returns the cleaned records and (example, pages) for each removed line; token
+        savings are recorded in run_stats["boilerplate"]."""
+        def candidates(text):
+            lines = text.split("\n")
+            content = [i for i, line in enumerate(lines)
+                       if line.strip() and not line.startswith(("[IMAGE: ", "[OCR from ", "[OCR Text]"))]
+            top = content[:zone]
+            bottom = content[-zone:] if len(content) > zone else []
+            return lines, [(i, "top") for i in top] + [(i, "bottom") for i in bottom if i not in top]
+        
+        counts = {}
+        for record in records:
+            lines, positions = candidates(record["text"])
+            seen = {(self._boilerplate_key(lines[i]), region) for i, region in positions}
+            for key in seen:
+                counts[key] = counts.get(key, 0) + 1
+        
+        threshold = max(min_pages, min_ratio * len(records))
+        repeated_keys = {key for key, count in counts.items() if count >= threshold}
+        if not repeated_keys:
+            return records, []
+        
+        examples = {}
+        lines_removed = 0
+        tokens_removed = 0
+        cleaned = []
+        for record in records:
+            lines, positions = candidates(record["text"])
+            drop = set()
+            for i, region in positions:
+                key = (self._boilerplate_key(lines[i]), region)
+                if key in repeated_keys:
+                    drop.add(i)
+                    examples.setdefault(key, lines[i].strip())
+                    tokens_removed += self.count_tokens(lines[i] + "\n")
+            lines_removed += len(drop)
+            text = "\n".join(line for i, line in enumerate(lines) if i not in drop).strip("\n")
+            cleaned.append(dict(record, text=text))
+        
+        repeated = [(line, counts[key]) for key, line in examples.items()]
+        tokens_saved = tokens_removed
+        if self.boilerplate == "note":
+            tokens_saved -= self.count_tokens(self._boilerplate_note(repeated, len(records)))
+        self.merge_run_stats({"boilerplate": {
+            "unique_lines": len(repeated),
+            "lines_removed": lines_removed,
+            "tokens_saved": tokens_saved
+        }})
+        print(f"✓ Removed {lines_removed} repeated header/footer lines ({tokens_saved:,} tokens saved)")
+        return cleaned, repeated
+    
+    def extract_text_with_image_positions(self, pdf_path: str, output_dir: str, pages_path: str = None,
+                                          source=None, prefetcher=None) -> str:
+        """Extract text from PDF and insert image filenames at appropriate positions, with OCR support.
+        With pages_path, the page records are also saved there for rechunk. source (bytes or
+        a local path) is read instead of pdf_path when given; see open_pdf for prefetcher."""
+        doc = open_pdf(pdf_path, source, prefetcher)
         
         # Create images directory
         images_dir = os.path.join(output_dir, "extracted_images")
         os.makedirs(images_dir, exist_ok=True)
         
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            
-            # Add page separator
-            full_text += f"--- Page {page_num + 1} ---\n"
-            
-            # Extract images first (now returns tuples with OCR text)
-            image_results = self.extract_images_from_page(page, page_num + 1, images_dir)
-            
-            # Extract text using normal PDF extraction
-            page_text = page.get_text()
-            page_text = self.clean_extracted_text(page_text)
-            
-            # Check if this is a scanned page (little extractable text)
-            is_scanned = self.is_page_mostly_images(page)
-            
-            # If it's a scanned page or we have very little text, try OCR on the entire page
-            ocr_page_text = ""
-            if self.use_ocr and (is_scanned or len(page_text.strip()) < 100):
-                print(f"Page {page_num + 1} appears to be scanned, applying OCR...")
-                ocr_page_text = self.extract_text_from_page_ocr(page)
-                if len(ocr_page_text.strip()) > len(page_text.strip()):
-                    print(f"✓ OCR produced better results for page {page_num + 1}")
-                    page_text = ocr_page_text
-                elif ocr_page_text.strip():
-                    print(f"✓ Combined PDF text with OCR text for page {page_num + 1}")
-                    page_text = f"{page_text}\n\n[OCR Text]:\n{ocr_page_text}"
-            
-            # Insert image references and OCR text
-            if image_results:
-                image_section = ""
-                for filename, ocr_text in image_results:
-                    image_section += f"[IMAGE: {filename}]"
-                    if ocr_text.strip():
-                        image_section += f"\n[OCR from {filename}]:\n{ocr_text}\n"
-                    image_section += "\n"
-                full_text += f"{image_section}\n"
-            
-            full_text += page_text + "\n\n"
-        
-        doc.close()
+        records = self.iter_page_records(doc, images_dir)
+        partial_path = f"{pages_path}.partial" if pages_path else None
+        if partial_path:
+            records = tee_page_records(partial_path, records)
+        try:
+            full_text = self.build_full_text(records)
+        except BaseException:
+            if partial_path and os.path.exists(partial_path):
+                records.close()
+                os.remove(partial_path)
+            raise
+        finally:
+            doc.close()
+        if partial_path:
+            # Only a complete document replaces the previous intermediate
+            os.replace(partial_path, pages_path)
         return full_text
     
-    def split_text_by_tokens(self, text: str, base_filename: str, output_dir: str) -> List[str]:
-        """Split text into chunks of approximately max_tokens each"""
-        lines = text.split('\n')
-        chunks = []
-        current_chunk = ""
+    def iter_text_chunks(self, pieces):
+        """Yield chunks of approximately max_tokens each as soon as they fill.
+        pieces are consecutive fragments of one text (e.g. page sections); the result is
+        the same as splitting "".join(pieces), without holding the whole text."""
+        def lines():
+            pending = ""
+            for piece in pieces:
+                parts = (pending + piece).split('\n')
+                pending = parts.pop()
+                yield from parts
+            yield pending
+        
+        current_chunk = []
         current_tokens = 0
         
-        for line in lines:
+        for line in lines():
             line_tokens = self.count_tokens(line + '\n')
             
             if current_tokens + line_tokens > self.max_tokens and current_chunk:
-                # Save current chunk
-                chunks.append(current_chunk.strip())
-                current_chunk = line + '\n'
+                # Emit current chunk
+                yield "".join(current_chunk).strip()
+                current_chunk = [line + '\n']
                 current_tokens = line_tokens
             else:
-                current_chunk += line + '\n'
+                current_chunk.append(line + '\n')
                 current_tokens += line_tokens
         
-        # Add remaining chunk
-        if current_chunk.strip():
-            chunks.append(current_chunk.strip())
+        # Emit remaining chunk
+        remaining = "".join(current_chunk).strip()
+        if remaining:
+            yield remaining
+    
+    def split_text_by_tokens(self, text: str, base_filename: str, output_dir: str) -> List[str]:
+        """Split text into chunks of approximately max_tokens each"""
+        chunks = list(self.iter_text_chunks([text]))
         
         # Save chunks to files
         output_files = []
@@ -249,8 +1188,73 @@ class PDFExtractor:
         
         return output_files
     
-    def process_pdf(self, pdf_path: str, output_dir: str = None) -> Dict[str, any]:
-        """Main processing function"""
+    def remove_text_files(self, output_dir: str, base_filename: str):
+        """Delete the {base}.txt / {base}_part_N.txt files a previous run wrote to output_dir
+        (as listed in its TEXT_FILES_MANIFEST), so a run with fewer chunks leaves no stale
+        parts behind. Files this tool did not write are left alone."""
+        manifest_path = Path(output_dir) / TEXT_FILES_MANIFEST
+        if not manifest_path.exists():
+            return
+        with open(manifest_path, encoding='utf-8') as f:
+            names = json.load(f).get(base_filename, [])
+        part_name = re.compile(re.escape(base_filename) + r"(_part_\d+)?\.txt")
+        for name in names:
+            if part_name.fullmatch(name):
+                (Path(output_dir) / name).unlink(missing_ok=True)
+    
+    def record_text_files(self, output_dir: str, base_filename: str, text_files: List[str]):
+        """List the text files just written for base_filename in output_dir's
+        TEXT_FILES_MANIFEST, for the next run's remove_text_files"""
+        manifest_path = Path(output_dir) / TEXT_FILES_MANIFEST
+        manifest = {}
+        if manifest_path.exists():
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        manifest[base_filename] = [Path(filepath).name for filepath in text_files]
+        tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+    
+    def replace_text_files(self, text: str, base_filename: str, output_dir: str) -> List[str]:
+        """split_text_by_tokens, replacing the text files a previous run wrote for base_filename"""
+        self.remove_text_files(output_dir, base_filename)
+        output_files = self.split_text_by_tokens(text, base_filename, str(output_dir))
+        self.record_text_files(output_dir, base_filename, output_files)
+        return output_files
+    
+    def rechunk(self, output_dir: str, target_dir: str = None) -> List[Dict[str, any]]:
+        """Rebuild the text files of a process_pdf output directory at the current max_tokens
+        from its saved page records ({stem}_pages.jsonl.gz), without re-extracting or OCRing.
+        The files replace the old ones, or go to target_dir (images stay where they are)."""
+        output_dir = Path(output_dir)
+        target_dir = Path(target_dir) if target_dir else output_dir
+        pages_files = sorted(output_dir.glob(f"*{PAGES_SUFFIX}"))
+        if not pages_files:
+            raise FileNotFoundError(f"No page records ({PAGES_SUFFIX}) in {output_dir}; "
+                                    f"re-run the extraction to create them")
+        target_dir.mkdir(parents=True, exist_ok=True)
+        
+        results = []
+        for pages_path in pages_files:
+            base_filename = pages_path.name[:-len(PAGES_SUFFIX)]
+            self.run_stats = self._new_run_stats()
+            full_text = self.build_full_text(read_page_records(str(pages_path)))
+            output_files = self.replace_text_files(full_text, base_filename, str(target_dir))
+            results.append({
+                "pages_path": str(pages_path),
+                "output_dir": str(target_dir),
+                "text_files": output_files,
+                "total_tokens": self.count_tokens(full_text),
+                **self.run_stats
+            })
+        return results
+    
+    def process_pdf(self, pdf_path: str, output_dir: str = None, source=None,
+                    prefetcher=None) -> Dict[str, any]:
+        """Main processing function. source optionally supplies the PDF's contents (bytes or a
+        local copy, e.g. from PDFPrefetcher, passed as prefetcher so that direct reads count
+        as I/O stall); pdf_path still names the outputs."""
         pdf_path = Path(pdf_path)
         
         if not pdf_path.exists():
@@ -262,16 +1266,19 @@ class PDFExtractor:
             output_dir = Path(output_dir)
         
         output_dir.mkdir(parents=True, exist_ok=True)
+        self.run_stats = self._new_run_stats()
         
         print(f"Processing: {pdf_path}")
         print(f"Output directory: {output_dir}")
         
-        # Extract text with image positions
-        full_text = self.extract_text_with_image_positions(str(pdf_path), str(output_dir))
+        # Extract text with image positions, keeping the page records for rechunk
+        base_filename = pdf_path.stem
+        pages_path = output_dir / f"{base_filename}{PAGES_SUFFIX}"
+        full_text = self.extract_text_with_image_positions(str(pdf_path), str(output_dir), str(pages_path),
+                                                           source=source, prefetcher=prefetcher)
         
         # Split into token-based chunks
-        base_filename = pdf_path.stem
-        output_files = self.split_text_by_tokens(full_text, base_filename, str(output_dir))
+        output_files = self.replace_text_files(full_text, base_filename, str(output_dir))
         
         # Count images
         images_dir = output_dir / "extracted_images"
@@ -282,9 +1289,880 @@ class PDFExtractor:
             "output_dir": str(output_dir),
             "text_files": output_files,
             "image_count": image_count,
-            "total_tokens": self.count_tokens(full_text)
+            "total_tokens": self.count_tokens(full_text),
+            **self.run_stats
         }
     
+    def extract_bytes(self, data) -> ExtractionResult:
+        """Extract a PDF held in memory (bytes, bytearray or memoryview) without touching the disk.
+        Chunks, PNG image bytes and stats are returned in an ExtractionResult."""
+        return self._extract_document(fitz.open(stream=data, filetype="pdf"))
+    
+    def _extract_document(self, doc) -> ExtractionResult:
+        """extract_bytes for an open document, which is closed afterwards"""
+        self.run_stats = self._new_run_stats()
+        self.memory_images = {}
+        
+        try:
+            records = list(self.iter_page_records(doc, None))
+        finally:
+            doc.close()
+        
+        full_text = self.build_full_text(records)
+        images, self.memory_images = self.memory_images, {}
+        return ExtractionResult(
+            chunks=list(self.iter_text_chunks([full_text])),
+            images=images,
+            pages=records,
+            total_tokens=self.count_tokens(full_text),
+            stats=dict(self.run_stats)
+        )
+    
+    def iter_chunks_from_bytes(self, data, images_dir: str = None):
+        """Yield the text chunks of an in-memory PDF as soon as each one fills.
+        Images are written to images_dir, or not kept at all when it is None."""
+        self.run_stats = self._new_run_stats()
+        previous_images, self.memory_images = self.memory_images, None
+        if images_dir:
+            os.makedirs(images_dir, exist_ok=True)
+        
+        doc = fitz.open(stream=data, filetype="pdf")
+        try:
+            records = self.iter_page_records(doc, images_dir)
+            if self.boilerplate:
+                # The repeated-line pass needs every page before any text can be emitted
+                sections = [self.build_full_text(records)]
+            else:
+                sections = (self.build_full_text([record]) for record in records)
+            yield from self.iter_text_chunks(sections)
+        finally:
+            doc.close()
+            self.memory_images = previous_images
+    
+    def extract_mmap(self, pdf_path: str) -> ExtractionResult:
+        """Extract a local PDF through a read-only memory map instead of reading it into memory"""
+        if self.page_timeout:
+            # Page workers open the file by path; handing them the mapped data would copy
+            # the whole file into memory, which is what the map avoids
+            return self._extract_document(fitz.open(str(pdf_path)))
+        with open(pdf_path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    return self.extract_bytes(view)
+                finally:
+                    view.release()
+    
+    # Async API: pages are extracted in pooled SupervisedPageWorker processes whose blocking
+    # calls run in executor threads, so the event loop is never blocked by extraction
+    
+    def _document_copy(self, keep_images: bool) -> "PDFExtractor":
+        """A shallow copy with its own per-document state, so concurrent async calls on one
+        extractor do not mix their run_stats or images"""
+        extractor = copy.copy(self)
+        extractor.run_stats = self._new_run_stats()
+        extractor.memory_images = {} if keep_images else None
+        extractor.start_document()
+        return extractor
+    
+    def _async_semaphore(self) -> asyncio.Semaphore:
+        """The semaphore shared by this extractor's async calls on the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.async_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+    
+    def _checkout_worker(self, extractor: "PDFExtractor", source) -> "SupervisedPageWorker":
+        """Take an idle pooled worker, preferably one that already has source open, or a new
+        one, and point it at source"""
+        with self._pool_lock:
+            worker = next((w for w in self._idle_workers if w.has_open(source)), None)
+            if worker is None and self._idle_workers:
+                worker = self._idle_workers[-1]
+            if worker is not None:
+                self._idle_workers.remove(worker)
+        if worker is None:
+            return SupervisedPageWorker(extractor, source, self.page_timeout)
+        worker.extractor = extractor
+        worker.open(source)
+        return worker
+    
+    def _release_worker(self, worker: "SupervisedPageWorker"):
+        with self._pool_lock:
+            self._idle_workers.append(worker)
+    
+    def close_workers(self):
+        """Stop the idle worker processes kept by the async API"""
+        with self._pool_lock:
+            workers = list(self._idle_workers)
+            self._idle_workers.clear()
+        for worker in workers:
+            worker.close()
+    
+    async def _arun_pages(self, extractor: "PDFExtractor", source, images_dir: str, pages: range,
+                          semaphore: asyncio.Semaphore, records: asyncio.Queue, stop: asyncio.Event):
+        """Extract a run of pages on one pooled worker while holding the semaphore, putting each
+        record (or the error that ended the run) on records. Stops before the next page once
+        stop is set; cancelling the task kills the page in flight."""
+        loop = asyncio.get_running_loop()
+        try:
+            async with semaphore:
+                if stop.is_set():
+                    return
+                checkout = loop.run_in_executor(None, self._checkout_worker, extractor, source)
+                try:
+                    worker = await asyncio.shield(checkout)
+                except asyncio.CancelledError:
+                    # The checkout still completes in its thread; return that worker to the pool
+                    checkout.add_done_callback(
+                        lambda future: future.exception() is None and self._release_worker(future.result()))
+                    raise
+                
+                reusable = True
+                try:
+                    for page_index in pages:
+                        if stop.is_set():
+                            break
+                        extractor._check_cancelled()
+                        page = loop.run_in_executor(None, worker.extract_page, page_index, images_dir)
+                        try:
+                            record = await asyncio.shield(page)
+                        except asyncio.CancelledError:
+                            # Kill the page mid-flight; the worker is dropped once its thread returns
+                            reusable = False
+                            process = worker.process
+                            if process is not None:
+                                process.kill()
+                            page.add_done_callback(lambda _: worker._kill())
+                            raise
+                        records.put_nowait(record)
+                finally:
+                    if reusable:
+                        self._release_worker(worker)
+        except Exception as e:
+            records.put_nowait(e)
+    
+    async def _arecords(self, extractor: "PDFExtractor", source, images_dir: str, semaphore=None):
+        """Async counterpart of iter_page_records: yield the page records of source (a path
+        or bytes) in order. Pages are extracted in runs of async_pages_per_task spread over
+        the worker pool, up to async_concurrency runs ahead of the consumer."""
+        loop = asyncio.get_running_loop()
+        if isinstance(source, (str, os.PathLike)):
+            source = name = os.fspath(source)
+        else:
+            source, name = bytes(source), ""
+        
+        def page_count():
+            doc = fitz.open(source) if isinstance(source, str) else fitz.open(stream=source, filetype="pdf")
+            try:
+                return len(doc)
+            finally:
+                doc.close()
+        
+        pages, skipped = extractor._page_span(await loop.run_in_executor(None, page_count))
+        # The image byte budget is spent in page order, so it keeps the document on one worker
+        size = max(len(pages), 1) if extractor.max_image_bytes else self.async_pages_per_task
+        runs = [pages[i:i + size] for i in range(0, len(pages), size)]
+        semaphore = semaphore or self._async_semaphore()
+        keep_images = extractor.memory_images is not None
+        stop = asyncio.Event()
+        scheduled = []  # (run extractor, records queue, task) per run
+        
+        extractor._check_cancelled()
+        extractor._emit("start", pdf_path=name, total_pages=len(pages))
+        try:
+            pages_done = 0
+            for index, run in enumerate(runs):
+                while len(scheduled) < min(len(runs), index + self.async_concurrency):
+                    run_extractor = extractor._document_copy(keep_images)
+                    records = asyncio.Queue()
+                    task = asyncio.ensure_future(self._arun_pages(
+                        run_extractor, source, images_dir, runs[len(scheduled)], semaphore, records, stop))
+                    scheduled.append((run_extractor, records, task))
+                run_extractor, records, task = scheduled[index]
+                for page_index in run:
+                    record = await records.get()
+                    if isinstance(record, Exception):
+                        raise record
+                    pages_done += 1
+                    extractor._emit_page(name, page_index, pages_done, len(pages))
+                    yield record
+                    extractor._check_cancelled()
+                await task
+                extractor.merge_run_stats(run_extractor.run_stats)
+                if keep_images:
+                    extractor.memory_images.update(run_extractor.memory_images)
+            if skipped:
+                yield extractor._skipped_pages_record(skipped)
+            extractor._emit("done", pdf_path=name, total_pages=len(pages))
+        except ExtractionCancelled:
+            raise  # runs in flight finish their current page and return their workers
+        except BaseException:
+            # Task cancelled, consumer gone or a run failed: kill the pages in flight
+            for _, _, task in scheduled:
+                task.cancel()
+            raise
+        finally:
+            stop.set()
+            await asyncio.gather(*(task for _, _, task in scheduled), return_exceptions=True)
+    
+    async def aiter_pages(self, source, images_dir: str = None, semaphore: asyncio.Semaphore = None):
+        """Async iterator over the page records of a PDF (a str or PathLike path, bytes,
+        bytearray or memoryview).
+        Images are written to images_dir, or not kept at all when it is None."""
+        extractor = self._document_copy(keep_images=False)
+        if images_dir:
+            os.makedirs(images_dir, exist_ok=True)
+        async for record in self._arecords(extractor, source, images_dir, semaphore):
+            yield record
+    
+    async def aiter_chunks(self, source, images_dir: str = None, semaphore: asyncio.Semaphore = None):
+        """Async iterator over the text chunks of a PDF, yielding each chunk as soon as it fills.
+        Token counting runs in a thread; images are handled as in aiter_pages."""
+        loop = asyncio.get_running_loop()
+        extractor = self._document_copy(keep_images=False)
+        if images_dir:
+            os.makedirs(images_dir, exist_ok=True)
+        sections = queue.Queue()
+        chunks = asyncio.Queue()
+        errors = []
+        
+        def chunker():
+            try:
+                for chunk in extractor.iter_text_chunks(iter(sections.get, None)):
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                with contextlib.suppress(RuntimeError):  # the event loop is already closed
+                    loop.call_soon_threadsafe(chunks.put_nowait, None)
+        
+        # A dedicated thread, not the executor: the chunker blocks waiting for sections, and
+        # must not hold an executor thread that the page work it is waiting for needs
+        threading.Thread(target=chunker, name="pdf-chunker", daemon=True).start()
+        records = self._arecords(extractor, source, images_dir, semaphore)
+        try:
+            if self.boilerplate:
+                # The repeated-line pass needs every page before any text can be emitted
+                pages = [record async for record in records]
+                sections.put(await loop.run_in_executor(None, extractor.build_full_text, pages))
+            else:
+                async for record in records:
+                    sections.put(extractor.build_full_text([record]))
+                    while not chunks.empty():
+                        chunk = chunks.get_nowait()
+                        if chunk is None:
+                            raise errors[0]  # chunking can only stop early on an error
+                        yield chunk
+            sections.put(None)
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                yield chunk
+            if errors:
+                raise errors[0]
+        finally:
+            sections.put(None)
+    
+    async def aprocess_pdf(self, pdf_path: str, output_dir: str = None,
+                           semaphore: asyncio.Semaphore = None) -> Dict[str, any]:
+        """Async process_pdf: writes the same files and returns the same result. Pages are
+        extracted in the worker pool; chunking and writing run in a thread."""
+        pdf_path = Path(pdf_path)
+        
+        if not pdf_path.exists():
+            raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+        
+        if output_dir is None:
+            output_dir = pdf_path.parent / f"{pdf_path.stem}_extracted"
+        else:
+            output_dir = Path(output_dir)
+        
+        images_dir = output_dir / "extracted_images"
+        images_dir.mkdir(parents=True, exist_ok=True)
+        extractor = self._document_copy(keep_images=False)
+        
+        print(f"Processing: {pdf_path}")
+        print(f"Output directory: {output_dir}")
+        
+        records = [record async for record in self._arecords(extractor, str(pdf_path), str(images_dir),
+                                                              semaphore)]
+        
+        def finish():
+            base_filename = pdf_path.stem
+            pages_path = output_dir / f"{base_filename}{PAGES_SUFFIX}"
+            write_page_records(f"{pages_path}.partial", records)
+            os.replace(f"{pages_path}.partial", pages_path)
+            
+            full_text = extractor.build_full_text(records)
+            output_files = extractor.replace_text_files(full_text, base_filename, str(output_dir))
+            return {
+                "pdf_path": str(pdf_path),
+                "output_dir": str(output_dir),
+                "text_files": output_files,
+                "image_count": len(list(images_dir.glob("*.png"))),
+                "total_tokens": extractor.count_tokens(full_text),
+                **extractor.run_stats
+            }
+        
+        return await asyncio.get_running_loop().run_in_executor(None, finish)
+    
+    async def aextract_bytes(self, data, semaphore: asyncio.Semaphore = None) -> ExtractionResult:
+        """Async extract_bytes: extract an in-memory PDF into an ExtractionResult without
+        touching the disk"""
+        extractor = self._document_copy(keep_images=True)
+        records = [record async for record in self._arecords(extractor, data, None, semaphore)]
+        
+        def finish():
+            full_text = extractor.build_full_text(records)
+            return ExtractionResult(
+                chunks=list(extractor.iter_text_chunks([full_text])),
+                images=extractor.memory_images,
+                pages=records,
+                total_tokens=extractor.count_tokens(full_text),
+                stats=dict(extractor.run_stats)
+            )
+        
+        return await asyncio.get_running_loop().run_in_executor(None, finish)
+    
+    def estimate_pdf(self, pdf_path: str, sample_pages: int = 12, rates: dict = None,
+                     ocr: bool = None) -> Dict[str, any]:
+        """Estimate what process_pdf would produce and how long it would take, without
+        running it. Image sizes are read from every page's metadata; text is probed on
+        evenly spaced pages and extrapolated. Nothing is decoded, rendered or OCRed.
+        ocr costs the run with or without OCR (default: use_ocr); Tesseract is not needed
+        here, so a host without it can still plan an OCR run."""
+        rates = rates or load_stage_rates()
+        ocr = self.use_ocr if ocr is None else ocr
+        started = time.perf_counter()
+        
+        doc = fitz.open(pdf_path)
+        try:
+            total_pages = len(doc)
+            # Width and height come from the image dictionaries; no pixels are decoded
+            page_images = [doc.get_page_images(index, full=True) for index in range(total_pages)]
+            images = sum(len(found) for found in page_images)
+            image_megapixels = sum(img[2] * img[3] for found in page_images for img in found) / 1e6
+            
+            sampled = sorted({i * total_pages // sample_pages for i in range(min(sample_pages, total_pages))})
+            scanned = ocr_pages = tokens = 0
+            ocr_megapixels = 0.0
+            for index in sampled:
+                page = doc[index]
+                page_num = index + 1
+                raw_text = page.get_text()
+                body = self.clean_extracted_text(raw_text)
+                scanned += self.is_page_mostly_images(page, text=raw_text)
+                markers = "".join(f"[IMAGE: page_{page_num}_image_{i + 1}.png]\n"
+                                  for i in range(len(page_images[index])))
+                
+                # Same decision as ocr_page_if_needed; pages are rendered at 2x zoom for OCR
+                if ocr and self.needs_page_ocr(page, text_layer_stats(body)):
+                    ocr_pages += 1
+                    ocr_megapixels += page.rect.width * page.rect.height * 4 / 1e6
+                    tokens += OCR_PAGE_TOKENS + self.count_tokens(f"--- Page {page_num} ---\n{markers}\n\n")
+                else:
+                    tokens += self.count_tokens(f"--- Page {page_num} ---\n{markers}\n{body}\n\n")
+        finally:
+            doc.close()
+        
+        scale = total_pages / len(sampled) if sampled else 0
+        total_tokens = round(tokens * scale)
+        seconds = total_pages * rates["page_seconds"] + image_megapixels * rates["image_megapixel_seconds"]
+        if ocr:
+            # Every non-blank image is OCRed as well as the scanned pages
+            ocr_rate = rates["ocr_megapixel_seconds"][self.ocr_profile]
+            seconds += (ocr_megapixels * scale + image_megapixels) * ocr_rate
+        
+        return {
+            "pdf_path": str(pdf_path),
+            "pages": total_pages,
+            "sampled_pages": len(sampled),
+            "scanned_pages": round(scanned * scale),
+            "ocr_pages": round(ocr_pages * scale),
+            "images": images,
+            "ocr_images": images if ocr else 0,
+            "tokens": total_tokens,
+            "chunks": max(1, math.ceil(total_tokens / self.max_tokens)),
+            "seconds": round(seconds, 2),
+            "estimate_seconds": round(time.perf_counter() - started, 3)
+        }
+    
+    def plan_shards(self, pdf_path: str, num_shards: int, shards_dir: str = None,
+                    output_dir: str = None) -> str:
+        """Split a PDF's page range into shards and write a manifest, returning its path"""
+        pdf_path = Path(pdf_path)
+        if not pdf_path.exists():
+            raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+        if num_shards < 1:
+            raise ValueError("Number of shards must be at least 1")
+        
+        doc = fitz.open(str(pdf_path))
+        page_count = len(doc)
+        doc.close()
+        
+        if shards_dir is None:
+            shards_dir = pdf_path.parent / f"{pdf_path.stem}_shards"
+        if output_dir is None:
+            output_dir = pdf_path.parent / f"{pdf_path.stem}_extracted"
+        shards_dir = Path(shards_dir)
+        shards_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Spread pages evenly; shard sizes differ by at most one page
+        num_shards = max(1, min(num_shards, page_count))
+        base, extra = divmod(page_count, num_shards)
+        shards = []
+        start = 0
+        for k in range(num_shards):
+            size = base + (1 if k < extra else 0)
+            shards.append({
+                "shard": k + 1,
+                "start_page": start + 1,
+                "end_page": start + size,
+                "dir": f"shard_{k + 1}"
+            })
+            start += size
+        
+        manifest = {
+            "pdf_path": str(pdf_path.resolve()),
+            "pdf_size": pdf_path.stat().st_size,
+            "page_count": page_count,
+            "output_dir": str(Path(output_dir).resolve()),
+            "shards": shards
+        }
+        manifest_path = shards_dir / "manifest.json"
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        
+        print(f"Planned {len(shards)} shard(s) for {page_count} pages: {manifest_path}")
+        return str(manifest_path)
+    
+    def run_shard(self, manifest_path: str, shard: int, pdf_path: str = None,
+                  shard_dir: str = None) -> Dict[str, any]:
+        """Extract one shard of a manifest into its own directory"""
+        manifest_path = Path(manifest_path)
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        
+        entry = next((s for s in manifest["shards"] if s["shard"] == shard), None)
+        if entry is None:
+            raise ValueError(f"Shard {shard} not found in {manifest_path}")
+        
+        # The PDF may live at a different path on this host
+        pdf_path = Path(pdf_path or manifest["pdf_path"])
+        if not pdf_path.exists():
+            raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+        
+        shard_dir = Path(shard_dir) if shard_dir else manifest_path.parent / entry["dir"]
+        images_dir = shard_dir / "extracted_images"
+        images_dir.mkdir(parents=True, exist_ok=True)
+        
+        print(f"Processing shard {shard}: pages {entry['start_page']}-{entry['end_page']} of {pdf_path}")
+        
+        doc = fitz.open(str(pdf_path))
+        try:
+            if len(doc) != manifest["page_count"]:
+                raise ValueError(f"{pdf_path} has {len(doc)} pages, manifest expects {manifest['page_count']}")
+            # Image names use absolute page numbers, so shards never collide
+            records = list(self.iter_page_records(doc, str(images_dir),
+                                                  entry["start_page"] - 1, entry["end_page"]))
+        finally:
+            doc.close()
+        
+        write_page_records(str(shard_dir / "pages.jsonl.gz"), records)
+        
+        # Written last: its presence marks the shard as complete
+        summary = {
+            "shard": shard,
+            "start_page": entry["start_page"],
+            "end_page": entry["end_page"],
+            "pages": len(records),
+            "images": [name for record in records for name in record["images"]]
+        }
+        with open(shard_dir / "shard.json", 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        
+        summary["shard_dir"] = str(shard_dir)
+        return summary
+    
+    def merge_shards(self, manifest_path: str, output_dir: str = None) -> Dict[str, any]:
+        """Combine completed shard outputs into the same files a single-node run produces"""
+        manifest_path = Path(manifest_path)
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        
+        output_dir = Path(output_dir or manifest["output_dir"])
+        images_dir = output_dir / "extracted_images"
+        images_dir.mkdir(parents=True, exist_ok=True)
+        self.run_stats = self._new_run_stats()
+        
+        records = []
+        merged_images = set()
+        for entry in manifest["shards"]:
+            shard_dir = manifest_path.parent / entry["dir"]
+            if not (shard_dir / "shard.json").exists():
+                raise RuntimeError(f"Shard {entry['shard']} has not completed: {shard_dir}")
+            
+            shard_records = read_page_records(str(shard_dir / "pages.jsonl.gz"))
+            expected = entry["end_page"] - entry["start_page"] + 1
+            if len(shard_records) != expected:
+                raise RuntimeError(f"Shard {entry['shard']} has {len(shard_records)} pages, expected {expected}")
+            records.extend(shard_records)
+            
+            # Image files (including _ERROR markers) already carry absolute page numbers
+            shard_images = shard_dir / "extracted_images"
+            if shard_images.exists():
+                for image_file in shard_images.iterdir():
+                    shutil.copy2(image_file, images_dir / image_file.name)
+                    merged_images.add(image_file.name)
+        
+        # Images left by an earlier merge or run (e.g. of a longer version of the document)
+        # are not referenced by this text
+        for image_file in images_dir.glob("page_*"):
+            if image_file.name not in merged_images:
+                image_file.unlink()
+        
+        records.sort(key=lambda record: record["page"])
+        full_text = self.build_full_text(records)
+        
+        base_filename = Path(manifest["pdf_path"]).stem
+        write_page_records(str(output_dir / f"{base_filename}{PAGES_SUFFIX}"), records)
+        output_files = self.replace_text_files(full_text, base_filename, str(output_dir))
+        
+        image_count = len(list(images_dir.glob("*.png")))
+        
+        return {
+            "pdf_path": manifest["pdf_path"],
+            "output_dir": str(output_dir),
+            "text_files": output_files,
+            "image_count": image_count,
+            "total_tokens": self.count_tokens(full_text),
+            **self.run_stats
+        }
+    
+    def pack_documents(self, pdf_paths: List[str], output_dir: str, base_filename: str = "batch",
+                       prefetch: Dict[str, any] = None) -> Dict[str, any]:
+        """Extract several PDFs and pack them into shared chunk files of up to max_tokens.
+        
+        Each document is wrapped in DOCUMENT/END DOCUMENT separator lines and starts a
+        new file only when it does not fit in the current one; documents larger than
+        max_tokens are split over several files. Images go to extracted_images/<document>/.
+        An index ({base_filename}_index.json) maps every document to the files and
+        character offsets it occupies. prefetch holds PDFPrefetcher options (depth,
+        max_bytes, scratch_dir) for reading the next PDFs ahead."""
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        self.remove_text_files(output_dir, base_filename)
+        
+        # Image directories of the previous pack, removed at the end unless reused
+        index_path = output_dir / f"{base_filename}_index.json"
+        previous_images = []
+        if index_path.exists():
+            with open(index_path, encoding='utf-8') as f:
+                previous_images = [document["images_dir"] for document in json.load(f)["documents"]
+                                   if document["images_dir"]]
+        
+        documents, failed, all_stats = [], [], []
+        text_files = []
+        current, current_tokens, current_length = [], 0, 0
+        
+        def flush():
+            nonlocal current, current_tokens, current_length
+            filepath = output_dir / f"{base_filename}_part_{len(text_files) + 1}.txt"
+            with open(filepath, 'w', encoding='utf-8') as f:
+                f.write("".join(current))
+            text_files.append(str(filepath))
+            print(f"Created: {filepath} ({current_tokens:,} tokens)")
+            current, current_tokens, current_length = [], 0, 0
+        
+        def add_part(document, text, tokens):
+            nonlocal current_tokens, current_length
+            if current and current_tokens + tokens > self.max_tokens:
+                flush()
+            document["parts"].append({"file": len(text_files), "start": current_length,
+                                      "end": current_length + len(text)})
+            current.append(text)
+            current_tokens += tokens
+            current_length += len(text)
+        
+        used_names = set()
+        prefetcher = PDFPrefetcher(pdf_paths, **(prefetch or {"depth": 0}))
+        for pdf_path, source in prefetcher:
+            # Same-named PDFs from different directories get distinct document ids
+            name = pdf_path.stem
+            suffix = 2
+            while name in used_names:
+                name = f"{pdf_path.stem}_{suffix}"
+                suffix += 1
+            used_names.add(name)
+            images_dir = output_dir / "extracted_images" / name
+            # Images from an earlier pack of a document with this name
+            shutil.rmtree(images_dir, ignore_errors=True)
+            
+            print(f"Packing: {pdf_path}")
+            self.run_stats = self._new_run_stats()
+            try:
+                doc = open_pdf(pdf_path, source, prefetcher)
+                try:
+                    images_dir.mkdir(parents=True, exist_ok=True)
+                    page_count = len(doc)
+                    full_text = self.build_full_text(self.iter_page_records(doc, str(images_dir)))
+                finally:
+                    doc.close()
+            except ExtractionCancelled:
+                raise
+            except Exception as e:
+                print(f"  ✗ Error: {e}", file=sys.stderr)
+                shutil.rmtree(images_dir, ignore_errors=True)
+                failed.append({"pdf_path": str(pdf_path), "error": str(e)})
+                continue
+            all_stats.append(self.run_stats)
+            if not any(images_dir.iterdir()):
+                images_dir.rmdir()
+            
+            block = (f"===== DOCUMENT: {pdf_path.name} ({page_count} pages) =====\n"
+                     f"{full_text.strip()}\n"
+                     f"===== END DOCUMENT: {pdf_path.name} =====\n\n")
+            document = {"document": name, "pdf_path": str(pdf_path), "pages": page_count,
+                        "tokens": self.count_tokens(block), "images_dir": None, "parts": []}
+            if images_dir.exists():
+                document["images_dir"] = str(images_dir.relative_to(output_dir))
+            
+            if document["tokens"] <= self.max_tokens:
+                add_part(document, block, document["tokens"])
+            else:
+                for piece in self.iter_text_chunks([block]):
+                    add_part(document, piece + "\n\n", self.count_tokens(piece + "\n\n"))
+            documents.append(document)
+        
+        if current:
+            flush()
+        if len(text_files) == 1:
+            # Same naming as split_text_by_tokens: no _part_N suffix for a single file
+            single = output_dir / f"{base_filename}.txt"
+            os.replace(text_files[0], single)
+            text_files = [str(single)]
+        self.record_text_files(output_dir, base_filename, text_files)
+        
+        filenames = [Path(filepath).name for filepath in text_files]
+        for document in documents:
+            for part in document["parts"]:
+                part["file"] = filenames[part["file"]]
+        
+        packed_images = {document["images_dir"] for document in documents}
+        for images_dir in previous_images:
+            if images_dir not in packed_images:
+                shutil.rmtree(output_dir / images_dir, ignore_errors=True)
+        
+        with open(index_path, 'w', encoding='utf-8') as f:
+            json.dump({"max_tokens": self.max_tokens, "files": filenames,
+                       "documents": documents, "failed": failed}, f, indent=2)
+        
+        self.run_stats = self._new_run_stats()
+        for stats in all_stats:
+            self.merge_run_stats(stats)
+        return {
+            "output_dir": str(output_dir),
+            "text_files": text_files,
+            "index_path": str(index_path),
+            "documents": len(documents),
+            "failed": failed,
+            "image_count": sum(1 for _ in (output_dir / "extracted_images").rglob("*.png")),
+            "total_tokens": sum(document["tokens"] for document in documents),
+            "prefetched": prefetcher.prefetched,
+            "io_stall_seconds": round(prefetcher.stall_seconds, 3),
+            **self.run_stats
+        }
+    
+    def sync_directory(self, source_dir: str, output_root: str = None, prune: bool = False,
+                       prefetch: Dict[str, any] = None) -> Dict[str, any]:
+        """Recursively process new or changed PDFs under source_dir.
+        
+        A manifest of source path, size, mtime, SHA-256 and settings fingerprint mapped to
+        outputs is kept in the output root (or source_dir), so unchanged files are skipped on
+        the next run. Files last extracted with different settings are processed again.
+        With prune=True, outputs of sources that no longer exist are deleted. prefetch holds
+        PDFPrefetcher options for reading the files to be processed ahead."""
+        source_dir = Path(source_dir)
+        if not source_dir.is_dir():
+            raise FileNotFoundError(f"Directory not found: {source_dir}")
+        
+        manifest_root = Path(output_root) if output_root else source_dir
+        manifest_root.mkdir(parents=True, exist_ok=True)
+        manifest_path = manifest_root / ".pdf_extractor_sync.json"
+        
+        manifest = {"files": {}}
+        if manifest_path.exists():
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        files = manifest["files"]
+        
+        def save_manifest():
+            tmp_path = manifest_path.with_suffix(".tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmp_path, manifest_path)
+        
+        summary = {"scanned": 0, "processed": 0, "unchanged": 0, "failed": 0, "pruned": 0,
+                   "prefetched": 0, "io_stall_seconds": 0.0, "results": []}
+        seen = set()
+        pending = []
+        settings = self.settings_fingerprint()
+        
+        try:
+            for path in iter_pdf_files(str(source_dir)):
+                pdf_path = Path(path)
+                rel = pdf_path.relative_to(source_dir).as_posix()
+                seen.add(rel)
+                summary["scanned"] += 1
+                
+                stat = pdf_path.stat()
+                entry = files.get(rel)
+                if output_root:
+                    output_dir = Path(output_root) / Path(rel).parent / f"{pdf_path.stem}_extracted"
+                else:
+                    output_dir = pdf_path.parent / f"{pdf_path.stem}_extracted"
+                outputs_present = entry is not None and entry.get("settings") == settings and all(
+                    Path(f).exists() for f in entry.get("text_files", [])) and output_dir.exists()
+                
+                # Size and mtime match: trust the previous run without reading the file
+                if outputs_present and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                    summary["unchanged"] += 1
+                    continue
+                
+                # Only a file of the same size may have been touched without being modified;
+                # new and resized files are hashed later from the bytes read for extraction
+                sha256 = None
+                if outputs_present and entry["size"] == stat.st_size:
+                    sha256 = file_sha256(str(pdf_path))
+                    if entry["sha256"] == sha256:
+                        entry["mtime_ns"] = stat.st_mtime_ns
+                        summary["unchanged"] += 1
+                        continue
+                pending.append((rel, pdf_path, output_dir, stat, sha256))
+            
+            # Only the files that need processing are read ahead
+            prefetcher = PDFPrefetcher([item[1] for item in pending], **(prefetch or {"depth": 0}))
+            for (rel, pdf_path, output_dir, stat, sha256), (_, source) in zip(pending, prefetcher):
+                try:
+                    result = self.process_pdf(str(pdf_path), str(output_dir), source=source,
+                                              prefetcher=prefetcher)
+                except ExtractionCancelled:
+                    raise
+                except Exception as e:
+                    print(f"  ✗ Error processing {rel}: {e}", file=sys.stderr)
+                    summary["failed"] += 1
+                    continue
+                if sha256 is None:
+                    if isinstance(source, (bytes, bytearray)):
+                        sha256 = hashlib.sha256(source).hexdigest()
+                    else:
+                        sha256 = file_sha256(str(source or pdf_path))
+                
+                files[rel] = {
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "sha256": sha256,
+                    "settings": settings,
+                    "output_dir": str(output_dir),
+                    "text_files": result["text_files"]
+                }
+                summary["processed"] += 1
+                summary["results"].append(result)
+                if summary["processed"] % 50 == 0:
+                    save_manifest()
+            summary["prefetched"] = prefetcher.prefetched
+            summary["io_stall_seconds"] = round(prefetcher.stall_seconds, 3)
+            
+            for rel in [rel for rel in files if rel not in seen]:
+                if not prune:
+                    continue
+                output_dir = Path(files[rel]["output_dir"])
+                if output_dir.exists():
+                    shutil.rmtree(output_dir)
+                    print(f"Pruned outputs of deleted source: {rel}")
+                del files[rel]
+                summary["pruned"] += 1
+        finally:
+            save_manifest()
+        
+        return summary
+    
+    def tesseract_config(self) -> str:
+        """Tesseract command-line options for the active OCR profile"""
+        profile = OCR_PROFILES[self.ocr_profile]
+        return f"--oem {profile['oem']} --psm {profile['psm']}"
+    
+    def detect_orientation(self, gray) -> int:
+        """Clockwise rotation (degrees) that uprights the document, detected once per document.
+        Used by profiles that run Tesseract without per-image orientation detection."""
+        if self._osd_rotation is None and self._osd_attempts < 3:
+            # A small or textless first image may defeat OSD; retry on the next few
+            self._osd_attempts += 1
+            try:
+                osd = pytesseract.image_to_osd(Image.fromarray(gray), output_type=pytesseract.Output.DICT)
+                self._osd_rotation = int(osd.get("rotate", 0)) % 360
+                if self._osd_rotation:
+                    print(f"✓ Detected document rotation: {self._osd_rotation}°")
+            except Exception:
+                pass
+        return self._osd_rotation or 0
+    
+    def prepare_ocr_image(self, image):
+        """Apply the active profile's preprocessing chain to a PIL image before OCR"""
+        profile = OCR_PROFILES[self.ocr_profile]
+        if np is None or not profile["grayscale"]:
+            return image.convert('RGB') if image.mode != 'RGB' else image
+        
+        gray = preprocess_for_ocr(np.asarray(image.convert('RGB')), max_side=profile["max_side"])
+        if profile["osd_once"]:
+            rotation = self.detect_orientation(gray)
+            if rotation:
+                gray = np.ascontiguousarray(np.rot90(gray, k=-(rotation // 90)))
+        if profile["binarize"]:
+            gray = np.where(gray > otsu_threshold(gray), 255, 0).astype(np.uint8)
+        return Image.fromarray(gray)
+    
+    def ocr_cache_key(self, image) -> str:
+        """Cache key of an image before preprocessing: its pixels plus everything else that
+        affects the OCR output (Tesseract version, language, engine settings and the
+        profile's preprocessing)"""
+        profile = sorted(OCR_PROFILES[self.ocr_profile].items())
+        digest = hashlib.sha256()
+        digest.update(f"{self._tesseract_version}|{self.ocr_language}|{self.tesseract_config()}|"
+                      f"{profile}|{np is not None}|{image.mode}|{image.size}|".encode('utf-8'))
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+    
+    def ocr_image(self, image) -> str:
+        """Run Tesseract on a PIL image using the active OCR profile"""
+        # Looked up before preprocessing, so a hit also skips orientation detection (itself
+        # a Tesseract call); the text of an image does not depend on the document it is in
+        key = None
+        if self.ocr_cache is not None:
+            key = self.ocr_cache_key(image)
+            cached = self.ocr_cache.get(key)
+            if cached is not None:
+                self.run_stats["ocr_cache"]["hits"] += 1
+                return cached
+            self.run_stats["ocr_cache"]["misses"] += 1
+        
+        prepared = self.prepare_ocr_image(image)
+        
+        extracted_text = pytesseract.image_to_string(
+            prepared, 
+            lang=self.ocr_language,
+            config=self.tesseract_config()
+        )
+        
+        # Clean extracted text
+        text = self.clean_extracted_text(extracted_text)
+        if key is not None:
+            self.ocr_cache.put(key, text)
+        return text
+    
     def extract_text_from_image_ocr(self, image_data: bytes) -> str:
         """Extract text from image data using OCR"""
         if not self.use_ocr:
@@ -293,89 +2171,466 @@ class PDFExtractor:
         try:
             # Convert image data to PIL Image
             image = Image.open(io.BytesIO(image_data))
-            
-            # Convert to RGB if necessary
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Perform OCR
-            extracted_text = pytesseract.image_to_string(
-                image, 
-                lang=self.ocr_language,
-                config='--psm 1'  # Automatic page segmentation with OSD
-            )
-            
-            # Clean extracted text
-            return self.clean_extracted_text(extracted_text)
+            return self.ocr_image(image)
             
         except Exception as e:
             print(f"Warning: OCR failed on image: {e}")
             return ""
     
+    def render_page_for_ocr(self, page):
+        """Render a page to a PIL image at 2x zoom for full-page OCR, or smaller if that
+        would exceed max_render_pixels"""
+        # Render page as image with high DPI for better OCR
+        zoom = 2.0  # 2x zoom for better OCR accuracy
+        width, height = page.rect.width, page.rect.height
+        if self.max_render_pixels and (width * zoom + 1) * (height * zoom + 1) > self.max_render_pixels:
+            # Largest zoom with (w*z + 1)(h*z + 1) <= limit; the +1s allow for MuPDF
+            # rounding the pixel bounds outwards
+            a, b, c = width * height, width + height, 1 - self.max_render_pixels
+            zoom = (-b + (b * b - 4 * a * c) ** 0.5) / (2 * a)
+            self._record_limit(page.number + 1, f"OCR render of page {page.number + 1}", "downscaled",
+                               f"{width:.0f}x{height:.0f}pt page rendered at "
+                               f"{zoom:.3g}x to stay within {self.max_render_pixels:,} pixels")
+        mat = fitz.Matrix(zoom, zoom)
+        pix = page.get_pixmap(matrix=mat, alpha=False)
+        
+        # Wrap the rendered samples directly instead of round-tripping through PNG
+        return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    
     def extract_text_from_page_ocr(self, page) -> str:
         """Extract text from entire page using OCR (for scanned documents)"""
         if not self.use_ocr:
             return ""
         
         try:
-            # Render page as image with high DPI for better OCR
-            mat = fitz.Matrix(2.0, 2.0)  # 2x zoom for better OCR accuracy
-            pix = page.get_pixmap(matrix=mat)
-            
-            # Convert to PIL Image
-            img_data = pix.tobytes("png")
-            image = Image.open(io.BytesIO(img_data))
-            
-            # Perform OCR
-            extracted_text = pytesseract.image_to_string(
-                image, 
-                lang=self.ocr_language,
-                config='--psm 1'  # Automatic page segmentation with OSD
-            )
-            
-            pix = None  # Clean up
-            
-            # Clean and return extracted text
-            return self.clean_extracted_text(extracted_text)
+            return self.ocr_image(self.render_page_for_ocr(page))
             
         except Exception as e:
             print(f"Warning: Page OCR failed: {e}")
             return ""
     
-    def is_page_mostly_images(self, page, text_threshold: int = 50) -> bool:
-        """Determine if a page is mostly images (likely scanned) based on text content"""
+    def is_page_mostly_images(self, page, text_threshold: int = 50, text: str = None) -> bool:
+        """Determine if a page is mostly images (likely scanned) based on text content.
+        text is the page's get_text() output when the caller already has it"""
         try:
-            page_text = page.get_text().strip()
+            page_text = (page.get_text() if text is None else text).strip()
             # If very little extractable text, likely a scanned page
             return len(page_text) < text_threshold
         except:
             return True  # If we can't extract text, assume it's image-based
 
+def _page_worker_main(conn, extractor_class, config):
+    """Worker process loop: open documents and extract single pages on request"""
+    extractor = extractor_class(**config)
+    doc = None
+    conn.send(("ready", None))
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        command, payload = message
+        try:
+            if command == "open":
+                if doc is not None:
+                    doc.close()
+                if isinstance(payload, str):
+                    doc = fitz.open(payload)
+                else:
+                    doc = fitz.open(stream=payload, filetype="pdf")
+                extractor.start_document()
+                conn.send(("ok", None))
+            elif command == "page":
+                # The document's image-byte total is kept by the parent, so a restarted
+                # worker continues from it
+                page_index, images_dir, extractor._image_bytes, keep_images = payload
+                extractor.run_stats = extractor._new_run_stats()
+                # Images nobody keeps are not encoded or sent back
+                extractor.memory_images = {} if keep_images else None
+                record = extractor.extract_page(doc[page_index], page_index + 1, images_dir)
+                conn.send(("ok", (record, extractor.run_stats, extractor.memory_images or {},
+                                  extractor._image_bytes)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+    if doc is not None:
+        doc.close()
+
+
+class SupervisedPageWorker:
+    """Runs extract_page in a child process with a wall-clock limit per page.
+    
+    A page that times out or kills the worker (e.g. a MuPDF segfault) is returned as a
+    [PAGE N: ERROR ...] record; the worker is restarted for the next page."""
+    
+    STARTUP_TIMEOUT = 120  # importing PyMuPDF/tiktoken in a fresh process is not counted against pages
+    
+    def __init__(self, extractor: PDFExtractor, source, timeout: float):
+        if not source:
+            raise ValueError("Page timeouts require a document opened from a file path or bytes")
+        self.extractor = extractor
+        # A path, or the document bytes for in-memory extraction
+        self.source = source if isinstance(source, str) else bytes(source)
+        self.timeout = timeout
+        self.context = multiprocessing.get_context("spawn")
+        self.process = None
+        self.conn = None
+    
+    def has_open(self, source) -> bool:
+        """Whether source (the same path, or the same bytes object) is the current document"""
+        return source is self.source or (isinstance(source, str) and source == self.source)
+    
+    def open(self, source):
+        """Switch to another document (a path or bytes), in place if the process is running"""
+        if self.has_open(source):
+            return
+        self.source = source if isinstance(source, str) else bytes(source)
+        if self.process is not None:
+            try:
+                self.conn.send(("open", self.source))
+                self._receive(self.STARTUP_TIMEOUT)
+            except (TimeoutError, EOFError, OSError, RuntimeError):
+                self._kill()  # the next page restarts the worker on the new document
+    
+    def _start(self):
+        parent_conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_page_worker_main,
+            args=(child_conn, type(self.extractor), self.extractor.worker_config()),
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self._receive(self.STARTUP_TIMEOUT)
+        self.conn.send(("open", self.source))
+        self._receive(self.STARTUP_TIMEOUT)
+    
+    def _receive(self, timeout: float):
+        """Wait for the worker's reply; raises TimeoutError or EOFError (worker died)"""
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"timed out after {timeout:g}s")
+        status, payload = self.conn.recv()
+        if status == "error":
+            raise RuntimeError(payload)
+        return payload
+    
+    def _kill(self):
+        if self.process is not None:
+            if self.process.is_alive():
+                self.process.kill()
+            self.process.join()
+            self.conn.close()
+        self.process = None
+        self.conn = None
+    
+    def extract_page(self, page_index: int, images_dir: str) -> Dict[str, any]:
+        page_num = page_index + 1
+        try:
+            if self.process is None:
+                self._start()
+            self.conn.send(("page", (page_index, images_dir, self.extractor._image_bytes,
+                                     self.extractor.memory_images is not None)))
+            record, stats, images, self.extractor._image_bytes = self._receive(self.timeout)
+            self.extractor.merge_run_stats(stats)
+            if self.extractor.memory_images is not None:
+                self.extractor.memory_images.update(images)
+            return record
+        except TimeoutError as e:
+            self._kill()
+            error = str(e)
+        except (EOFError, OSError):
+            exitcode = self.process.exitcode if self.process is not None else None
+            if self.process is not None:
+                self.process.join(5)
+                exitcode = self.process.exitcode
+            self._kill()
+            error = f"worker crashed (exit code {exitcode})"
+        except RuntimeError as e:
+            # Ordinary exception inside the worker; the process is still usable
+            error = str(e)
+        
+        print(f"Warning: Page {page_num} failed: {error}")
+        self.extractor.run_stats.setdefault("page_errors", []).append({"page": page_num, "error": error})
+        return {"page": page_num, "text": f"[PAGE {page_num}: ERROR {error}]", "images": []}
+    
+    def close(self):
+        if self.process is not None and self.process.is_alive():
+            try:
+                self.conn.send(None)
+                self.process.join(5)
+            except (OSError, EOFError):
+                pass
+        self._kill()
+
+
+# Backslash escapes accepted in --delimiter: \\, quotes, single letters, octal, \xhh, \uXXXX, \UXXXXXXXX
+DELIMITER_ESCAPE_PATTERN = re.compile(r'\\(?:[\\\'"abfnrtv]|[0-7]{1,3}|x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8})')
+
+
+def decode_escapes(text: str) -> str:
+    """Replace backslash escapes in text, leaving every other character (including
+    non-ASCII ones, which unicode_escape would garble) as it is"""
+    return DELIMITER_ESCAPE_PATTERN.sub(lambda match: codecs.decode(match.group(0), 'unicode_escape'), text)
+
+
+def write_chunk_stream(extractor: PDFExtractor, data, out, output_format: str = "text",
+                       delimiter: str = "\n\f\n", images_dir: str = None) -> int:
+    """Stream the chunks of an in-memory PDF to a binary file object, flushing each one
+    as soon as it is complete. Returns the number of chunks written."""
+    count = 0
+    for chunk in extractor.iter_chunks_from_bytes(data, images_dir):
+        if output_format == "jsonl":
+            record = {"chunk": count + 1, "tokens": extractor.count_tokens(chunk), "text": chunk}
+            out.write((json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8'))
+        elif output_format == "nul":
+            out.write(chunk.encode('utf-8') + b"\0")
+        else:
+            if count:
+                out.write(delimiter.encode('utf-8'))
+            out.write(chunk.encode('utf-8'))
+        out.flush()
+        count += 1
+    if output_format == "text" and count:
+        out.write(b"\n")
+        out.flush()
+    return count
+
+
 def main():
     parser = argparse.ArgumentParser(description="Extract text and images from PDF with token splitting and OCR support")
-    parser.add_argument("pdf_path", nargs='+', help="Path to PDF file(s) - supports multiple files and wildcards")
+    parser.add_argument("pdf_path", nargs='*',
+                       help="Path to PDF file(s) - supports multiple files and wildcards; "
+                            "'-' reads one PDF from stdin and streams chunks to stdout")
     parser.add_argument("-o", "--output", help="Output directory (default: {pdf_name}_extracted for each file)")
     parser.add_argument("-t", "--max-tokens", type=int, default=45000, 
                        help="Maximum tokens per output file (default: 45000)")
     parser.add_argument("-b", "--batch", action="store_true", 
-                       help="Batch mode: put all files in single output directory")
+                       help="Batch mode: pack all documents into shared text files of up to --max-tokens "
+                            "in one output directory (default: batch_extracted), with an index")
     parser.add_argument("--ocr", action="store_true", 
                        help="Enable OCR for scanned documents (requires Tesseract)")
     parser.add_argument("--ocr-lang", default="eng", 
                        help="OCR language code (default: eng). Examples: vie (Vietnamese), eng+vie (multiple)")
+    parser.add_argument("--ocr-profile", choices=list(OCR_PROFILES), default="accurate",
+                       help="OCR speed/accuracy profile (default: accurate)")
+    parser.add_argument("--ocr-cache", metavar="PATH",
+                       help="SQLite file caching OCR results by image content, shared across runs and processes")
+    parser.add_argument("--ocr-cache-size", type=int, default=512, metavar="MB",
+                       help="Maximum size of the OCR cache texts before LRU eviction (default: 512)")
+    parser.add_argument("--text-quality-threshold", type=float, default=0.5, metavar="SCORE",
+                       help="With --ocr, OCR full pages whose text-layer quality score (0-1) is below this "
+                            "(default: 0.5)")
+    parser.add_argument("--skip-blank-images", action="store_true",
+                       help="Do not save blank or near-uniform images (they are never OCR'd)")
+    parser.add_argument("--layout", action="store_true",
+                       help="Place image references where the images appear in the page's reading order")
+    parser.add_argument("--page-timeout", type=float, metavar="SECONDS",
+                       help="Extract pages in a supervised worker process; pages that exceed this time "
+                            "or crash the worker are replaced by an error marker")
+    parser.add_argument("--strip-boilerplate", choices=["remove", "note"],
+                       help="Drop headers, footers and notices repeated on most pages "
+                            "(note: list them once at the top of the output)")
+    parser.add_argument("--format", choices=["text", "nul", "jsonl"], default="text",
+                       help="Pipe mode output: chunks joined by --delimiter, NUL-terminated, or JSON lines")
+    parser.add_argument("--delimiter", default="\\n\\f\\n",
+                       help="Pipe mode chunk delimiter for --format text; escapes allowed (default: \\n\\f\\n)")
+    parser.add_argument("--images-dir", help="Pipe mode: write images here (default: images are not kept)")
+    parser.add_argument("--estimate", action="store_true",
+                       help="Dry run: estimate pages, OCR work, tokens, chunks and time without extracting")
+    parser.add_argument("--sample-pages", type=int, default=12,
+                       help="Pages probed per PDF by --estimate (default: 12)")
+    parser.add_argument("--rates", help="Stage rates file for --estimate (default: stage_rates.json if present, "
+                                        "written by 'benchmark.py calibrate')")
+    parser.add_argument("--prefetch", type=int, default=2, metavar="N",
+                       help="Read the next N PDFs ahead in background threads while one is processed "
+                            "(default: 2, 0 disables)")
+    parser.add_argument("--prefetch-mb", type=int, default=512, metavar="MB",
+                       help="Maximum size of the PDFs held by the prefetcher at once (default: 512)")
+    parser.add_argument("--scratch-dir", help="Prefetch into copies in this local directory instead of memory")
+    parser.add_argument("--max-image-pixels", type=int, default=100_000_000,
+                       help="Skip embedded images with more pixels than this (default: 100000000, 0 disables)")
+    parser.add_argument("--max-render-pixels", type=int, default=50_000_000,
+                       help="Downscale OCR page renders to at most this many pixels (default: 50000000, 0 disables)")
+    parser.add_argument("--max-pages", type=int, help="Skip pages after this many in each document")
+    parser.add_argument("--max-image-mb", type=int,
+                       help="Skip a document's remaining images once its decoded images reach this size")
+    parser.add_argument("--plan-shards", type=int, metavar="N",
+                       help="Split each PDF's pages into N shards and write a shard manifest")
+    parser.add_argument("--manifest", help="Shard manifest written by --plan-shards (used with --shard or --merge-shards)")
+    parser.add_argument("--shard", type=int, metavar="K",
+                       help="Extract shard K of --manifest into its shard directory (-o overrides it)")
+    parser.add_argument("--merge-shards", action="store_true",
+                       help="Merge the completed shards of --manifest into the final text files")
+    parser.add_argument("--rechunk", action="store_true",
+                       help="Rebuild the text files of existing output directories (or of the given PDFs' "
+                            "default output directories) at --max-tokens from their saved page records")
+    parser.add_argument("-r", "--recursive", action="store_true",
+                       help="Treat paths as directories: walk them recursively and only process new or changed PDFs")
+    parser.add_argument("--prune", action="store_true",
+                       help="With --recursive, delete outputs of PDFs that no longer exist")
     
     args = parser.parse_args()
     
+    if args.manifest and args.shard is None and not args.merge_shards:
+        parser.error("--manifest requires --shard or --merge-shards")
+    if (args.shard is not None or args.merge_shards) and not args.manifest:
+        parser.error("--shard and --merge-shards require --manifest")
+    if not args.manifest and not args.pdf_path:
+        parser.error("the following arguments are required: pdf_path")
+    if "-" in args.pdf_path and len(args.pdf_path) > 1:
+        parser.error("'-' (stdin) cannot be combined with other paths")
+    
+    # Pipe mode: PDF on stdin, chunks on stdout; all log output goes to stderr
+    if args.pdf_path == ["-"]:
+        # Chunks are written to a private copy of fd 1, and fd 1 itself now points at stderr,
+        # so output from page worker processes (which inherit fd 1) or C libraries cannot
+        # end up in the chunk stream
+        sys.stdout.flush()
+        stdout_fd = os.dup(1)
+        stdout = os.fdopen(stdout_fd, "wb")
+        os.dup2(2, 1)
+        try:
+            with contextlib.redirect_stdout(sys.stderr):
+                extractor = PDFExtractor(
+                    max_tokens=args.max_tokens, 
+                    use_ocr=args.ocr,
+                    ocr_language=args.ocr_lang,
+                    layout=args.layout,
+                    skip_blank_images=args.skip_blank_images,
+                    ocr_profile=args.ocr_profile,
+                    page_timeout=args.page_timeout,
+                    boilerplate=args.strip_boilerplate,
+                    ocr_cache=args.ocr_cache,
+                    ocr_cache_size=args.ocr_cache_size * 2**20,
+                    text_quality_threshold=args.text_quality_threshold,
+                    max_image_pixels=args.max_image_pixels,
+                    max_render_pixels=args.max_render_pixels,
+                    max_pages=args.max_pages,
+                    max_image_bytes=args.max_image_mb * 2**20 if args.max_image_mb else None
+                )
+                data = sys.stdin.buffer.read()
+                if not data:
+                    raise ValueError("No PDF data on stdin")
+                delimiter = decode_escapes(args.delimiter)
+                count = write_chunk_stream(extractor, data, stdout, args.format, delimiter, args.images_dir)
+                stdout.close()
+                print(f"✓ Wrote {count} chunk(s) to stdout")
+        except BrokenPipeError:
+            # Downstream consumer went away. Point the chunk stream at devnull so flushing
+            # what is still buffered at exit cannot raise again (as the Python docs
+            # recommend for SIGPIPE); stderr stays open for the message
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, stdout_fd)
+            print("Error: output closed by the reader", file=sys.stderr)
+            sys.exit(1)
+        except Exception as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+    
     try:
         extractor = PDFExtractor(
             max_tokens=args.max_tokens, 
             use_ocr=args.ocr,
-            ocr_language=args.ocr_lang
+            ocr_language=args.ocr_lang,
+            layout=args.layout,
+            skip_blank_images=args.skip_blank_images,
+            ocr_profile=args.ocr_profile,
+            page_timeout=args.page_timeout,
+            boilerplate=args.strip_boilerplate,
+            ocr_cache=args.ocr_cache,
+            ocr_cache_size=args.ocr_cache_size * 2**20,
+            text_quality_threshold=args.text_quality_threshold,
+            max_image_pixels=args.max_image_pixels,
+            max_render_pixels=args.max_render_pixels,
+            max_pages=args.max_pages,
+            max_image_bytes=args.max_image_mb * 2**20 if args.max_image_mb else None
         )
         
+        # Shard workflow on an existing manifest
+        if args.manifest:
+            if args.shard is not None:
+                pdf_override = args.pdf_path[0] if args.pdf_path else None
+                summary = extractor.run_shard(args.manifest, args.shard, pdf_override, args.output)
+                print(f"  ✓ Shard {summary['shard']}: {summary['pages']} pages, "
+                      f"{len(summary['images'])} images -> {summary['shard_dir']}")
+            else:
+                result = extractor.merge_shards(args.manifest, args.output)
+                print(f"  ✓ Text files: {len(result['text_files'])}")
+                print(f"  ✓ Images: {result['image_count']}")
+                print(f"  ✓ Tokens: {result['total_tokens']:,}")
+            return
+        
+        # Re-split existing outputs at a new token limit from their page records
+        if args.rechunk:
+            output_dirs = []
+            for path in map(Path, args.pdf_path):
+                if path.is_dir():
+                    # An output directory, or a tree containing several
+                    output_dirs.extend(sorted({p.parent for p in path.rglob(f"*{PAGES_SUFFIX}")}))
+                elif path.suffix.lower() == '.pdf':
+                    base_dir = Path(args.output) if args.output else path.parent
+                    output_dirs.append(base_dir / f"{path.stem}_extracted")
+            if not output_dirs:
+                print("No page records found to rechunk!", file=sys.stderr)
+                sys.exit(1)
+            
+            failed = 0
+            for output_dir in output_dirs:
+                print(f"Rechunking: {output_dir}")
+                try:
+                    for result in extractor.rechunk(str(output_dir)):
+                        print(f"  ✓ Text files: {len(result['text_files'])}")
+                        print(f"  ✓ Tokens: {result['total_tokens']:,}")
+                except Exception as e:
+                    print(f"  ✗ Error: {e}", file=sys.stderr)
+                    failed += 1
+            if failed:
+                sys.exit(1)
+            return
+        
+        # Read-ahead of upcoming PDFs, used by every mode that processes several files
+        prefetch = {"depth": args.prefetch, "max_bytes": args.prefetch_mb * 2**20,
+                    "scratch_dir": args.scratch_dir}
+        
+        # Incremental sync of directory trees
+        if args.recursive and not args.estimate:
+            totals = {"scanned": 0, "processed": 0, "unchanged": 0, "failed": 0, "pruned": 0,
+                      "prefetched": 0, "io_stall_seconds": 0.0}
+            for source_dir in args.pdf_path:
+                print(f"Syncing directory: {source_dir}")
+                output_root = None
+                if args.output:
+                    # Keep several trees apart under one output directory
+                    output_root = Path(args.output)
+                    if len(args.pdf_path) > 1:
+                        output_root = output_root / Path(source_dir).resolve().name
+                summary = extractor.sync_directory(source_dir, output_root, prune=args.prune, prefetch=prefetch)
+                for key in totals:
+                    totals[key] += summary[key]
+            
+            print("\n" + "="*50)
+            print("SYNC COMPLETE")
+            print("="*50)
+            print(f"PDFs found: {totals['scanned']}")
+            print(f"Processed (new or changed): {totals['processed']}")
+            print(f"Unchanged: {totals['unchanged']}")
+            print(f"Failed: {totals['failed']}")
+            print(f"Pruned: {totals['pruned']}")
+            if args.prefetch > 0:
+                print(f"Prefetched: {totals['prefetched']}/{totals['processed'] + totals['failed']} PDFs, "
+                      f"I/O stall: {totals['io_stall_seconds']:.1f}s")
+            if totals["failed"]:
+                sys.exit(1)
+            return
+        
         # Handle multiple PDF files
         pdf_files = []
         for path_pattern in args.pdf_path:
+            if args.recursive:
+                pdf_files.extend(Path(path) for path in iter_pdf_files(path_pattern))
+                continue
             # Expand wildcards
             expanded_paths = Path().glob(path_pattern) if '*' in path_pattern else [Path(path_pattern)]
             for path in expanded_paths:
@@ -386,13 +2641,78 @@ def main():
             print("No PDF files found!", file=sys.stderr)
             sys.exit(1)
         
+        if args.estimate:
+            rates = load_stage_rates(args.rates)
+            totals = {"pages": 0, "scanned_pages": 0, "ocr_pages": 0, "images": 0,
+                      "tokens": 0, "chunks": 0, "seconds": 0.0, "estimate_seconds": 0.0}
+            print(f"{'PDF':<40} {'Pages':>6} {'Scanned':>8} {'OCR':>6} {'Images':>7} "
+                  f"{'Tokens':>11} {'Chunks':>7} {'Est. time':>10}")
+            for pdf_path in pdf_files:
+                try:
+                    estimate = extractor.estimate_pdf(str(pdf_path), args.sample_pages, rates, ocr=args.ocr)
+                except Exception as e:
+                    print(f"{pdf_path.name[:40]:<40} ✗ Error: {e}", file=sys.stderr)
+                    continue
+                for key in totals:
+                    totals[key] += estimate[key]
+                print(f"{pdf_path.name[:40]:<40} {estimate['pages']:>6} {estimate['scanned_pages']:>8} "
+                      f"{estimate['ocr_pages']:>6} {estimate['images']:>7} {estimate['tokens']:>11,} "
+                      f"{estimate['chunks']:>7} {estimate['seconds']:>9.1f}s")
+            
+            print("\n" + "="*50)
+            print("ESTIMATE")
+            print("="*50)
+            print(f"PDFs: {len(pdf_files)}")
+            print(f"Pages: {totals['pages']:,} ({totals['scanned_pages']:,} scanned, "
+                  f"{totals['ocr_pages']:,} to OCR)")
+            print(f"Images: {totals['images']:,}")
+            print(f"Tokens: ~{totals['tokens']:,} in ~{totals['chunks']:,} text file(s)")
+            expected = (f"{totals['seconds'] / 60:.1f} min" if totals['seconds'] >= 60
+                        else f"{totals['seconds']:.1f}s")
+            print(f"Expected time: ~{expected} (estimated in {totals['estimate_seconds']:.1f}s)")
+            return
+        
+        if args.plan_shards:
+            for pdf_path in pdf_files:
+                base_dir = Path(args.output) if args.output else pdf_path.parent
+                extractor.plan_shards(str(pdf_path), args.plan_shards,
+                                      base_dir / f"{pdf_path.stem}_shards",
+                                      base_dir / f"{pdf_path.stem}_extracted")
+            return
+        
+        if args.batch:
+            output_dir = Path(args.output) if args.output else Path("batch_extracted")
+            print(f"Packing {len(pdf_files)} PDF file(s) into {output_dir}...")
+            result = extractor.pack_documents([str(p) for p in pdf_files], str(output_dir), prefetch=prefetch)
+            
+            print("\n" + "="*50)
+            print("BATCH PACKING COMPLETE")
+            print("="*50)
+            print(f"PDFs packed: {result['documents']}")
+            print(f"Failed: {len(result['failed'])}")
+            print(f"Total text files: {len(result['text_files'])}")
+            print(f"Total images: {result['image_count']}")
+            print(f"Total tokens: {result['total_tokens']:,}")
+            if args.prefetch > 0:
+                print(f"Prefetched: {result['prefetched']}/{len(pdf_files)} PDFs, "
+                      f"I/O stall: {result['io_stall_seconds']:.1f}s")
+            if extractor.ocr_cache:
+                print(f"OCR cache: {result['ocr_cache']['hits']} hits, {result['ocr_cache']['misses']} misses")
+            print(f"Index: {result['index_path']}")
+            if result['failed']:
+                sys.exit(1)
+            return
+        
         print(f"Processing {len(pdf_files)} PDF file(s)...")
         
         total_files = 0
         total_images = 0
         total_tokens = 0
+        cache_hits = cache_misses = 0
+        page_ocr = {"runs": 0, "avoided": 0, "added": 0}
         
-        for i, pdf_path in enumerate(pdf_files, 1):
+        prefetcher = PDFPrefetcher(pdf_files, **prefetch)
+        for i, (pdf_path, source) in enumerate(prefetcher, 1):
             print(f"\n[{i}/{len(pdf_files)}] Processing: {pdf_path.name}")
             
             # Determine output directory (same logic as single file)
@@ -402,7 +2722,8 @@ def main():
                 output_dir = pdf_path.parent / f"{pdf_path.stem}_extracted"
             
             try:
-                result = extractor.process_pdf(str(pdf_path), str(output_dir))
+                result = extractor.process_pdf(str(pdf_path), str(output_dir), source=source,
+                                               prefetcher=prefetcher)
                 
                 total_files += len(result['text_files'])
                 total_images += result['image_count']
@@ -411,6 +2732,12 @@ def main():
                 print(f"  ✓ Text files: {len(result['text_files'])}")
                 print(f"  ✓ Images: {result['image_count']}")
                 print(f"  ✓ Tokens: {result['total_tokens']:,}")
+                if result['boilerplate']['tokens_saved']:
+                    print(f"  ✓ Boilerplate tokens saved: {result['boilerplate']['tokens_saved']:,}")
+                cache_hits += result['ocr_cache']['hits']
+                cache_misses += result['ocr_cache']['misses']
+                for key in page_ocr:
+                    page_ocr[key] += result['page_ocr'][key]
                 
             except Exception as e:
                 print(f"  ✗ Error: {e}", file=sys.stderr)
@@ -423,10 +2750,19 @@ def main():
         print(f"Total text files: {total_files}")
         print(f"Total images: {total_images}")
         print(f"Total tokens: {total_tokens:,}")
+        if args.prefetch > 0:
+            print(f"Prefetched: {prefetcher.prefetched}/{len(pdf_files)} PDFs, "
+                  f"I/O stall: {prefetcher.stall_seconds:.1f}s")
+        if extractor.ocr_cache:
+            print(f"OCR cache: {cache_hits} hits, {cache_misses} misses")
+        if extractor.use_ocr:
+            print(f"Full-page OCR: {page_ocr['runs']} page(s) "
+                  f"({page_ocr['avoided']} avoided, {page_ocr['added']} added by text-layer scoring)")
         
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # worker processes in frozen (PyInstaller) builds
     main()
\ No newline at end of file
@@ -7,12 +7,14 @@ A user-friendly graphical interface for extracting text and images from PDF file
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 import os
+import queue
 import threading
+import time
 from pathlib import Path
 import sys
 
 # Import the main extractor class
-from pdf_extractor import PDFExtractor
+from pdf_extractor import PDFExtractor, ExtractionCancelled, OCR_PROFILES
 
 class PDFExtractorGUI:
     def __init__(self, root):
@@ -31,9 +33,17 @@ class PDFExtractorGUI:
         self.max_tokens = tk.IntVar(value=45000)
         self.use_ocr = tk.BooleanVar(value=False)
         self.ocr_language = tk.StringVar(value="eng")
+        self.ocr_profile = tk.StringVar(value="accurate")
         self.processing = False
         
+        # The worker thread never touches Tk widgets; it posts events here and
+        # process_events() applies them on the Tk thread
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.page_started_at = None
+        
         self.create_widgets()
+        self.root.after(100, self.process_events)
         
     def create_widgets(self):
         # Main frame
@@ -103,6 +113,11 @@ class PDFExtractorGUI:
                                      width=15, state="readonly")
         self.ocr_combo.grid(row=0, column=1, sticky=tk.W, padx=(10, 0))
         
+        ttk.Label(self.ocr_frame, text="OCR Profile:").grid(row=1, column=0, sticky=tk.W, pady=(5, 0))
+        self.profile_combo = ttk.Combobox(self.ocr_frame, textvariable=self.ocr_profile, 
+                                         values=list(OCR_PROFILES), width=15, state="readonly")
+        self.profile_combo.grid(row=1, column=1, sticky=tk.W, padx=(10, 0), pady=(5, 0))
+        
         # Initially disable OCR settings
         self.toggle_ocr_settings()
         
@@ -110,26 +125,35 @@ class PDFExtractorGUI:
         self.progress_var = tk.DoubleVar()
         self.progress_bar = ttk.Progressbar(main_frame, variable=self.progress_var, 
                                            maximum=100, length=300)
-        self.progress_bar.grid(row=5, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=10)
+        self.progress_bar.grid(row=5, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=(10, 0))
+        
+        # Page rate and ETA for the current file
+        self.rate_var = tk.StringVar(value="")
+        ttk.Label(main_frame, textvariable=self.rate_var).grid(row=6, column=0, columnspan=3, 
+                                                               sticky=tk.W, pady=(2, 5))
         
         # Status text
         self.status_text = scrolledtext.ScrolledText(main_frame, height=10, width=70)
-        self.status_text.grid(row=6, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S), pady=5)
-        main_frame.rowconfigure(6, weight=1)
+        self.status_text.grid(row=7, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S), pady=5)
+        main_frame.rowconfigure(7, weight=1)
         
         # Buttons
         button_frame = ttk.Frame(main_frame)
-        button_frame.grid(row=7, column=0, columnspan=3, pady=10)
+        button_frame.grid(row=8, column=0, columnspan=3, pady=10)
         
         self.extract_button = ttk.Button(button_frame, text="Extract PDFs", 
                                         command=self.start_extraction)
         self.extract_button.grid(row=0, column=0, padx=(0, 10))
         
+        self.cancel_button = ttk.Button(button_frame, text="Cancel", 
+                                       command=self.cancel_extraction, state='disabled')
+        self.cancel_button.grid(row=0, column=1, padx=(0, 10))
+        
         ttk.Button(button_frame, text="Clear Log", 
-                  command=self.clear_log).grid(row=0, column=1, padx=(0, 10))
+                  command=self.clear_log).grid(row=0, column=2, padx=(0, 10))
         
         ttk.Button(button_frame, text="Exit", 
-                  command=self.root.quit).grid(row=0, column=2)
+                  command=self.root.quit).grid(row=0, column=3)
         
         # Add some initial text
         self.log_message("Ready to extract PDF files...")
@@ -165,10 +189,47 @@ class PDFExtractorGUI:
             self.output_directory.set(directory)
     
     def log_message(self, message):
-        """Add message to status log"""
-        self.status_text.insert(tk.END, f"{message}\n")
-        self.status_text.see(tk.END)
-        self.root.update_idletasks()
+        """Add message to status log (safe to call from any thread)"""
+        self.events.put(("log", message))
+    
+    def process_events(self):
+        """Apply queued worker events to the widgets; runs on the Tk thread via after()"""
+        try:
+            while True:
+                kind, payload = self.events.get_nowait()
+                if kind == "log":
+                    self.status_text.insert(tk.END, f"{payload}\n")
+                    self.status_text.see(tk.END)
+                elif kind == "progress":
+                    self.update_progress(*payload)
+                elif kind == "finished":
+                    self.finish_extraction(*payload)
+        except queue.Empty:
+            pass
+        self.root.after(100, self.process_events)
+    
+    def update_progress(self, file_index, total_files, event):
+        """Update the progress bar, page rate and ETA from an extractor event"""
+        total_pages = max(event["total_pages"], 1)
+        if event["event"] == "start":
+            self.page_started_at = time.monotonic()
+            pages_done = 0
+        elif event["event"] == "page":
+            pages_done = event["pages_done"]
+        else:
+            return
+        
+        self.progress_var.set((file_index + pages_done / total_pages) / total_files * 100)
+        
+        elapsed = time.monotonic() - self.page_started_at
+        if pages_done and elapsed > 0:
+            rate = pages_done / elapsed
+            remaining = (event["total_pages"] - pages_done) / rate
+            minutes, seconds = divmod(int(remaining), 60)
+            self.rate_var.set(f"File {file_index + 1}/{total_files}: page {pages_done}/{event['total_pages']} "
+                              f"- {rate:.2f} pages/s - ETA {minutes}:{seconds:02d}")
+        else:
+            self.rate_var.set(f"File {file_index + 1}/{total_files}: page 0/{event['total_pages']}")
     
     def clear_log(self):
         """Clear the status log"""
@@ -190,61 +251,98 @@ class PDFExtractorGUI:
         
         # Start extraction in background thread
         self.processing = True
+        self.cancel_event.clear()
         self.extract_button.config(state='disabled')
+        self.cancel_button.config(state='normal')
         self.progress_var.set(0)
-        
-        thread = threading.Thread(target=self.extract_files)
+        self.rate_var.set("")
+        
+        # Tk variables are read here, on the Tk thread, not in the worker
+        settings = {
+            "files": list(self.selected_files),
+            "output_directory": self.output_directory.get(),
+            "max_tokens": self.max_tokens.get(),
+            "use_ocr": self.use_ocr.get(),
+            "ocr_language": self.ocr_language.get(),
+            "ocr_profile": self.ocr_profile.get()
+        }
+        
+        thread = threading.Thread(target=self.extract_files, args=(settings,))
         thread.daemon = True
         thread.start()
     
-    def extract_files(self):
+    def cancel_extraction(self):
+        """Ask the worker to stop; it finishes the current page first"""
+        if self.processing:
+            self.cancel_event.set()
+            self.cancel_button.config(state='disabled')
+            self.log_message("Cancelling after the current page...")
+    
+    def extract_files(self, settings):
         """Extract files (runs in background thread)"""
+        total_files = len(settings["files"])
+        processed = 0
         try:
             extractor = PDFExtractor(
-                max_tokens=self.max_tokens.get(),
-                use_ocr=self.use_ocr.get(),
-                ocr_language=self.ocr_language.get()
+                max_tokens=settings["max_tokens"],
+                use_ocr=settings["use_ocr"],
+                ocr_language=settings["ocr_language"],
+                ocr_profile=settings["ocr_profile"],
+                cancel_event=self.cancel_event
             )
-            total_files = len(self.selected_files)
             
-            if self.use_ocr.get():
-                self.log_message(f"OCR enabled (language: {self.ocr_language.get()})")
+            if settings["use_ocr"]:
+                self.log_message(f"OCR enabled (language: {settings['ocr_language']}, "
+                                 f"profile: {settings['ocr_profile']})")
             
             self.log_message(f"Starting extraction of {total_files} file(s)...")
             
-            for i, pdf_path in enumerate(self.selected_files):
-                progress = (i / total_files) * 100
-                self.progress_var.set(progress)
+            for i, pdf_path in enumerate(settings["files"]):
+                extractor.progress_callback = (
+                    lambda event, i=i: self.events.put(("progress", (i, total_files, event))))
                 
                 filename = os.path.basename(pdf_path)
                 self.log_message(f"Processing: {filename}")
                 
                 try:
                     # Set output directory for this file
-                    output_dir = os.path.join(self.output_directory.get(), 
+                    output_dir = os.path.join(settings["output_directory"], 
                                             f"{Path(pdf_path).stem}_extracted")
                     
                     result = extractor.process_pdf(pdf_path, output_dir)
+                    processed += 1
                     
                     self.log_message(f"✓ Completed: {filename}")
                     self.log_message(f"  - Text files: {len(result['text_files'])}")
                     self.log_message(f"  - Images: {result['image_count']}")
                     self.log_message(f"  - Total tokens: {result['total_tokens']:,}")
                     
+                except ExtractionCancelled:
+                    raise
                 except Exception as e:
                     self.log_message(f"✗ Error processing {filename}: {str(e)}")
             
-            self.progress_var.set(100)
             self.log_message("Extraction completed!")
-            messagebox.showinfo("Success", f"Successfully processed {total_files} file(s)!")
+            self.events.put(("finished", ("done", f"Successfully processed {total_files} file(s)!")))
             
+        except ExtractionCancelled:
+            self.log_message(f"Extraction cancelled ({processed}/{total_files} file(s) completed)")
+            self.events.put(("finished", ("cancelled", None)))
+        
         except Exception as e:
             self.log_message(f"Error: {str(e)}")
-            messagebox.showerror("Error", f"Extraction failed: {str(e)}")
-        
-        finally:
-            self.processing = False
-            self.extract_button.config(state='normal')
+            self.events.put(("finished", ("error", f"Extraction failed: {str(e)}")))
+    
+    def finish_extraction(self, status, message):
+        """Reset the controls once the worker has stopped (Tk thread)"""
+        self.processing = False
+        self.extract_button.config(state='normal')
+        self.cancel_button.config(state='disabled')
+        if status == "done":
+            self.progress_var.set(100)
+            messagebox.showinfo("Success", message)
+        elif status == "error":
+            messagebox.showerror("Error", message)
     
     def toggle_ocr_settings(self):
         """Enable/disable OCR settings based on checkbox"""
@@ -3,14 +3,60 @@
 Test suite for PDF Text and Image Extractor
 """
 
+import asyncio
 import tempfile
 import os
+import sys
+import subprocess
+import time
 from pathlib import Path
 import shutil
 import re
+import json
+import io
 
-# Import the class we'll be testing (assuming it will be in pdf_extractor.py)
-# from pdf_extractor import PDFExtractor
+import fitz
+import numpy as np
+import pytesseract
+import pytest
+import tiktoken
+from PIL import Image
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pdf_extractor import (PDFExtractor, ExtractionCancelled, image_blank_stats,
+                           otsu_threshold, preprocess_for_ocr, write_chunk_stream, load_stage_rates,
+                           OCRCache, text_layer_stats, PDFPrefetcher, SupervisedPageWorker, open_pdf)
+
+
+def _tokenizer_available():
+    """The cl100k_base encoding is downloaded on first use; skip when offline"""
+    try:
+        tiktoken.get_encoding("cl100k_base")
+        return True
+    except Exception:
+        return False
+
+
+requires_tokenizer = pytest.mark.skipif(not _tokenizer_available(),
+                                        reason="tiktoken cl100k_base encoding not available")
+
+
+def make_test_pdf(path, pages=3, images_every=2):
+    """Create a small PDF with text on every page and an RGB image on every Nth page"""
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Heading for page {i + 1}", fontsize=16)
+        page.insert_text((72, 110), f"Body text of page {i + 1}. " * 4, fontsize=10)
+        if images_every and i % images_every == 0:
+            pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 40, 30), False)
+            pix.set_rect(pix.irect, (30 * (i % 8), 120, 200))
+            page.insert_image(fitz.Rect(72, 200, 232, 320), pixmap=pix)
+    doc.save(str(path))
+    doc.close()
+    return Path(path)
 
 class TestPDFExtractor:
     def setup_method(self):
@@ -151,6 +197,1258 @@ class TestPDFExtractor:
             return False
         return True
 
+@requires_tokenizer
+class TestShardedProcessing:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.pdf = make_test_pdf(self.test_dir / "archive.pdf", pages=7)
+        self.extractor = PDFExtractor(max_tokens=120)
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_plan_splits_page_range_evenly(self):
+        manifest_path = self.extractor.plan_shards(str(self.pdf), 3, self.test_dir / "shards")
+        manifest = json.loads(Path(manifest_path).read_text())
+        ranges = [(s["start_page"], s["end_page"]) for s in manifest["shards"]]
+        assert ranges == [(1, 3), (4, 5), (6, 7)]
+        assert manifest["page_count"] == 7
+    
+    def test_merge_requires_all_shards(self):
+        manifest_path = self.extractor.plan_shards(str(self.pdf), 2, self.test_dir / "shards")
+        self.extractor.run_shard(manifest_path, 1)
+        with pytest.raises(RuntimeError):
+            self.extractor.merge_shards(manifest_path, self.test_dir / "merged")
+    
+    def test_merge_removes_images_of_an_earlier_run(self):
+        merged_dir = self.test_dir / "merged"
+        (merged_dir / "extracted_images").mkdir(parents=True)
+        stale = merged_dir / "extracted_images" / "page_99_image_1.png"
+        stale.write_bytes(b"old")
+        
+        manifest_path = self.extractor.plan_shards(str(self.pdf), 2, self.test_dir / "shards")
+        for k in (1, 2):
+            self.extractor.run_shard(manifest_path, k)
+        merged = self.extractor.merge_shards(manifest_path, str(merged_dir))
+        assert not stale.exists()
+        assert merged["image_count"] == 4
+    
+    def test_multi_process_shards_match_single_node_run(self):
+        single = self.extractor.process_pdf(str(self.pdf), str(self.test_dir / "single"))
+        
+        manifest_path = self.extractor.plan_shards(str(self.pdf), 3, self.test_dir / "shards")
+        script = Path(__file__).parent / "pdf_extractor.py"
+        # Separate processes stand in for separate hosts
+        workers = [
+            subprocess.Popen([sys.executable, str(script), "-t", "120",
+                              "--manifest", manifest_path, "--shard", str(k)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            for k in (1, 2, 3)
+        ]
+        for worker in workers:
+            _, stderr = worker.communicate(timeout=120)
+            assert worker.returncode == 0, stderr.decode()
+        
+        merged = self.extractor.merge_shards(manifest_path, str(self.test_dir / "merged"))
+        
+        assert [Path(f).name for f in merged["text_files"]] == [Path(f).name for f in single["text_files"]]
+        for merged_file, single_file in zip(merged["text_files"], single["text_files"]):
+            assert Path(merged_file).read_text() == Path(single_file).read_text()
+        assert merged["total_tokens"] == single["total_tokens"]
+        merged_images = sorted(p.name for p in (self.test_dir / "merged" / "extracted_images").iterdir())
+        single_images = sorted(p.name for p in (self.test_dir / "single" / "extracted_images").iterdir())
+        assert merged_images == single_images
+
+
+@requires_tokenizer
+class TestRecursiveSync:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.source = self.test_dir / "source"
+        (self.source / "a" / "b").mkdir(parents=True)
+        make_test_pdf(self.source / "top.pdf", pages=2)
+        make_test_pdf(self.source / "a" / "b" / "deep.PDF", pages=1)
+        (self.source / "a" / "notes.txt").write_text("not a pdf")
+        self.output = self.test_dir / "out"
+        self.extractor = PDFExtractor()
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_only_new_or_changed_files_are_processed(self):
+        first = self.extractor.sync_directory(self.source, self.output)
+        assert (first["scanned"], first["processed"]) == (2, 2)
+        assert (self.output / "a" / "b" / "deep_extracted" / "deep.txt").exists()
+        
+        second = self.extractor.sync_directory(self.source, self.output)
+        assert (second["processed"], second["unchanged"]) == (0, 2)
+        
+        # Touching a file without changing it is detected by the hash
+        os.utime(self.source / "top.pdf", ns=(1, 1))
+        third = self.extractor.sync_directory(self.source, self.output)
+        assert third["processed"] == 0
+        
+        make_test_pdf(self.source / "top.pdf", pages=3)
+        fourth = self.extractor.sync_directory(self.source, self.output)
+        assert fourth["processed"] == 1
+        assert "--- Page 3 ---" in (self.output / "top_extracted" / "top.txt").read_text()
+    
+    def test_new_files_are_hashed_from_prefetched_bytes(self, monkeypatch):
+        import pdf_extractor
+        hashed = []
+        original = pdf_extractor.file_sha256
+        monkeypatch.setattr(pdf_extractor, "file_sha256", lambda path: hashed.append(path) or original(path))
+        
+        summary = self.extractor.sync_directory(self.source, self.output, prefetch={"depth": 2})
+        assert (summary["processed"], summary["prefetched"]) == (2, 2)
+        assert hashed == []
+        manifest = json.loads((self.output / ".pdf_extractor_sync.json").read_text())
+        assert manifest["files"]["top.pdf"]["sha256"] == original(str(self.source / "top.pdf"))
+        
+        # A touched file of the same size is checked by hash and left alone
+        os.utime(self.source / "top.pdf", ns=(1, 1))
+        touched = self.extractor.sync_directory(self.source, self.output, prefetch={"depth": 2})
+        assert (touched["processed"], touched["prefetched"]) == (0, 0)
+        assert len(hashed) == 1
+    
+    def test_changed_settings_reprocess_files(self):
+        self.extractor.sync_directory(self.source, self.output)
+        same = PDFExtractor().sync_directory(self.source, self.output)
+        assert (same["processed"], same["unchanged"]) == (0, 2)
+        
+        smaller = PDFExtractor(max_tokens=40).sync_directory(self.source, self.output)
+        assert smaller["processed"] == 2
+        assert (self.output / "top_extracted" / "top_part_2.txt").exists()
+        assert PDFExtractor(max_tokens=40).sync_directory(self.source, self.output)["processed"] == 0
+    
+    def test_prune_removes_outputs_of_deleted_sources(self):
+        self.extractor.sync_directory(self.source, self.output)
+        (self.source / "top.pdf").unlink()
+        
+        kept = self.extractor.sync_directory(self.source, self.output)
+        assert kept["pruned"] == 0
+        assert (self.output / "top_extracted").exists()
+        
+        pruned = self.extractor.sync_directory(self.source, self.output, prune=True)
+        assert pruned["pruned"] == 1
+        assert not (self.output / "top_extracted").exists()
+        assert (self.output / "a" / "b" / "deep_extracted").exists()
+    
+    def test_cancellation_stops_the_sync(self):
+        cancel = threading.Event()
+        extractor = PDFExtractor(cancel_event=cancel,
+                                 progress_callback=lambda event: event["event"] == "page" and cancel.set())
+        with pytest.raises(ExtractionCancelled):
+            extractor.sync_directory(self.source, self.output)
+        # Nothing was recorded as done, so the next run picks up both files
+        cancel.clear()
+        resumed = PDFExtractor().sync_directory(self.source, self.output)
+        assert (resumed["processed"], resumed["failed"]) == (2, 0)
+
+
+@requires_tokenizer
+class TestProgressAndCancellation:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.pdf = make_test_pdf(self.test_dir / "doc.pdf", pages=4)
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_callback_receives_an_event_per_page(self):
+        events = []
+        extractor = PDFExtractor(progress_callback=events.append)
+        extractor.process_pdf(str(self.pdf), str(self.test_dir / "out"))
+        
+        assert [e["event"] for e in events] == ["start", "page", "page", "page", "page", "done"]
+        assert events[0]["total_pages"] == 4
+        assert [e["pages_done"] for e in events if e["event"] == "page"] == [1, 2, 3, 4]
+    
+    def test_cancel_stops_within_one_page(self):
+        cancel = threading.Event()
+        pages_seen = []
+        
+        def on_event(event):
+            if event["event"] == "page":
+                pages_seen.append(event["page"])
+                cancel.set()
+        
+        extractor = PDFExtractor(progress_callback=on_event, cancel_event=cancel)
+        with pytest.raises(ExtractionCancelled):
+            extractor.process_pdf(str(self.pdf), str(self.test_dir / "out"))
+        assert pages_seen == [1]
+
+
+@requires_tokenizer
+class TestLayoutMode:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.pdf = self.test_dir / "layout.pdf"
+        doc = fitz.open()
+        page = doc.new_page()
+        page.insert_text((72, 72), "Introduction above the chart", fontsize=12)
+        pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 20, 20), False)
+        pix.set_rect(pix.irect, (200, 40, 40))
+        page.insert_image(fitz.Rect(72, 100, 172, 200), pixmap=pix)
+        page.insert_text((72, 240), "Caption below the chart", fontsize=12)
+        cmyk = fitz.Pixmap(fitz.csCMYK, fitz.IRect(0, 0, 20, 20), False)
+        cmyk.set_rect(cmyk.irect, (0, 80, 80, 0))
+        page.insert_image(fitz.Rect(72, 300, 172, 400), pixmap=cmyk)
+        doc.save(str(self.pdf))
+        doc.close()
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_image_markers_follow_reading_order(self):
+        extractor = PDFExtractor(layout=True)
+        result = extractor.process_pdf(str(self.pdf), str(self.test_dir / "out"))
+        text = Path(result["text_files"][0]).read_text()
+        
+        positions = [text.index(marker) for marker in (
+            "Introduction above the chart", "[IMAGE: page_1_image_1.png]",
+            "Caption below the chart", "[IMAGE: page_1_image_2.png]")]
+        assert positions == sorted(positions)
+        assert result["image_count"] == 2
+    
+    def test_default_mode_keeps_images_at_top_of_page(self):
+        extractor = PDFExtractor()
+        result = extractor.process_pdf(str(self.pdf), str(self.test_dir / "out"))
+        text = Path(result["text_files"][0]).read_text()
+        assert text.index("[IMAGE: page_1_image_2.png]") < text.index("Introduction above the chart")
+
+
+def _pixmap_from_array(array):
+    """Build an RGB pixmap from an (h, w, 3) uint8 array"""
+    height, width, _ = array.shape
+    return fitz.Pixmap(fitz.csRGB, width, height, np.ascontiguousarray(array).tobytes(), False)
+
+
+class TestBlankImageDetection:
+    def test_uniform_and_margin_images_have_no_ink(self):
+        white = np.full((60, 80, 3), 255, dtype=np.uint8)
+        fill = np.zeros((60, 80, 3), dtype=np.uint8)
+        fill[:] = (20, 90, 160)
+        rng = np.random.default_rng(0)
+        margin = np.clip(245 + rng.normal(0, 3, (60, 80, 3)), 0, 255).astype(np.uint8)
+        
+        for array in (white, fill, margin):
+            stats = image_blank_stats(_pixmap_from_array(array))
+            assert stats["ink_ratio"] < 0.002
+            assert stats["dominant_share"] > 0.9
+    
+    def test_text_like_image_has_ink(self):
+        page = np.full((60, 80, 3), 255, dtype=np.uint8)
+        page[10:50:4, 5:75] = 0  # dark "text lines"
+        stats = image_blank_stats(_pixmap_from_array(page))
+        assert stats["ink_ratio"] > 0.1
+        assert stats["variance"] > 100
+    
+    @requires_tokenizer
+    def test_small_mark_on_a_large_page_is_not_blank(self):
+        extractor = PDFExtractor(skip_blank_images=True)
+        signature = np.full((400, 400, 3), 255, dtype=np.uint8)
+        signature[300:306, 250:260] = 20  # 60 pixels: well under 0.2% of the image
+        stats = image_blank_stats(_pixmap_from_array(signature))
+        assert stats["ink_ratio"] < extractor.blank_ink_ratio
+        assert stats["ink_pixels"] == 60
+        assert not extractor.check_blank_image(_pixmap_from_array(signature), 1, "signature.png")
+        
+        speck = np.full((400, 400, 3), 255, dtype=np.uint8)
+        speck[10:12, 10:12] = 0  # dust
+        assert extractor.check_blank_image(_pixmap_from_array(speck), 1, "speck.png")
+    
+    @requires_tokenizer
+    def test_blank_images_are_skipped_and_recorded(self):
+        test_dir = Path(tempfile.mkdtemp())
+        try:
+            pdf = test_dir / "blank.pdf"
+            doc = fitz.open()
+            page = doc.new_page()
+            page.insert_text((72, 72), "Page with a blank and a real image")
+            blank = np.full((30, 30, 3), 250, dtype=np.uint8)
+            real = np.full((30, 30, 3), 255, dtype=np.uint8)
+            real[5:25:3] = 0
+            page.insert_image(fitz.Rect(72, 100, 172, 200), pixmap=_pixmap_from_array(blank))
+            page.insert_image(fitz.Rect(72, 250, 172, 350), pixmap=_pixmap_from_array(real))
+            doc.save(str(pdf))
+            doc.close()
+            
+            extractor = PDFExtractor(skip_blank_images=True)
+            result = extractor.process_pdf(str(pdf), str(test_dir / "out"))
+            
+            assert result["image_count"] == 1
+            assert [entry["saved"] for entry in result["blank_images"]] == [False]
+            text = Path(result["text_files"][0]).read_text()
+            assert text.count("[IMAGE: ") == 1
+        finally:
+            shutil.rmtree(test_dir, ignore_errors=True)
+
+
+class TestOCRPreprocessing:
+    def test_otsu_threshold_separates_ink_from_paper(self):
+        gray = np.full((40, 40), 225, dtype=np.uint8)
+        gray[10:20] = 40
+        threshold = otsu_threshold(gray)
+        assert 40 <= threshold < 225
+    
+    def test_preprocess_converts_to_grayscale_and_downscales(self):
+        rgb = np.zeros((300, 200, 3), dtype=np.uint8)
+        rgb[:, :, 0] = 255
+        gray = preprocess_for_ocr(rgb, max_side=100)
+        assert gray.ndim == 2
+        assert max(gray.shape) <= 100
+        assert abs(int(gray[0, 0]) - 76) <= 1  # 0.299 * 255
+    
+    def test_preprocess_keeps_size_without_limit(self):
+        rgb = np.full((30, 20, 3), 128, dtype=np.uint8)
+        assert preprocess_for_ocr(rgb).shape == (30, 20)
+    
+    @requires_tokenizer
+    def test_accurate_profile_keeps_the_original_image(self):
+        image = Image.new("RGB", (60, 40), (200, 30, 30))
+        assert PDFExtractor(ocr_profile="accurate").prepare_ocr_image(image) is image
+        assert PDFExtractor(ocr_profile="accurate").prepare_ocr_image(image.convert("P")).mode == "RGB"
+        assert PDFExtractor(ocr_profile="balanced").prepare_ocr_image(image).mode == "L"
+    
+    @requires_tokenizer
+    def test_profiles_set_tesseract_modes(self):
+        assert PDFExtractor(ocr_profile="fast").tesseract_config() == "--oem 1 --psm 6"
+        assert PDFExtractor(ocr_profile="accurate").tesseract_config() == "--oem 3 --psm 1"
+        with pytest.raises(ValueError):
+            PDFExtractor(ocr_profile="turbo")
+
+
+class PathologicalPageExtractor(PDFExtractor):
+    """Hangs on page 2 and kills its process on page 3, like a pathological MuPDF page"""
+    
+    def extract_page(self, page, page_num, images_dir):
+        if page_num == 2:
+            time.sleep(60)
+        if page_num == 3:
+            os.abort()
+        return super().extract_page(page, page_num, images_dir)
+
+
+class CrashingPageExtractor(PDFExtractor):
+    """Kills its worker process on page 2"""
+    
+    def extract_page(self, page, page_num, images_dir):
+        if page_num == 2:
+            os.abort()
+        return super().extract_page(page, page_num, images_dir)
+
+
+@requires_tokenizer
+class TestPageTimeouts:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.pdf = make_test_pdf(self.test_dir / "doc.pdf", pages=4)
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_hung_and_crashed_pages_become_error_markers(self):
+        extractor = PathologicalPageExtractor(page_timeout=3)
+        started = time.monotonic()
+        result = extractor.process_pdf(str(self.pdf), str(self.test_dir / "out"))
+        elapsed = time.monotonic() - started
+        
+        text = Path(result["text_files"][0]).read_text()
+        assert "Heading for page 1" in text
+        assert "[PAGE 2: ERROR timed out after 3s]" in text
+        assert "[PAGE 3: ERROR worker crashed" in text
+        assert "Heading for page 4" in text
+        assert [error["page"] for error in result["page_errors"]] == [2, 3]
+        assert elapsed < 60
+    
+    def test_supervised_output_matches_in_process_output(self):
+        direct = PDFExtractor().process_pdf(str(self.pdf), str(self.test_dir / "direct"))
+        supervised = PDFExtractor(page_timeout=30).process_pdf(str(self.pdf), str(self.test_dir / "supervised"))
+        assert Path(direct["text_files"][0]).read_text() == Path(supervised["text_files"][0]).read_text()
+        assert supervised["image_count"] == direct["image_count"]
+
+
+@requires_tokenizer
+class TestMemoryRegression:
+    def test_stage_peaks_within_stored_baseline(self):
+        import benchmark
+        baseline = json.loads(benchmark.BASELINE_PATH.read_text())
+        stages = benchmark.profile_memory(baseline["document"])
+        
+        assert set(stages) == set(benchmark.MEMORY_STAGES)
+        failures = benchmark.check_memory_baseline(stages, baseline)
+        assert not failures, "\n".join(failures)
+
+
+@requires_tokenizer
+class TestBoilerplateRemoval:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.pdf = self.test_dir / "corporate.pdf"
+        doc = fitz.open()
+        for i in range(5):
+            page = doc.new_page()
+            page.insert_text((72, 40), "ACME Corporation - Quarterly Report", fontsize=9)
+            page.insert_text((72, 100), f"Section {i + 1} discusses topic number {i + 1} in detail.", fontsize=11)
+            page.insert_text((72, 120), f"Unique finding {i * 7} for this section.", fontsize=11)
+            page.insert_text((72, 800), "CONFIDENTIAL - do not distribute", fontsize=8)
+            page.insert_text((72, 815), f"Page {i + 1} of 5", fontsize=8)
+        doc.save(str(self.pdf))
+        doc.close()
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_repeated_headers_and_footers_are_removed(self):
+        plain = PDFExtractor().process_pdf(str(self.pdf), str(self.test_dir / "plain"))
+        result = PDFExtractor(boilerplate="remove").process_pdf(str(self.pdf), str(self.test_dir / "clean"))
+        text = Path(result["text_files"][0]).read_text()
+        
+        assert "ACME Corporation" not in text
+        assert "CONFIDENTIAL" not in text
+        assert "Page 3 of 5" not in text
+        assert "Unique finding 14 for this section." in text
+        assert result["boilerplate"]["unique_lines"] == 3
+        assert result["boilerplate"]["lines_removed"] == 15
+        assert result["boilerplate"]["tokens_saved"] > 0
+        assert result["total_tokens"] < plain["total_tokens"]
+        assert plain["boilerplate"]["tokens_saved"] == 0
+    
+    def test_note_mode_keeps_one_copy(self):
+        result = PDFExtractor(boilerplate="note").process_pdf(str(self.pdf), str(self.test_dir / "note"))
+        text = Path(result["text_files"][0]).read_text()
+        assert text.startswith("[REPEATED LINES, REMOVED]:\nACME Corporation - Quarterly Report "
+                               "(repeated on 5/5 pages)\n")
+        assert text.count("ACME Corporation") == 1
+        assert text.count("CONFIDENTIAL") == 1
+    
+    def test_note_gives_the_actual_page_count(self):
+        topics = ["budget", "hiring", "travel", "audit"]
+        records = [{"page": i + 1, "text": "\n".join(f"The {topic} review, point {n}." for n in range(6))}
+                   for i, topic in enumerate(topics)]
+        for record in records[:3]:
+            record["text"] = "DRAFT\n" + record["text"]
+        text = PDFExtractor(boilerplate="note").build_full_text(records)
+        assert text.startswith("[REPEATED LINES, REMOVED]:\nDRAFT (repeated on 3/4 pages)\n\n")
+        assert text.count("DRAFT") == 1
+
+
+@requires_tokenizer
+class TestInMemoryExtraction:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.pdf = make_test_pdf(self.test_dir / "upload.pdf", pages=5)
+        self.extractor = PDFExtractor(max_tokens=150)
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_extract_bytes_matches_files_and_writes_nothing(self):
+        on_disk = self.extractor.process_pdf(str(self.pdf), str(self.test_dir / "out"))
+        
+        scratch = Path(tempfile.mkdtemp())
+        cwd = os.getcwd()
+        os.chdir(scratch)
+        try:
+            result = self.extractor.extract_bytes(self.pdf.read_bytes())
+        finally:
+            os.chdir(cwd)
+        assert list(scratch.iterdir()) == []
+        shutil.rmtree(scratch)
+        
+        assert result.chunks == [Path(f).read_text() for f in on_disk["text_files"]]
+        assert result.total_tokens == on_disk["total_tokens"]
+        assert result.image_count == on_disk["image_count"] == 3
+        assert all(data.startswith(b"\x89PNG") for data in result.images.values())
+        assert [page["page"] for page in result.pages] == [1, 2, 3, 4, 5]
+    
+    def test_memoryview_and_mmap_inputs(self):
+        expected = self.extractor.extract_bytes(self.pdf.read_bytes())
+        from_view = self.extractor.extract_bytes(memoryview(self.pdf.read_bytes()))
+        from_mmap = self.extractor.extract_mmap(str(self.pdf))
+        assert from_view.chunks == expected.chunks
+        assert from_mmap.chunks == expected.chunks
+        assert from_mmap.images == expected.images
+    
+    def test_supervised_in_memory_extraction(self):
+        expected = self.extractor.extract_bytes(self.pdf.read_bytes())
+        supervised = PDFExtractor(max_tokens=150, page_timeout=30).extract_bytes(self.pdf.read_bytes())
+        assert supervised.chunks == expected.chunks
+        assert supervised.images == expected.images
+    
+    def test_supervised_mmap_extraction_passes_the_path(self, monkeypatch):
+        sources = []
+        original_init = SupervisedPageWorker.__init__
+        
+        def record_source(worker, extractor, source, timeout):
+            sources.append(source)
+            original_init(worker, extractor, source, timeout)
+        
+        monkeypatch.setattr(SupervisedPageWorker, "__init__", record_source)
+        expected = self.extractor.extract_bytes(self.pdf.read_bytes())
+        supervised = PDFExtractor(max_tokens=150, page_timeout=30).extract_mmap(str(self.pdf))
+        assert sources == [str(self.pdf)]
+        assert supervised.chunks == expected.chunks
+        assert supervised.images == expected.images
+
+
+
+@requires_tokenizer
+class TestPipeMode:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.pdf = make_test_pdf(self.test_dir / "piped.pdf", pages=5)
+        self.extractor = PDFExtractor(max_tokens=150)
+        self.expected = self.extractor.extract_bytes(self.pdf.read_bytes()).chunks
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_jsonl_and_nul_records_match_chunks(self):
+        out = io.BytesIO()
+        count = write_chunk_stream(self.extractor, self.pdf.read_bytes(), out, "jsonl")
+        records = [json.loads(line) for line in out.getvalue().decode().splitlines()]
+        assert count == len(self.expected) > 1
+        assert [r["text"] for r in records] == self.expected
+        assert [r["chunk"] for r in records] == list(range(1, count + 1))
+        
+        out = io.BytesIO()
+        write_chunk_stream(self.extractor, self.pdf.read_bytes(), out, "nul")
+        assert out.getvalue().decode().split("\0")[:-1] == self.expected
+    
+    def test_images_go_to_side_directory_or_nowhere(self):
+        images_dir = self.test_dir / "images"
+        write_chunk_stream(self.extractor, self.pdf.read_bytes(), io.BytesIO(), images_dir=str(images_dir))
+        assert len(list(images_dir.glob("*.png"))) == 3
+        write_chunk_stream(self.extractor, self.pdf.read_bytes(), io.BytesIO())
+        assert self.extractor.memory_images == {}
+    
+    def test_cli_reads_stdin_and_writes_stdout(self):
+        script = Path(__file__).parent / "pdf_extractor.py"
+        proc = subprocess.run([sys.executable, str(script), "-", "-t", "150", "--delimiter", "\\n§ @@ →\\n"],
+                              input=self.pdf.read_bytes(), capture_output=True, timeout=120,
+                              env={**os.environ, "PYTHONIOENCODING": "utf-8"})
+        assert proc.returncode == 0, proc.stderr.decode()
+        assert proc.stdout.decode() == "\n§ @@ →\n".join(self.expected) + "\n"
+        assert "Wrote" in proc.stderr.decode()
+    
+    def test_cli_exits_quietly_when_the_reader_goes_away(self):
+        script = Path(__file__).parent / "pdf_extractor.py"
+        proc = subprocess.Popen([sys.executable, str(script), "-", "-t", "150"],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc.stdout.close()
+        _, stderr = proc.communicate(self.pdf.read_bytes(), timeout=120)
+        assert proc.returncode == 1
+        assert b"output closed by the reader" in stderr
+        assert b"Exception ignored" not in stderr and b"Traceback" not in stderr
+    
+    def test_cli_worker_logs_stay_out_of_the_stream(self):
+        script = Path(__file__).parent / "pdf_extractor.py"
+        proc = subprocess.run([sys.executable, str(script), "-", "-t", "150", "--page-timeout", "60",
+                               "--format", "jsonl"],
+                              input=self.pdf.read_bytes(), capture_output=True, timeout=120)
+        assert proc.returncode == 0, proc.stderr.decode()
+        records = [json.loads(line) for line in proc.stdout.decode().splitlines()]
+        assert [r["text"] for r in records] == self.expected
+        # Page workers log image conversions; those lines must reach stderr only
+        assert "Converted image to RGB" in proc.stderr.decode()
+
+
+
+@requires_tokenizer
+class TestEstimate:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.pdf = make_test_pdf(self.test_dir / "batch.pdf", pages=30, images_every=3)
+        self.extractor = PDFExtractor(max_tokens=300)
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_estimate_tracks_a_full_run(self):
+        estimate = self.extractor.estimate_pdf(str(self.pdf), sample_pages=6)
+        result = self.extractor.process_pdf(str(self.pdf), str(self.test_dir / "out"))
+        
+        assert estimate["sampled_pages"] == 6
+        assert (estimate["pages"], estimate["images"]) == (30, result["image_count"])
+        assert abs(estimate["tokens"] - result["total_tokens"]) < 0.1 * result["total_tokens"]
+        assert abs(estimate["chunks"] - len(result["text_files"])) <= 1
+        assert estimate["scanned_pages"] == estimate["ocr_pages"] == 0
+    
+    def test_scanned_pages_are_costed_for_ocr(self):
+        scanned = self.test_dir / "scanned.pdf"
+        doc = fitz.open()
+        for _ in range(4):
+            page = doc.new_page()
+            pix = fitz.Pixmap(fitz.csGRAY, fitz.IRect(0, 0, 300, 400), False)
+            page.insert_image(page.rect, pixmap=pix)
+        doc.save(str(scanned))
+        doc.close()
+        
+        estimate = self.extractor.estimate_pdf(str(scanned))
+        assert (estimate["scanned_pages"], estimate["ocr_pages"]) == (4, 0)
+        
+        with_ocr = self.extractor.estimate_pdf(str(scanned), ocr=True)
+        assert (with_ocr["ocr_pages"], with_ocr["ocr_images"]) == (4, 4)
+        assert with_ocr["tokens"] > estimate["tokens"]
+        assert with_ocr["seconds"] > estimate["seconds"]
+        
+        # The estimate never calls Tesseract: --estimate --ocr costs OCR on a host without it
+        script = Path(__file__).parent / "pdf_extractor.py"
+        env = dict(os.environ, PATH=str(self.test_dir))  # no tesseract binary on PATH
+        proc = subprocess.run([sys.executable, str(script), "--estimate", "--ocr", str(scanned)],
+                              capture_output=True, text=True, timeout=120, env=env)
+        assert proc.returncode == 0, proc.stderr
+        assert "(4 scanned, 4 to OCR)" in proc.stdout
+    
+    def test_calibration_file_overrides_defaults(self):
+        rates_path = self.test_dir / "rates.json"
+        rates_path.write_text(json.dumps({"page_seconds": 1.0, "ocr_megapixel_seconds": {"fast": 9.0}}))
+        rates = load_stage_rates(str(rates_path))
+        assert rates["page_seconds"] == 1.0
+        assert rates["ocr_megapixel_seconds"]["fast"] == 9.0
+        assert rates["ocr_megapixel_seconds"]["accurate"] > 0
+        assert self.extractor.estimate_pdf(str(self.pdf), rates=rates)["seconds"] >= 30
+
+
+
+@requires_tokenizer
+class TestBatchPacking:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        (self.test_dir / "other").mkdir()
+        self.pdfs = [make_test_pdf(self.test_dir / f"memo_{i}.pdf", pages=1) for i in range(5)]
+        self.pdfs.append(make_test_pdf(self.test_dir / "other" / "memo_0.pdf", pages=1))
+        self.pdfs.append(make_test_pdf(self.test_dir / "report.pdf", pages=30))
+        self.extractor = PDFExtractor(max_tokens=1000)
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_documents_share_files_within_token_limit(self):
+        out = self.test_dir / "packed"
+        result = self.extractor.pack_documents([str(p) for p in self.pdfs], str(out))
+        
+        assert result["documents"] == 7 and result["failed"] == []
+        for text_file in result["text_files"]:
+            assert self.extractor.count_tokens(Path(text_file).read_text()) <= 1000
+        
+        index = json.loads(Path(result["index_path"]).read_text())
+        names = [document["document"] for document in index["documents"]]
+        assert names == ["memo_0", "memo_1", "memo_2", "memo_3", "memo_4", "memo_0_2", "report"]
+        memo_files = {part["file"] for document in index["documents"][:6] for part in document["parts"]}
+        assert len(memo_files) < 6
+        assert len(index["documents"][-1]["parts"]) > 1
+        
+        for document, pdf in zip(index["documents"], self.pdfs):
+            text = "".join((out / part["file"]).read_text()[part["start"]:part["end"]]
+                           for part in document["parts"])
+            assert text.startswith(f"===== DOCUMENT: {pdf.name} ({document['pages']} pages) =====")
+            assert f"===== END DOCUMENT: {pdf.name} =====" in text
+            assert text.count("--- Page ") == document["pages"]
+        
+        assert (out / "extracted_images" / "memo_0_2" / "page_1_image_1.png").exists()
+        assert result["image_count"] == 6 + 15
+    
+    def test_single_file_and_failures_are_reported(self):
+        broken = self.test_dir / "broken.pdf"
+        broken.write_bytes(b"not a pdf")
+        result = PDFExtractor(max_tokens=20000).pack_documents(
+            [str(self.pdfs[0]), str(broken), str(self.pdfs[1])], str(self.test_dir / "packed"))
+        
+        assert [Path(f).name for f in result["text_files"]] == ["batch.txt"]
+        assert [f["pdf_path"] for f in result["failed"]] == [str(broken)]
+        index = json.loads(Path(result["index_path"]).read_text())
+        assert {part["file"] for d in index["documents"] for part in d["parts"]} == {"batch.txt"}
+    
+    def test_repacking_removes_previous_batch_files(self):
+        out = self.test_dir / "packed"
+        pdfs = [str(p) for p in self.pdfs[:3]]
+        PDFExtractor(max_tokens=100000).pack_documents(pdfs, str(out))
+        result = PDFExtractor(max_tokens=150).pack_documents(pdfs, str(out))
+        assert len(result["text_files"]) > 1
+        assert sorted(out.glob("batch*.txt")) == sorted(Path(f) for f in result["text_files"])
+    
+    def test_repacking_removes_images_of_dropped_documents(self):
+        out = self.test_dir / "packed"
+        PDFExtractor(max_tokens=100000).pack_documents([str(p) for p in self.pdfs[:3]], str(out))
+        before = sorted(p.name for p in (out / "extracted_images").iterdir())
+        assert len(before) == 3
+        result = PDFExtractor(max_tokens=100000).pack_documents([str(self.pdfs[1])], str(out))
+        assert sorted(p.name for p in (out / "extracted_images").iterdir()) == [before[1]]
+        assert result["image_count"] == len(list((out / "extracted_images").rglob("*.png")))
+
+
+
+class TestOCRCache:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.cache_path = self.test_dir / "ocr.sqlite"
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_lru_eviction_keeps_recently_used_entries(self):
+        cache = OCRCache(self.cache_path, max_bytes=1000)
+        for i in range(4):
+            cache.put(f"key{i}", "x" * 300)
+            time.sleep(0.01)
+        assert cache.get("key0") is None
+        
+        time.sleep(0.01)
+        assert cache.get("key1") == "x" * 300  # refreshed, so key2 is now the oldest
+        cache.put("key4", "y" * 300)
+        assert cache.get("key2") is None
+        assert cache.get("key1") is not None and cache.get("key4") is not None
+        cache.close()
+    
+    def test_inserts_do_not_rescan_the_table(self):
+        cache = OCRCache(self.cache_path, max_bytes=10_000)
+        cache.put("first", "x")
+        statements = []
+        cache._conn.set_trace_callback(statements.append)
+        for i in range(50):
+            cache.put(f"key{i}", "x" * 100)
+        assert not any("SUM(size)" in statement for statement in statements)
+        
+        # Crossing the limit sums the real total once and evicts down to 90%
+        cache.put("big", "y" * 5000)
+        assert sum("SUM(size)" in statement for statement in statements) == 1
+        assert cache._total <= 9000
+        assert cache._total == cache._conn.execute("SELECT SUM(size) FROM ocr").fetchone()[0]
+        cache.close()
+    
+    def test_shared_across_processes(self):
+        code = ("import sys; from pdf_extractor import OCRCache; "
+                "OCRCache(sys.argv[1]).put('stamp', 'APPROVED')")
+        subprocess.run([sys.executable, "-c", code, str(self.cache_path)], check=True,
+                       cwd=Path(__file__).parent, capture_output=True, timeout=60)
+        assert OCRCache(self.cache_path).get("stamp") == "APPROVED"
+    
+    @requires_tokenizer
+    def test_repeated_images_hit_the_cache(self, monkeypatch):
+        calls = []
+        
+        def fake_tesseract(image, lang, config):
+            calls.append(image.size)
+            return "APPROVED  by finance"
+        monkeypatch.setattr(pytesseract, "image_to_string", fake_tesseract)
+        
+        stamp = Image.new("RGB", (120, 60), "white")
+        stamp.paste((200, 0, 0), (10, 10, 110, 50))
+        extractor = PDFExtractor(ocr_profile="fast", ocr_cache=str(self.cache_path))
+        extractor.use_ocr = True
+        assert extractor.ocr_image(stamp) == "APPROVED by finance"
+        assert extractor.ocr_image(stamp.copy()) == "APPROVED by finance"
+        assert len(calls) == 1
+        assert extractor.run_stats["ocr_cache"] == {"hits": 1, "misses": 1}
+        
+        # A new run (another extractor on the same file) starts warm; settings are part of the key
+        rerun = PDFExtractor(ocr_profile="fast", ocr_cache=str(self.cache_path))
+        assert rerun.ocr_image(stamp) == "APPROVED by finance"
+        other_language = PDFExtractor(ocr_profile="fast", ocr_language="deu", ocr_cache=str(self.cache_path))
+        other_language.ocr_image(stamp)
+        assert len(calls) == 2
+        assert rerun.worker_config()["ocr_cache"] == str(self.cache_path)
+        
+        # A hit skips orientation detection
+        def no_osd(*args, **kwargs):
+            raise AssertionError("orientation detection ran on a cache hit")
+        monkeypatch.setattr(pytesseract, "image_to_osd", no_osd)
+        assert PDFExtractor(ocr_profile="fast", ocr_cache=str(self.cache_path)).ocr_image(stamp) == "APPROVED by finance"
+
+
+
+class TestTextLayerQuality:
+    def test_score_separates_prose_from_broken_text_layers(self):
+        prose = "The committee approved the budget for the next quarter after a short review. " * 3
+        assert text_layer_stats(prose)["score"] > 0.9
+        assert text_layer_stats("Chapter 3: Results")["score"] > 0.9
+        assert text_layer_stats("会议批准了下一季度的预算，并安排了审查。" * 4)["score"] > 0.9
+        
+        broken = {
+            "no spaces": "Thecommitteeapprovedthebudget fornextquarteraftera shortreviewofall items " * 3,
+            "letter spaced": "T h e c o m m i t t e e a p p r o v e d t h e b u d g e t",
+            "symbols": "!\"#$ %&'( )*+, -./: ;<=> ?@[] " * 4,
+            "replacement": "\ufffd\ufffd budget \ufffd review \ufffd quarter " * 4,
+            "mojibake": "Le comitÃ© a approuvÃ© le budget du trimestre prochain aprÃ¨s rÃ©vision. " * 3,
+        }
+        for name, text in broken.items():
+            assert text_layer_stats(text)["score"] < 0.5, name
+        assert text_layer_stats("   \n ")["score"] == 0.0
+    
+    @requires_tokenizer
+    def test_ocr_decisions_and_counters(self, monkeypatch):
+        test_dir = Path(tempfile.mkdtemp())
+        try:
+            pdf = test_dir / "mixed.pdf"
+            doc = fitz.open()
+            doc.new_page().insert_text((72, 72), "Part II", fontsize=24)  # short title page
+            page = doc.new_page()                                           # scan
+            page.insert_image(page.rect, pixmap=fitz.Pixmap(fitz.csGRAY, fitz.IRect(0, 0, 60, 80), False))
+            page = doc.new_page()                                           # garbled text layer
+            for i in range(20):
+                page.insert_text((72, 72 + 14 * i), "Thebudgetwasapprovedafterreviewbytheboard inQ3", fontsize=10)
+            doc.new_page().insert_text((72, 72), "Normal prose on this page. " * 8, fontsize=8)
+            doc.save(str(pdf))
+            doc.close()
+            
+            ocr_pages = []
+            extractor = PDFExtractor()
+            extractor.use_ocr = True
+            monkeypatch.setattr(extractor, "extract_text_from_page_ocr",
+                                lambda page: ocr_pages.append(page.number + 1) or "The budget was approved.")
+            monkeypatch.setattr(extractor, "extract_text_from_image_ocr", lambda data: "")
+            import pdf_extractor
+            calls = []
+            page_class = pdf_extractor.fitz.Page
+            for method in ("get_text", "get_drawings"):
+                original = getattr(page_class, method)
+                monkeypatch.setattr(page_class, method,
+                                    lambda self, *a, _name=method, _original=original, **k:
+                                    calls.append(_name) or _original(self, *a, **k))
+            result = extractor.process_pdf(str(pdf), str(test_dir / "out"))
+            
+            # One text pass per page; none of these pages needs the vector-content check
+            assert calls.count("get_text") == 4
+            assert "get_drawings" not in calls
+            assert ocr_pages == [2, 3]
+            # Title page: avoided vs. the 100-character rule; garbled page: added
+            assert result["page_ocr"] == {"runs": 2, "avoided": 1, "added": 1}
+            text = Path(result["text_files"][0]).read_text()
+            assert "Thebudgetwasapproved" not in text
+            assert "Part II" in text
+        finally:
+            shutil.rmtree(test_dir, ignore_errors=True)
+
+
+
+@requires_tokenizer
+class TestRechunk:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.pdf = make_test_pdf(self.test_dir / "corpus.pdf", pages=12)
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_rechunk_matches_a_fresh_run_at_the_new_limit(self):
+        out = self.test_dir / "out"
+        small = PDFExtractor(max_tokens=150).process_pdf(str(self.pdf), str(out))
+        assert (out / "corpus_pages.jsonl.gz").exists()
+        assert len(small["text_files"]) > 2
+        
+        fresh = PDFExtractor(max_tokens=600).process_pdf(str(self.pdf), str(self.test_dir / "fresh"))
+        rechunked = PDFExtractor(max_tokens=600).rechunk(str(out))[0]
+        
+        assert [Path(f).name for f in rechunked["text_files"]] == [Path(f).name for f in fresh["text_files"]]
+        for ours, theirs in zip(rechunked["text_files"], fresh["text_files"]):
+            assert Path(ours).read_text() == Path(theirs).read_text()
+        assert rechunked["total_tokens"] == fresh["total_tokens"]
+        # Parts beyond the new count are gone
+        assert sorted(p.name for p in out.glob("*.txt")) == sorted(Path(f).name for f in rechunked["text_files"])
+    
+    def test_only_files_written_by_a_previous_run_are_removed(self):
+        out = self.test_dir / "out"
+        out.mkdir()
+        # A user's notes that happen to share the naming scheme
+        (out / "corpus.txt").write_text("my notes")
+        (out / "corpus_part_9.txt").write_text("more notes")
+        
+        PDFExtractor(max_tokens=150).process_pdf(str(self.pdf), str(out))
+        assert (out / "corpus_part_9.txt").read_text() == "more notes"
+        result = PDFExtractor(max_tokens=100000).process_pdf(str(self.pdf), str(out))
+        assert [Path(f).name for f in result["text_files"]] == ["corpus.txt"]
+        assert not (out / "corpus_part_2.txt").exists()
+        assert (out / "corpus_part_9.txt").read_text() == "more notes"
+    
+    def test_rechunk_into_another_directory(self):
+        out = self.test_dir / "out"
+        PDFExtractor(max_tokens=150).process_pdf(str(self.pdf), str(out))
+        before = sorted(p.name for p in out.iterdir())
+        
+        result = PDFExtractor(max_tokens=100000).rechunk(str(out), str(self.test_dir / "100k"))[0]
+        assert [Path(f).name for f in result["text_files"]] == ["corpus.txt"]
+        assert sorted(p.name for p in out.iterdir()) == before
+        
+        with pytest.raises(FileNotFoundError):
+            PDFExtractor().rechunk(str(self.test_dir / "100k"))
+    
+    def test_cancelled_run_keeps_no_partial_records(self):
+        cancel = threading.Event()
+        extractor = PDFExtractor(cancel_event=cancel,
+                                 progress_callback=lambda e: e["event"] == "page" and e["page"] == 3 and cancel.set())
+        with pytest.raises(ExtractionCancelled):
+            extractor.process_pdf(str(self.pdf), str(self.test_dir / "out"))
+        assert not list((self.test_dir / "out").glob("*.gz*"))
+
+
+
+class SlowPrefetcher(PDFPrefetcher):
+    """Simulates slow network storage and records the bytes held at each read"""
+    def __init__(self, *args, delay=0.2, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delay = delay
+        self.held = []
+    
+    def _read(self, index):
+        self.held.append(self.reserved_bytes)
+        time.sleep(self.delay)
+        return super()._read(index)
+
+
+class TestPrefetching:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.pdfs = [make_test_pdf(self.test_dir / f"doc_{i}.pdf", pages=2) for i in range(5)]
+        self.size = max(p.stat().st_size for p in self.pdfs)
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def test_reads_ahead_while_the_consumer_works(self):
+        prefetcher = SlowPrefetcher(self.pdfs, depth=2, delay=0.2)
+        seen = []
+        for path, source in prefetcher:
+            assert source == path.read_bytes()
+            seen.append(path)
+            time.sleep(0.3)  # "processing" hides the next read
+        assert seen == self.pdfs
+        assert prefetcher.prefetched == 5
+        # Only the first read is waited for in full
+        assert 0.15 < prefetcher.stall_seconds < 0.45
+    
+    def test_byte_budget_limits_data_held(self):
+        prefetcher = SlowPrefetcher(self.pdfs, depth=4, max_bytes=2 * self.size, delay=0.01)
+        for _ in prefetcher:
+            time.sleep(0.05)
+        assert max(prefetcher.held) <= 2 * self.size
+        
+        # Files over the budget are read directly by the consumer
+        over_budget = PDFPrefetcher(self.pdfs, max_bytes=self.size // 2)
+        assert [source for _, source in over_budget] == [None] * 5
+    
+    def test_direct_reads_count_as_stall(self, monkeypatch):
+        import pdf_extractor
+        real_open = pdf_extractor.fitz.open
+        
+        def slow_open(*args, **kwargs):
+            time.sleep(0.1)  # storage latency
+            return real_open(*args, **kwargs)
+        
+        monkeypatch.setattr(pdf_extractor.fitz, "open", slow_open)
+        # Every file is over the budget, so every file is read directly
+        prefetcher = PDFPrefetcher(self.pdfs, max_bytes=self.size // 2)
+        for path, source in prefetcher:
+            open_pdf(path, source, prefetcher).close()
+        assert prefetcher.prefetched == 0
+        assert prefetcher.stall_seconds >= 0.45
+    
+    def test_scratch_copies_are_removed(self):
+        scratch = self.test_dir / "scratch"
+        for path, source in PDFPrefetcher(self.pdfs, scratch_dir=str(scratch)):
+            assert source.parent.parent == scratch and source.name == path.name
+            assert source.read_bytes() == path.read_bytes()
+        assert not any(scratch.rglob("*.pdf"))
+    
+    @requires_tokenizer
+    def test_prefetched_source_gives_identical_output(self):
+        extractor = PDFExtractor(max_tokens=150)
+        direct = extractor.process_pdf(str(self.pdfs[0]), str(self.test_dir / "direct"))
+        prefetched = extractor.process_pdf(str(self.pdfs[0]), str(self.test_dir / "prefetched"),
+                                           source=self.pdfs[0].read_bytes())
+        for ours, theirs in zip(prefetched["text_files"], direct["text_files"]):
+            assert Path(ours).name == Path(theirs).name
+            assert Path(ours).read_text() == Path(theirs).read_text()
+        assert prefetched["image_count"] == direct["image_count"]
+    
+    @requires_tokenizer
+    def test_batch_packing_and_sync_read_ahead(self):
+        extractor = PDFExtractor(max_tokens=300)
+        paths = [str(p) for p in self.pdfs]
+        direct = extractor.pack_documents(paths, str(self.test_dir / "direct"))
+        packed = extractor.pack_documents(paths, str(self.test_dir / "packed"), prefetch={"depth": 2})
+        assert packed["prefetched"] == 5 and direct["prefetched"] == 0
+        for ours, theirs in zip(packed["text_files"], direct["text_files"]):
+            assert Path(ours).read_text() == Path(theirs).read_text()
+        
+        scratch = self.test_dir / "scratch"
+        synced = extractor.sync_directory(self.test_dir, self.test_dir / "synced",
+                                          prefetch={"depth": 2, "scratch_dir": str(scratch)})
+        assert (synced["processed"], synced["prefetched"]) == (5, 5)
+        assert (self.test_dir / "synced" / "doc_0_extracted" / "doc_0.txt").exists()
+        # Unchanged files are neither processed nor read ahead
+        again = extractor.sync_directory(self.test_dir, self.test_dir / "synced", prefetch={"depth": 2})
+        assert (again["unchanged"], again["prefetched"]) == (5, 0)
+
+
+
+@requires_tokenizer
+class TestResourceGuards:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        # 40x30 RGB images (1,200 pixels, 3,600 decoded bytes) on pages 1, 3, 5, ...
+        self.pdf = make_test_pdf(self.test_dir / "bomb.pdf", pages=12)
+    
+    def teardown_method(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def _refuse_decoding(self, extractor, monkeypatch):
+        def decode(*args):
+            raise AssertionError("oversized image was decoded")
+        monkeypatch.setattr(extractor, "save_image_pixmap", decode)
+    
+    @pytest.mark.parametrize("layout", [False, True])
+    def test_oversized_images_are_skipped_before_decoding(self, layout, monkeypatch):
+        extractor = PDFExtractor(max_image_pixels=1000, layout=layout)
+        self._refuse_decoding(extractor, monkeypatch)
+        result = extractor.process_pdf(str(self.pdf), str(self.test_dir / "out"))
+        
+        images_dir = self.test_dir / "out" / "extracted_images"
+        assert result["image_count"] == 0
+        assert (images_dir / "page_1_image_1_SKIPPED.txt").read_text().startswith("SKIPPED: 40x30 image")
+        assert "[IMAGE: page_3_image_1_SKIPPED.txt]" in Path(result["text_files"][0]).read_text()
+        assert len(result["resource_limits"]) == 6
+    
+    def test_image_byte_budget_per_document(self):
+        extractor = PDFExtractor(max_image_bytes=8000)
+        first = extractor.process_pdf(str(self.pdf), str(self.test_dir / "first"))
+        assert first["image_count"] == 2
+        assert [entry["page"] for entry in first["resource_limits"]] == [5, 7, 9, 11]
+        # The budget is per document
+        second = extractor.process_pdf(str(self.pdf), str(self.test_dir / "second"))
+        assert second["image_count"] == 2
+    
+    def test_image_byte_budget_survives_worker_restarts(self):
+        extractor = CrashingPageExtractor(max_image_bytes=8000, page_timeout=30)
+        result = extractor.process_pdf(str(self.pdf), str(self.test_dir / "out"))
+        assert [error["page"] for error in result["page_errors"]] == [2]
+        # The restarted worker continues from the bytes already spent on pages 1 and 3
+        assert result["image_count"] == 2
+        assert [entry["page"] for entry in result["resource_limits"]] == [5, 7, 9, 11]
+    
+    def test_oversized_render_is_downscaled(self):
+        extractor = PDFExtractor(max_render_pixels=20000)
+        doc = fitz.open(str(self.pdf))
+        image = extractor.render_page_for_ocr(doc[0])
+        doc.close()
+        assert image.width * image.height <= 20000
+        assert extractor.run_stats["resource_limits"][0]["action"] == "downscaled"
+    
+    def test_pages_after_the_limit_are_skipped(self):
+        result = PDFExtractor(max_pages=5).extract_bytes(self.pdf.read_bytes())
+        assert [page["page"] for page in result.pages] == [1, 2, 3, 4, 5, 6]
+        text = "".join(result.chunks)
+        assert "[PAGES 6-12: SKIPPED document has 12 pages, limit is 5]" in text
+        assert "Body text of page 6" not in text
+        assert sorted(result.images) == ["page_1_image_1.png", "page_3_image_1.png", "page_5_image_1.png"]
+
+
+class SlowPageExtractor(PDFExtractor):
+    """Takes a noticeable time per page, so overlapping documents can be observed"""
+    
+    def extract_page(self, page, page_num, images_dir):
+        time.sleep(0.3)
+        return super().extract_page(page, page_num, images_dir)
+
+
+@requires_tokenizer
+class TestAsyncAPI:
+    def setup_method(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.pdf = make_test_pdf(self.test_dir / "doc.pdf", pages=4)
+        self.loop = asyncio.new_event_loop()
+        self.extractors = []
+    
+    def teardown_method(self):
+        for extractor in self.extractors:
+            extractor.close_workers()
+        self.loop.close()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    def _extractor(self, extractor_class=PDFExtractor, **kwargs):
+        extractor = extractor_class(**kwargs)
+        self.extractors.append(extractor)
+        return extractor
+    
+    def test_output_matches_sync_api(self):
+        extractor = self._extractor(max_tokens=60)
+        direct = PDFExtractor(max_tokens=60).process_pdf(str(self.pdf), str(self.test_dir / "direct"))
+        result = self.loop.run_until_complete(extractor.aprocess_pdf(str(self.pdf), str(self.test_dir / "async")))
+        
+        assert len(result["text_files"]) == len(direct["text_files"]) > 1
+        for sync_file, async_file in zip(direct["text_files"], result["text_files"]):
+            assert Path(sync_file).read_text() == Path(async_file).read_text()
+        assert result["image_count"] == direct["image_count"] == 2
+        assert result["total_tokens"] == direct["total_tokens"]
+        assert (self.test_dir / "async" / "doc_pages.jsonl.gz").exists()
+        
+        data = self.pdf.read_bytes()
+        in_memory = self.loop.run_until_complete(extractor.aextract_bytes(data))
+        expected = PDFExtractor(max_tokens=60).extract_bytes(data)
+        assert in_memory.chunks == expected.chunks
+        assert in_memory.images == expected.images
+    
+    def test_pages_and_chunks_stream_in_order(self):
+        extractor = self._extractor(max_tokens=60)
+        
+        async def collect(iterator):
+            return [item async for item in iterator]
+        
+        pages = self.loop.run_until_complete(collect(extractor.aiter_pages(str(self.pdf))))
+        assert [page["page"] for page in pages] == [1, 2, 3, 4]
+        assert "Heading for page 3" in pages[2]["text"]
+        
+        chunks = self.loop.run_until_complete(collect(extractor.aiter_chunks(self.pdf.read_bytes())))
+        assert chunks == PDFExtractor(max_tokens=60).extract_bytes(self.pdf.read_bytes()).chunks
+        # Both documents ran in the same pooled worker process
+        assert len(extractor._idle_workers) == 1
+    
+    def test_path_objects_and_page_limit(self):
+        extractor = self._extractor(max_pages=2)
+        
+        async def collect():
+            return [record async for record in extractor.aiter_pages(self.pdf)]
+        
+        pages = self.loop.run_until_complete(collect())
+        expected = PDFExtractor(max_pages=2).extract_bytes(self.pdf.read_bytes()).pages
+        assert pages == expected
+        assert pages[-1]["text"] == "[PAGES 3-4: SKIPPED document has 4 pages, limit is 2]"
+    
+    def test_more_chunk_streams_than_executor_threads(self):
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.loop.set_default_executor(executor)
+        extractor = self._extractor(max_tokens=60, async_concurrency=1)
+        data = self.pdf.read_bytes()
+        
+        async def collect():
+            return [chunk async for chunk in extractor.aiter_chunks(data)]
+        
+        async def run_all():
+            return await asyncio.wait_for(asyncio.gather(*(collect() for _ in range(6))), 120)
+        
+        try:
+            results = self.loop.run_until_complete(run_all())
+        finally:
+            executor.shutdown(wait=False)
+        expected = PDFExtractor(max_tokens=60).extract_bytes(data).chunks
+        assert results == [expected] * 6
+    
+    def _count_busy_workers(self, extractor, monkeypatch):
+        """Track how many pooled workers are checked out at once"""
+        busy = []
+        peak = [0]
+        checkout, release = extractor._checkout_worker, extractor._release_worker
+        
+        def counting_checkout(*args):
+            worker = checkout(*args)
+            busy.append(worker)
+            peak[0] = max(peak[0], len(busy))
+            return worker
+        
+        def counting_release(worker):
+            busy.remove(worker)
+            release(worker)
+        
+        monkeypatch.setattr(extractor, "_checkout_worker", counting_checkout)
+        monkeypatch.setattr(extractor, "_release_worker", counting_release)
+        return peak
+    
+    def test_shared_semaphore_limits_concurrent_work(self, monkeypatch):
+        extractor = self._extractor(SlowPageExtractor)
+        peak = self._count_busy_workers(extractor, monkeypatch)
+        paths = [make_test_pdf(self.test_dir / f"doc{i}.pdf", pages=2) for i in range(4)]
+        
+        async def run_all():
+            semaphore = asyncio.Semaphore(2)
+            return await asyncio.gather(*(extractor.aprocess_pdf(str(path), semaphore=semaphore)
+                                          for path in paths))
+        
+        results = self.loop.run_until_complete(run_all())
+        assert [Path(result["pdf_path"]).name for result in results] == [path.name for path in paths]
+        assert peak[0] == 2
+        assert len(extractor._idle_workers) == 2
+    
+    def test_pages_of_one_document_run_in_parallel(self, monkeypatch):
+        extractor = self._extractor(SlowPageExtractor, max_tokens=60, async_concurrency=2,
+                                    async_pages_per_task=1)
+        peak = self._count_busy_workers(extractor, monkeypatch)
+        pdf = make_test_pdf(self.test_dir / "long.pdf", pages=8)
+        result = self.loop.run_until_complete(extractor.aextract_bytes(pdf.read_bytes()))
+        
+        expected = PDFExtractor(max_tokens=60).extract_bytes(pdf.read_bytes())
+        assert result.chunks == expected.chunks
+        assert result.images == expected.images
+        assert [page["page"] for page in result.pages] == list(range(1, 9))
+        assert peak[0] == 2
+    
+    def test_image_byte_budget_is_spent_in_page_order(self):
+        extractor = self._extractor(max_image_bytes=8000, async_concurrency=4, async_pages_per_task=1)
+        pdf = make_test_pdf(self.test_dir / "images.pdf", pages=12)
+        result = self.loop.run_until_complete(extractor.aextract_bytes(pdf.read_bytes()))
+        assert result.image_count == 2
+        assert result.images == PDFExtractor(max_image_bytes=8000).extract_bytes(pdf.read_bytes()).images
+        assert [entry["page"] for entry in result.stats["resource_limits"]] == [5, 7, 9, 11]
+    
+    def test_discarded_images_are_not_sent_back(self, monkeypatch):
+        received = []
+        receive = SupervisedPageWorker._receive
+        
+        def recording_receive(worker, timeout):
+            payload = receive(worker, timeout)
+            if payload is not None:
+                received.append(payload[2])
+            return payload
+        
+        monkeypatch.setattr(SupervisedPageWorker, "_receive", recording_receive)
+        extractor = self._extractor()
+        
+        async def collect():
+            return [record async for record in extractor.aiter_pages(self.pdf)]
+        
+        pages = self.loop.run_until_complete(collect())
+        assert "[IMAGE: page_1_image_1.png]" in pages[0]["text"]
+        assert received == [{}] * 4
+    
+    def test_cancellation_kills_the_page_in_flight(self):
+        extractor = self._extractor(PathologicalPageExtractor)
+        pages = []
+        
+        async def consume():
+            async for record in extractor.aiter_pages(str(self.pdf)):
+                pages.append(record)
+        
+        async def cancel_after_first_page():
+            task = asyncio.ensure_future(consume())
+            while not pages:
+                await asyncio.sleep(0.05)
+            await asyncio.sleep(0.5)  # page 2 hangs in the worker
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        
+        started = time.monotonic()
+        self.loop.run_until_complete(cancel_after_first_page())
+        assert time.monotonic() - started < 30
+        assert [page["page"] for page in pages] == [1]
+        assert extractor._idle_workers == []
+        
+        # The extractor keeps working after a cancelled call
+        single = make_test_pdf(self.test_dir / "single.pdf", pages=1)
+        result = self.loop.run_until_complete(extractor.aextract_bytes(single.read_bytes()))
+        assert "Heading for page 1" in result.chunks[0]
+    
+    def test_cancel_event_stops_between_pages(self):
+        cancel = threading.Event()
+        extractor = self._extractor(cancel_event=cancel,
+                                    progress_callback=lambda event: event["event"] == "page" and cancel.set())
+        with pytest.raises(ExtractionCancelled):
+            self.loop.run_until_complete(extractor.aextract_bytes(self.pdf.read_bytes()))
+        # No page was in flight, so the worker went back to the pool
+        assert len(extractor._idle_workers) == 1
+
+
 def run_manual_test():
     """Manual test function to validate with actual PDF"""
     print("Running manual validation...")